@@ -0,0 +1,181 @@
+"""Fast circular aperture sums based on a summed-area table.
+
+The image is integrated once per frame. A circular aperture is split into
+rectangles of pixels that are fully inside the circle, which are summed with
+four lookups in the summed-area table each, and the pixels on the edge of the
+circle, which are summed with their exact overlap weight. The footprints are
+cached per radius and sub-pixel position of the center, so thousands of
+apertures per frame can be summed in one vectorized call.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import numpy as np
+
+from photutils.geometry import circular_overlap_grid
+from astropy.stats import sigma_clipped_stats
+
+import settings as s
+
+
+
+class ApertureEngine:
+    """Aperture sums on one image.
+
+    Parameters
+    ----------
+    image
+        Observed image (without background)
+    phase_steps : int
+        Number of steps per pixel the sub-pixel position of the aperture center is rounded to.
+        The footprints are exact for the rounded position.
+
+    """
+
+    def __init__(self, image, phase_steps=None):
+        self.image = np.asarray(image, dtype=float)
+        if(phase_steps is None):
+            phase_steps = s.APERTURE_PHASE_STEPS
+        self.phase_steps = int(phase_steps)
+        self._pad = -1
+        self._padded = None
+        self._table = None
+        self._footprints = {}
+
+    def _prepare(self, radius):
+        """Pad the image so every aperture touching the image fits and build the summed-area table."""
+        pad = 2*int(np.ceil(radius)) + 3
+        if(pad <= self._pad):
+            return
+        self._pad = pad
+        self._padded = np.pad(self.image, pad, 'constant')
+        table = np.zeros((self._padded.shape[0]+1, self._padded.shape[1]+1))
+        np.cumsum(np.cumsum(self._padded, axis=0), axis=1, out=table[1:, 1:])
+        self._table = table
+
+    def _footprint(self, radius, phase_x, phase_y):
+        """Cached decomposition of the aperture into full rectangles and weighted edge pixels.
+
+        Returns
+        -------
+        rectangles : array
+            (k, 4) array with y0, y1, x0, x1 offsets (inclusive) of the rectangles fully inside the circle
+        edge : tuple
+            offsets dy, dx and weights of the pixels partially inside the circle
+
+        """
+        key = (round(radius, 6), phase_x, phase_y)
+        if(key in self._footprints):
+            return self._footprints[key]
+        fx = phase_x / self.phase_steps
+        fy = phase_y / self.phase_steps
+        half = int(np.ceil(radius)) + 1
+        n = 2*half + 1
+        weights = circular_overlap_grid(-half-0.5-fx, half+0.5-fx, -half-0.5-fy, half+0.5-fy, n, n, radius, 1, 1)
+
+        full = weights >= 1 - 1e-10
+        rectangles = []
+        for row in range(n):
+            columns = np.nonzero(full[row])[0]
+            if(len(columns) == 0):
+                continue
+            span = [columns[0]-half, columns[-1]-half]
+            #merge rows with the same span into one rectangle
+            if(rectangles and rectangles[-1][1] == row-half-1 and rectangles[-1][2:] == span):
+                rectangles[-1][1] = row-half
+            else:
+                rectangles.append([row-half, row-half] + span)
+        rectangles = np.array(rectangles, dtype=int).reshape(-1, 4)
+
+        partial = (weights > 1e-10) & ~full
+        edge_y, edge_x = np.nonzero(partial)
+        edge = (edge_y-half, edge_x-half, weights[partial])
+
+        self._footprints[key] = (rectangles, edge)
+        return rectangles, edge
+
+    def sum_circular(self, x, y, radius):
+        """Sum the image in circular apertures.
+
+        Pixel centers are at integer coordinates (same convention as photutils).
+        Pixels outside of the image count as zero. Apertures completely outside the image give nan.
+
+        Parameters
+        ----------
+        x, y : array
+            Aperture centers in pixel
+        radius : float
+            Aperture radius in pixel
+
+        Returns
+        -------
+        sums : array
+
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        self._prepare(radius)
+        pad = self._pad
+        sums = np.full(x.shape, np.nan)
+
+        inside = ((x > -0.5-radius) & (x < self.image.shape[1]-0.5+radius) &
+                  (y > -0.5-radius) & (y < self.image.shape[0]-0.5+radius))
+        if(not np.any(inside)):
+            return sums
+        index = np.nonzero(inside)[0]
+        ix = np.floor(x[index] + 0.5).astype(int)
+        iy = np.floor(y[index] + 0.5).astype(int)
+        phase_x = np.round((x[index] - ix) * self.phase_steps).astype(int)
+        phase_y = np.round((y[index] - iy) * self.phase_steps).astype(int)
+        ix = ix + pad
+        iy = iy + pad
+
+        phases, group = np.unique(np.column_stack([phase_x, phase_y]), axis=0, return_inverse=True)
+        group = group.reshape(-1)
+        table = self._table
+        for i, (p_x, p_y) in enumerate(phases):
+            members = np.nonzero(group == i)[0]
+            rectangles, (edge_y, edge_x, edge_w) = self._footprint(radius, p_x, p_y)
+            cy = iy[members][:, np.newaxis]
+            cx = ix[members][:, np.newaxis]
+            total = np.zeros(len(members))
+            if(rectangles.shape[0] > 0):
+                y0 = cy + rectangles[:,0]
+                y1 = cy + rectangles[:,1] + 1
+                x0 = cx + rectangles[:,2]
+                x1 = cx + rectangles[:,3] + 1
+                total += np.sum(table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0], axis=1)
+            if(len(edge_w) > 0):
+                total += self._padded[cy + edge_y, cx + edge_x] @ edge_w
+            sums[index[members]] = total
+        return sums
+
+    def random_aperture_noise(self, radius, n_apertures=None):
+        """Estimate the noise in an aperture from apertures placed at random positions in the image.
+
+        Parameters
+        ----------
+        radius : float
+            Aperture radius in pixel
+        n_apertures : int
+            Number of random apertures, default from settings
+
+        Returns
+        -------
+        std_apertures : float
+            sigma clipped standard deviation of the random aperture sums
+
+        """
+        if(n_apertures is None):
+            n_apertures = s.N_NOISE_APERTURES
+        ny, nx = self.image.shape
+        ran_x = 2*radius + np.random.random(n_apertures) * (nx-4*radius)
+        ran_y = 2*radius + np.random.random(n_apertures) * (ny-4*radius)
+        random_sums = self.sum_circular(ran_x, ran_y, radius)
+        m,_, std_apertures = sigma_clipped_stats(random_sums, sigma=3)
+        return std_apertures
@@ -20,6 +20,14 @@ from argparse import ArgumentParser
 
 import get_catalog_data as query
 import get_transformation as register
+import triangle_hash
+import detection_table
+import solve_manifest
+import batch_schedule
+import job_queue
+import diagnostics
+import image_io
+import profiling
 import settings as s
 #
 import astropy.units as u
@@ -31,17 +39,18 @@ from photutils import DAOStarFinder
 from photutils import aperture_photometry, CircularAperture
 #from astropy.stats import mad_std
 from astropy.stats import sigma_clipped_stats
-from matplotlib.colors import LogNorm
 from astropy.wcs import WCS
 from astropy.wcs import Wcsprm
 from astropy.table import Table
 import warnings
 import os
 import copy
+import contextlib
+import io
 
 
 
-def find_sources(image, vignette=3):
+def find_sources(image, vignette=3, binning=1):
     """Find surces in the image. Uses DAOStarFinder with symmetric gaussian kernels. Only uses 5 sigma detections. It only gives the 200 brightest sources or less.
     This has to work well for the later calculations to work. Possible issues: low signal to noise image, gradient in the background
 
@@ -51,13 +60,19 @@ def find_sources(image, vignette=3):
         Observed image (without background)
     vignette : float
         Cut off courners with a vignette. Default: nothing cut off
+    binning : int
+        Detect on the image block summed by binning x binning pixels, FWHM, thresholds and aperture are scaled to match.
+        Much faster for large images, the positions are only good to a fraction of the binning (see refine_centroids).
 
     Returns
     -------
     observaion : dataframe
-        Pandas dataframe with the sources
+        Pandas dataframe with the sources, positions in pixels of the full resolution image
 
     """
+    if(binning > 1):
+        image = diagnostics.block_average(image, binning)*binning**2
+
     #find sources
     #bkg_sigma = mad_std(image)
     mean, median, std = sigma_clipped_stats(image, sigma=3.0)
@@ -66,7 +81,6 @@ def find_sources(image, vignette=3):
     if(vignette < 3):
         image = copy.copy(image)
         sidelength = np.max(image.shape)
-        print(sidelength)
         x = np.arange(0, image.shape[1])
         y = np.arange(0, image.shape[0])
         vignette = vignette * sidelength/2
@@ -75,20 +89,20 @@ def find_sources(image, vignette=3):
 
     #daofind = DAOStarFinder(fwhm=4., threshold=5.*std, brightest=200)
     #daofind = DAOStarFinder(fwhm=7., threshold=0.6, brightest=400 )
-    daofind = DAOStarFinder(fwhm=s.FWHM, threshold=s.DETECTION_SIGMA_THRESHOLD *std, brightest=s.N_BRIGHTEST_SOURCES )
+    #std is measured on the binned image, the absolute threshold scales with the pixels summed into one
+    daofind = DAOStarFinder(fwhm=s.FWHM/binning, threshold=s.DETECTION_SIGMA_THRESHOLD *std, brightest=s.N_BRIGHTEST_SOURCES )
     if(s.DETECTION_ABSOLUTE_THRESHOLD is not None):
-        daofind = DAOStarFinder(fwhm=s.FWHM, threshold=s.DETECTION_ABSOLUTE_THRESHOLD, brightest=s.N_BRIGHTEST_SOURCES )
+        daofind = DAOStarFinder(fwhm=s.FWHM/binning, threshold=s.DETECTION_ABSOLUTE_THRESHOLD*binning**2, brightest=s.N_BRIGHTEST_SOURCES )
 
 
 
 
     sources = daofind(image)
-    print("REACHED")
     for col in sources.colnames:
         sources[col].info.format = '%.8g'  # for consistent table output
 
     positions = (sources['xcentroid'], sources['ycentroid'])
-    apertures = CircularAperture(positions, r=4.)
+    apertures = CircularAperture(positions, r=4./binning)
     phot_table = aperture_photometry(image, apertures)
     for col in phot_table.colnames:
         phot_table[col].info.format = '%.8g'  # for consistent table output
@@ -97,10 +111,108 @@ def find_sources(image, vignette=3):
 
     #through out candidates where the star finder messed up
     observation = observation.query("aperture_sum > "+str(5*std))
+    if(binning > 1):
+        #center of binned pixel i is at (i+0.5)*binning-0.5 in the full resolution image
+        observation = observation.assign(xcenter=(observation["xcenter"]+0.5)*binning-0.5,
+                                         ycenter=(observation["ycenter"]+0.5)*binning-0.5)
     return  observation
 
 
-def write_wcs_to_hdr(original_filename, wcsprm):
+def windowed_centroids(image, x, y, fwhm, iterations=10):
+    """Centroids with a gaussian window that follows the star (like XWIN of SExtractor), much less noisy than the plain center of mass.
+
+    Parameters
+    ----------
+    image
+        Image (without background)
+    x, y : array
+        Start positions in pixel, good to about the fwhm
+    fwhm : float
+        Seeing in pixel, sets the window
+    iterations : int
+
+    Returns
+    -------
+    x, y : array
+        Centroids, sources too close to the edge keep their start position
+
+    """
+    half_size = int(np.ceil(2*fwhm))
+    sigma = fwhm/(2*np.sqrt(2*np.log(2)))
+    x = np.array(x, dtype=float)
+    y = np.array(y, dtype=float)
+    ny, nx = image.shape
+    ix = np.round(x).astype(int)
+    iy = np.round(y).astype(int)
+    inside = np.flatnonzero((ix >= half_size) & (ix < nx-half_size) & (iy >= half_size) & (iy < ny-half_size))
+    if(len(inside) == 0):
+        return x, y
+
+    #one stamp per source, the window moves inside the stamp
+    offsets = np.arange(-half_size, half_size+1)
+    rows = iy[inside, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+    columns = ix[inside, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+    stamps = image[rows, columns].astype(float)
+    center_x = x[inside]
+    center_y = y[inside]
+    for _ in range(iterations):
+        dx = columns - center_x[:, np.newaxis, np.newaxis]
+        dy = rows - center_y[:, np.newaxis, np.newaxis]
+        weighted = stamps*np.exp(-(dx**2+dy**2)/(2*sigma**2))
+        norm = weighted.sum(axis=(1,2))
+        good = norm > 0
+        norm[~good] = 1.
+        #steps are limited to a pixel so noise can not throw the window off the star
+        center_x = center_x + np.where(good, np.clip(2*(weighted*dx).sum(axis=(1,2))/norm, -1, 1), 0)
+        center_y = center_y + np.where(good, np.clip(2*(weighted*dy).sum(axis=(1,2))/norm, -1, 1), 0)
+    x[inside] = center_x
+    y[inside] = center_y
+    return x, y
+
+
+def refine_centroids(image, detections, catalog_sources, wcsprm, radius):
+    """Measure the positions of the detections close to a catalog source on the full resolution image.
+
+    Used after the coarse solve on a binned image (see find_sources), the other detections keep their position.
+
+    Parameters
+    ----------
+    image
+        Full resolution image (without background)
+    detections : Detections
+        Sources found on the binned image
+    catalog_sources : CatalogSources
+    wcsprm
+        World coordinates after the coarse solve
+    radius : float
+        Only detections within this many pixels of a catalog source are measured
+
+    Returns
+    -------
+    detections : Detections
+        Detections with the refined positions
+    n_refined : int
+        Number of refined positions
+
+    """
+    distances, matches = register.nearest_catalog_source(detections, catalog_sources.on_sensor(wcsprm))
+    matched = np.flatnonzero(distances < radius**2) #squared distances
+    x = detections.x.copy()
+    y = detections.y.copy()
+    x[matched], y[matched] = windowed_centroids(image, x[matched], y[matched], s.FWHM)
+    return register.Detections(x, y, detections.flux, detections.rows), len(matched)
+
+
+def output_filename(fits_image_filename, output_mode="copy"):
+    """File the result of the frame is written to, see write_wcs_to_hdr."""
+    if(output_mode == "copy"):
+        return fits_image_filename.rsplit('.', 1)[0]+'_astro.fits'
+    if(output_mode in ["wcs", "head"]):
+        return image_io.sidecar_filename(fits_image_filename, output_mode)
+    return fits_image_filename
+
+
+def write_wcs_to_hdr(original_filename, wcsprm, extra_hdus=[], compression=None, output_mode="copy"):
     """Update the header of the fits file itself.
 
     Parameters
@@ -109,31 +221,70 @@ def write_wcs_to_hdr(original_filename, wcsprm):
         Original filename of the fits file
     wcsprm : astropy.wcs.wcsprm
         World coordinate system object decsribing translation between image and skycoord
+    extra_hdus : list
+        Extensions to add to the output, e.g. the detection table. Existing extensions with the same EXTNAME are replaced
+    compression : str
+        Write the image tile compressed with this algorithm (e.g. 'RICE_1'). Compressed input is copied as it is
+    output_mode : str
+        'copy': new file <name>_astro.fits with image, updated header and extensions.
+        'wcs': only the WCS and the extensions in <name>.wcs. 'head': only the WCS as text header <name>.head.
+        'inplace': update the header of the original file, the extensions are not stored.
+        The output does not need to copy the image except for 'copy', all files are replaced atomically
 
     """
-    with fits.open(original_filename) as hdul:
+    wcs_header = WCS(wcsprm.to_header()).to_header()
+    if(output_mode == "wcs"):
+        shape = image_io.image_header(original_filename)
+        print("wcs written to {}".format(image_io.write_wcs_sidecar(original_filename, wcs_header, (shape["NAXIS2"], shape["NAXIS1"]), extra_hdus)))
+        return
+    if(output_mode == "head"):
+        print("wcs written to {}".format(image_io.write_head_sidecar(original_filename, wcs_header)))
+        return
+    if(output_mode == "inplace"):
+        if(image_io.update_header_in_place(original_filename, wcs_header)):
+            print("header of {} updated in place.".format(original_filename))
+        else:
+            print("header of {} did not fit into its header blocks, HDUs written again.".format(original_filename))
+        return
 
-        hdu = hdul[0]
+    #compressed images stay binary tables, so only the header changes and the tiles are copied without recompression
+    with fits.open(original_filename, disable_image_compression=True) as hdul:
+
+        index = image_io.image_hdu_index(hdul)
+        hdu = hdul[index]
         hdr_file = hdu.header
 
         #new_header_info = wcs.to_header()
 
-        wcs =WCS(wcsprm.to_header())
-
         #I will through out CD which contains the scaling and separate into pc and Cdelt
-        for old_parameter in ['CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', "PC1_1", "PC1_2", "PC2_1", "PC2_2"]:
-            if (old_parameter in hdr_file):
-                del hdr_file[old_parameter]
-
-        hdr_file.update(wcs.to_header())
+        image_io.update_wcs(hdr_file, wcs_header)
         repr(hdr_file)
 
         hdu.header = hdr_file
-        hdul[0] = hdu
-        #removing fits ending
-        name_parts = original_filename.rsplit('.', 1)
-        hdul.writeto(name_parts[0]+'_astro.fits', overwrite=True)
-        print("file written.")
+        lossy = False
+        if(compression is not None and not image_io.is_compressed(hdu)):
+            lossy = image_io.is_lossy_compression(hdu.data)
+            #the image moves into a compressed extension behind an empty primary HDU
+            if(index == 0):
+                hdul.insert(0, fits.PrimaryHDU())
+                index = 1
+            hdul[index] = image_io.compress(hdul[index], compression)
+        else:
+            hdul[index] = hdu
+        for extra_hdu in extra_hdus:
+            extname = extra_hdu.header["EXTNAME"]
+            if(extname in hdul):
+                del hdul[extname]
+            hdul.append(extra_hdu)
+        hdul.writeto(output_filename(original_filename), overwrite=True)
+    if(lossy):
+        #the stored tables have to refer to the pixels as they were written
+        with fits.open(output_filename(original_filename)) as hdul:
+            data = image_io.image_hdu(hdul).data
+        #the tiles are left as they are, in update mode astropy would quantize the image again
+        with fits.open(output_filename(original_filename), mode="update", disable_image_compression=True) as hdul:
+            detection_table.update_checksums(hdul, data)
+    print("file written.")
 
 
 
@@ -245,6 +396,48 @@ def read_additional_info_from_header(wcsprm, hdr, RA_input=None, DEC_input=None,
 
 
 
+def plausible_pixscales(hdr, scale_range=None):
+    """Pixel scales (arcsec/pixel) searched if the pixel scale is unclear: scale_range if given, else PIXSCALE_RANGES for the instrument in the header, else PIXSCALE_RANGE."""
+    if(scale_range is not None):
+        return list(scale_range)
+    instrument = str(hdr.get("INSTRUME", "")).strip()
+    return list(s.PIXSCALE_RANGES.get(instrument, s.PIXSCALE_RANGE))
+
+
+def rough_position(wcsprm, shape, PIXSCALE_UNCLEAR):
+    """Center of the catalog query: crval, or the center of the image if crval is outside of the image."""
+    coord = SkyCoord(wcsprm.crval[0], wcsprm.crval[1], unit=(u.deg, u.deg), frame="icrs")
+    if(not PIXSCALE_UNCLEAR):
+        if(wcsprm.crpix[0] < 0 or wcsprm.crpix[1] < 0 or wcsprm.crpix[0] > shape[0] or wcsprm.crpix[1] > shape[1] ):
+            print("central value outside of the image, moving it to the center")
+            coord_radec = wcsprm.p2s([[shape[0]/2, shape[1]/2]], 0)["world"][0]
+            coord = SkyCoord(coord_radec[0], coord_radec[1], unit=(u.deg, u.deg), frame="icrs")
+            #print(wcsprm)
+    return coord
+
+
+def catalog_cone(fits_image_filename, args):
+    """Catalog query of a frame (center and radius) from the header only, the same as solve_frame will use.
+
+    Returns None if the header does not give a position.
+    """
+    try:
+        hdr = image_io.image_header(fits_image_filename)
+        shape = (hdr["NAXIS2"], hdr["NAXIS1"])
+        hdr["NAXIS1"] = shape[0]
+        hdr["NAXIS2"] = shape[1]
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            wcsprm = WCS(hdr).wcs
+            wcsprm, fov_radius, _, PIXSCALE_UNCLEAR = read_additional_info_from_header(wcsprm, hdr, args.ra, args.dec, args.projection_ra, args.projection_dec)
+            coord = rough_position(wcsprm, shape, PIXSCALE_UNCLEAR)
+    except Exception:
+        return None
+    if(np.array_equal(wcsprm.crval, [0,0])):
+        return None
+    return coord, u.Quantity(fov_radius, u.arcmin)
+
+
 def parseArguments():
     """Parse the given Arguments when calling the file from the command line.
 
@@ -284,6 +477,19 @@ def parseArguments():
 
     parser.add_argument("-vignette", "--vignette", help="Do not use corner of the image. Only use the data in a circle around the center with certain radius. Default: not used. Set to 1 for circle that touches the sides. Less to cut off more", type=float, default=3)
 
+    parser.add_argument("-fast", "--fast_mode", help="Scaling, rotation and offset are first determined with the brightest sources only and repeated with all sources if that result is not convincing. Set to 0 to always use all sources", type=int, default=1)
+    parser.add_argument("-blind", "--blind_solve", help="If the pixelscale is unclear, scale, rotation and offset are first searched with triangle hashes. Set to 0 to always use the cross correlation", type=int, default=s.BLIND_SOLVE)
+    parser.add_argument("-scale_search", "--scale_search", help="If the pixelscale is unclear (and the blind solve failed), a bank of pixel scales within -scale_range is searched in one pass. Set to 0 to search with one wide histogram instead", type=int, default=s.SCALE_SEARCH)
+    parser.add_argument("-scale_range", "--scale_range", help="Smallest and largest plausible pixel scale in arcsec/pixel for the scale search. Default: PIXSCALE_RANGES for the instrument (INSTRUME in the header) or PIXSCALE_RANGE from settings. example: -scale_range 0.1 0.5", type=float, nargs=2, default=None)
+    parser.add_argument("-manifest", "--manifest", help="SQLite file that keeps track of solved frames. Frames already solved with the same settings are skipped, failed ones are retried. Query it with solve_manifest.py", type=str, default=None)
+    parser.add_argument("-queue", "--queue", help="SQLite job queue on shared storage. The frames are added to the queue and solved by this and all other workers on the queue (start more with job_queue.py)", type=str, default=None)
+    parser.add_argument("-schedule", "--schedule", help="With several frames, frames of the same field are solved one after the other and the catalog is downloaded once for all of them. Set to 0 to use the given order", type=int, default=1)
+    parser.add_argument("-profile", "--profile", help="Write a profile per frame: cProfile statistics (<frame>_profile_<stage>.pstats) and memory peak of each stage (read, detect, catalog, ...) with a summary in <frame>_profile.txt", action="store_true")
+    parser.add_argument("-bin", "--detection_binning", help="Detect sources for the coarse solve on the image block summed by this factor (2 or 4), only the matched sources are measured on the full resolution image for the fine transformation. Much faster for large detectors. Default: 1 (no binning)", type=int, default=s.DETECTION_BINNING)
+    parser.add_argument("-compress", "--compress", help="Write the _astro.fits output tile compressed with this algorithm, e.g. RICE_1 or GZIP_2. Compressed input is always written compressed", type=str, default=None)
+    parser.add_argument("-output", "--output_mode", help="'copy' writes <name>_astro.fits with the image, 'wcs' only the wcs and detections to <name>.wcs, 'head' only the wcs as text header <name>.head, 'inplace' updates the header of the file itself. Default: copy", type=str, default=s.OUTPUT_MODE, choices=["copy", "wcs", "head", "inplace"])
+    parser.add_argument("-precision", "--precision", help="'single' computes the image and the registration arrays in float32, which halves memory use and traffic. Default: 'double'", type=str, default=s.PRECISION, choices=["double", "single"])
+
 
 
     # Print version
@@ -300,11 +506,337 @@ def parseArguments():
     return args
 
 
+def solve_frame(fits_image_filename, args, StartTime, renderer=None):
+    """Astrometry for one fits file. The result is written to the file with the ending _astro.fits (or as chosen with -output).
+
+    Parameters
+    ----------
+    fits_image_filename : str
+        fits file
+    args
+        command line arguments, see parseArguments
+    StartTime : datetime
+        start of the run, for the timing output
+    renderer : DiagnosticRenderer
+        renders the plots before and after the fit, None for no plots
+
+    Returns
+    -------
+    result : dict
+        wcs (header as string), n_matches and rms_px of the sources matched within 3 pixel
+        and the mode used to find scaling, rotation and offset (blind, fast, full or none)
+
+    """
+    print("")
+    print(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
+    print("> Astrometry for {} ".format(fits_image_filename))
+
+    profiling.begin("read")
+    with fits.open(fits_image_filename) as hdul:
+        #print(hdul.info())
+        #print(hdul[0].header)
+
+        #first HDU with an image, for tile compressed files the first extension
+        hdu = image_io.image_hdu(hdul)
+        #hdu.verify('fix')
+        hdr = hdu.header
+
+        #with a vignette only the part of the image inside is read, for compressed images only those tiles are decompressed
+        box = None
+        if(args.vignette < 1):
+            box = image_io.vignette_box(hdu.shape, args.vignette)
+        data = image_io.read_pixels(hdu, box)
+        checksum = detection_table.image_checksum(data)
+        image_or = data.astype(register.float_type())
+        median = np.nanmedian(image_or)
+        image_or[np.isnan(image_or)]=median
+        if(box is not None):
+            y0, y1, x0, x1 = box
+            image_full = np.full(hdu.shape, median, dtype=image_or.dtype)
+            image_full[y0:y1, x0:x1] = image_or
+            image_or = image_full
+        image = image_or - median
+
+    profiling.begin("detect")
+    binning = getattr(args, "detection_binning", 1)
+    observation = find_sources(image, args.vignette, binning)
+    #print(observation)
+
+    detections_px = np.column_stack([observation['xcenter'], observation['ycenter']])
+
+    profiling.begin("header")
+
+    #world coordinates
+    print(">Info found in the file -- (CRVAl: position of central pixel (CRPIX) on the sky)")
+    print(WCS(hdr))
+
+    hdr["NAXIS1"] = image.shape[0]
+    hdr["NAXIS2"] = image.shape[1]
+
+    #wcsprm = Wcsprm(hdr.tostring().encode('utf-8')) #everything else gave me errors with python 3, seemed to make problems with pc conversios, so i wwitched to the form below
+    wcsprm = WCS(hdr).wcs
+    wcsprm_original = WCS(hdr).wcs
+    if(args.verbose):
+        print(WCS(wcsprm.to_header()))
+    wcsprm, fov_radius, INCREASE_FOV_FLAG, PIXSCALE_UNCLEAR = read_additional_info_from_header(wcsprm, hdr, args.ra, args.dec, args.projection_ra, args.projection_dec)
+    if(args.verbose):
+        print(WCS(wcsprm.to_header()))
+
+    #print(wcsprm)
+    #wcsprm.pc = [[2, 0],[0,1]]
+
+
+    #Possibly usefull examples of how to use wcsprm:
+    #print(wcsprm.set())
+    #print(wcsprm.get_pc())
+    #pc = wcsprm.get_pc()
+    #print(np.linalg.det(pc))
+    #print(wcsprm.get_cdelt())
+    #wcs.fix()
+    #print(wcsprm.print_contents())
+    #print(repr(hdr.update(wcsprm.to_header().encode('utf-8')))) #not working
+
+    #hdu.verify("fix")
+    #print(repr(hdr))
+    #wcs.wcs_pix2world(pixcrd, 1)
+    #wcs.wcs_world2pix(world, 1)
+    #wcs.wcs.crpix = [-234.75, 8.3393]
+    # wcs.wcs.cdelt = np.array([-0.066667, 0.066667])
+    # wcs.wcs.crval = [0, -90]
+    # wcs.wcs.ctype = ["RA---AIR", "DEC--AIR"]
+    # wcs.wcs.set_pv([(2, 1, 45.0)])
+    # For historical compatibility, three alternate specifications of the linear transformations
+    # are available in wcslib. The canonical PCi_ja with CDELTia, CDi_ja, and the deprecated CROTAia
+    # keywords. Although the latter may not formally co-exist with PCi_ja,
+    # the approach here is simply to ignore them if given in conjunction with PCi_ja.
+    # has_pc, has_cd and has_crota can be used to determine which of these alternatives are present in the header.
+    # These alternate specifications of the linear transformation matrix are translated immediately to PCi_ja by set
+    # and are nowhere visible to the lower-level routines. In particular, set resets cdelt to unity if CDi_ja is present
+    # (and no PCi_ja). If no CROTAia is associated with the latitude axis, set reverts to a unity PCi_ja matrix.
+
+
+
+
+
+    profiling.begin("catalog")
+    #get rough coordinates
+    #print(hdr["RA"])
+    #coord = SkyCoord(hdr["RA"], hdr["DEC"], unit=(u.hourangle, u.deg), frame="icrs")
+    coord = rough_position(wcsprm, image.shape, PIXSCALE_UNCLEAR)
+
+
+
+    #failed downloads are retried, see catalog_client.py
+    print(">Dowloading catalog data")
+    radius = u.Quantity(fov_radius, u.arcmin)#will prob need more
+    catalog_data = query.get_data(coord, radius, args.catalog)
+    #reference = reference.query("mag <20")
+    max_sources = 500
+    if(INCREASE_FOV_FLAG):
+        max_sources= max_sources*2.25 #1.5 times the radius, so 2.25 the area
+    if(catalog_data is not None and catalog_data.shape[0]>max_sources):
+        catalog_data = catalog_data.nsmallest(400, "mag")
+
+    catalog_merged = False
+    if(args.catalog == "GAIA" and catalog_data.shape[0] < 5):
+        print("GAIA seems to not have enough objects, will enhance with PS1")
+        catalog_data2 = query.get_data(coord, radius, "PS")
+        #stars found by both surveys are only kept once
+        catalog_data = query.merge_catalogs([("GAIA", catalog_data), ("PS", catalog_data2)])
+        catalog_merged = True
+    elif(args.catalog == "PS" and (catalog_data is None or catalog_data.shape[0] < 5)):
+        print("We seem to be outside the PS footprint, enhance with GAIA data")
+        catalog_data2 = query.get_data(coord, radius, "GAIA")
+        catalog_data = query.merge_catalogs([("PS", catalog_data), ("GAIA", catalog_data2)])
+        catalog_merged = True
+
+    #plotting what we have, I keep it in the detector field, world coordinates are more painfull to plot
+    #rendered in the background from a binned quick-look image, so it does not hold up the solving
+    profiling.begin("plot")
+    name_parts = fits_image_filename.rsplit('.', 1)
+    if(renderer is not None):
+        image_small, plot_binning = diagnostics.quicklook(image)
+        renderer.submit(diagnostics.draw_overview, filename=name_parts[0]+"_image_before.pdf" if args.save_images else None,
+                        window_title='Input for {}'.format(fits_image_filename), image=image_small, factor=plot_binning, shape=image.shape,
+                        detections=detections_px, catalog=wcsprm.s2p(catalog_data[["ra", "dec"]], 1)['pixcrd'],
+                        title="Input - red: catalog sources, blue: detected sources in img")
+
+    ###tranforming to match the sources
+    print("---------------------------------")
+    print(">Finding the transformation")
+    blind_solved = False
+    mode = "none"
+    #the registration works on arrays, the dataframes are only converted once
+    detections = register.Detections.from_dataframe(observation)
+    catalog_sources = register.CatalogSources.from_dataframe(catalog_data)
+    #frames cut from the same downloaded region share the catalog side of the scale and rotation search
+    catalog_region = None
+    region_key, region_data = query.downloaded_region(coord, radius, args.catalog)
+    if(region_key is not None and not catalog_merged):
+        catalog_region = register.CatalogRegion(region_key, register.CatalogSources.from_dataframe(region_data),
+                                                (coord.icrs.ra.deg, coord.icrs.dec.deg), radius.to(u.deg).value)
+    profiling.end() #the registration marks its own stages
+    if(PIXSCALE_UNCLEAR and args.blind_solve):
+        print("Pixelscale unclear, trying blind solve with triangle hashes")
+        with profiling.stage("blind"):
+            wcsprm_blind = triangle_hash.blind_solve(detections, catalog_sources, wcsprm, coord, radius, args.catalog, verbose=args.verbose)
+        if(wcsprm_blind is not None):
+            wcsprm = wcsprm_blind
+            blind_solved = True
+            mode = "blind"
+    if(not blind_solved and (args.rotation_scaling or args.xy_transformation)):
+        scale_factors = None
+        if(PIXSCALE_UNCLEAR and getattr(args, "scale_search", s.SCALE_SEARCH)):
+            pixscale_range = plausible_pixscales(hdr, getattr(args, "scale_range", None))
+            scale_factors = register.scale_hypotheses(wcsprm, pixscale_range)
+            print("Pixelscale unclear, searching {} pixel scales between {:.3g} and {:.3g} arcsec".format(len(scale_factors), *pixscale_range))
+        wcsprm, solve_diagnostics = register.coarse_registration(detections, catalog_sources, wcsprm, scale_guessed=PIXSCALE_UNCLEAR,
+                                                 rotation_scaling=args.rotation_scaling, xy_transformation=args.xy_transformation,
+                                                 fast=args.fast_mode, INCREASE_FOV_FLAG=INCREASE_FOV_FLAG, verbose=args.verbose,
+                                                 scale_factors=scale_factors, catalog_region=catalog_region)
+        mode = solve_diagnostics["mode"]
+
+    if(binning > 1):
+        #the coarse solve used positions from the binned image, measure the stars that were matched at full resolution
+        profiling.begin("refine")
+        detections, n_refined = refine_centroids(image, detections, catalog_sources, wcsprm, s.REFINE_RADIUS*binning)
+        observation = observation.assign(xcenter=detections.x, ycenter=detections.y)
+        detections_px = np.column_stack([detections.x, detections.y])
+        print("Measured {} matched sources on the full resolution image".format(n_refined))
+
+    #correct subpixel error
+    profiling.begin("fine")
+    obs_x, obs_y, cat_x, cat_y, distances = register.find_matches(detections, catalog_sources, wcsprm, threshold=3)
+    rms = np.sqrt(np.mean(np.square(distances)))
+    best_score = len(obs_x)/(rms+10) #start with current best score
+    fine_transformation = False
+    if(args.fine_transformation):
+        for i in [2,3,5,8,10,6,4, 20,2,1,0.5]:
+            wcsprm_new, score = register.fine_transformation(detections, catalog_sources, wcsprm, threshold=i)
+            if(score> best_score):
+                wcsprm = wcsprm_new
+                best_score = score
+                fine_transformation = True
+        if not fine_transformation:
+            print("Fine transformation did not improve result so will be discarded.")
+        else:
+            print("Fine transformation applied to improve result")
+    #register.calculate_rms(observation, catalog_data,wcs)
+    profiling.end()
+
+    #make wcsprim more physical by moving scaling to cdelt, out of the pc matrix
+    wcs =WCS(wcsprm.to_header())
+    if(args.verbose):
+        print(wcs)
+
+    from astropy.wcs import utils
+    scales = utils.proj_plane_pixel_scales(wcs)
+    print(scales)
+    cdelt = wcsprm.get_cdelt()
+    print(cdelt)
+    scale_ratio = scales/cdelt
+    #print(scale_ratio)
+    pc = np.array(wcsprm.get_pc())
+    pc[0,0] = pc[0,0]/scale_ratio[0]
+    pc[1,0] = pc[1,0]/scale_ratio[1]
+    pc[0,1] = pc[0,1]/scale_ratio[0]
+    pc[1,1] = pc[1,1]/scale_ratio[1]
+    wcsprm.pc = pc
+    wcsprm.cdelt = scales
+    if(args.verbose):
+        print("moved scaling info to CDelt")
+        print(WCS(wcsprm.to_header()))
+
+    #WCS difference before and after
+    print("> Compared to the input the Wcs was changed by: ")
+    scales_original = utils.proj_plane_pixel_scales(WCS(hdr))
+    print("WCS got scaled by {} in x direction and {} in y direction".format(scales[0]/scales_original[0], scales[1]/scales_original[1]))
+    #sources:
+    #https://math.stackexchange.com/questions/2113634/comparing-two-rotation-matrices
+    #https://stackoverflow.com/questions/2827393/angles-between-two-n-dimensional-vectors-in-python/13849249#13849249
+    def unit_vector(vector):
+        """ Returns the unit vector of the vector.  """
+        return vector / max(np.linalg.norm(vector), 1e-10)
+    def matrix_angle( B, A ):
+        """ comment cos between vectors or matrices """
+        Aflat = A.reshape(-1)
+        Aflat = unit_vector(Aflat)
+        Bflat = B.reshape(-1)
+        Bflat = unit_vector(Bflat)
+        #return np.arccos((np.dot( Aflat, Bflat ) / max( np.linalg.norm(Aflat) * np.linalg.norm(Bflat), 1e-10 )))
+        return np.arccos(np.clip(np.dot(Aflat, Bflat), -1.0, 1.0))
+    #print(matrix_angle(wcsprm.get_pc(), wcsprm_original.get_pc()) /2/np.pi*360)
+    rotation_angle = matrix_angle(wcsprm.get_pc(), wcsprm_original.get_pc()) /2/np.pi*360
+    if((wcsprm.get_pc() @ wcsprm_original.get_pc() )[0,1] > 0):
+        text = "counterclockwise"
+    else:
+        text = "clockwise"
+    print("Rotation of WCS by an angle of {} deg ".format(rotation_angle)+text)
+    old_central_pixel = wcsprm_original.s2p([wcsprm.crval], 0)["pixcrd"][0]
+    print("x offset: {} px, y offset: {} px ".format(wcsprm.crpix[0]- old_central_pixel[0], wcsprm.crpix[1]- old_central_pixel[1]))
+
+
+    #check final figure
+    profiling.begin("plot")
+    if(renderer is not None):
+        renderer.submit(diagnostics.draw_overview, filename=name_parts[0]+"_image_after.pdf" if args.save_images else None,
+                        window_title='Result for {}'.format(fits_image_filename), image=image_small, factor=plot_binning, shape=image.shape,
+                        detections=detections_px, catalog=wcsprm.s2p(catalog_data[["ra", "dec"]], 1)['pixcrd'],
+                        title="Result - red: catalog sources, blue: detected sources in img")
+
+    profiling.begin("rms")
+    print("--- Evaluate how good the transformation is ----")
+    register.calculate_rms(detections, catalog_sources, wcsprm)
+
+
+    #keep the detections and matched catalog sources so photometry does not have to detect again
+    obs_matched, cat_matched, matched_distances = register.find_matches_keep_catalog_info(observation, catalog_data, wcsprm, threshold=3)
+    extra_hdus = [detection_table.detections_to_hdu(observation, checksum, detection_table.detection_key(args.vignette, binning), 4.,
+                                                    box, args.vignette),
+                  detection_table.matched_catalog_to_hdu(obs_matched, cat_matched, checksum, box)]
+    #the downloaded catalog region with all columns photometry needs, so it does not have to query again
+    catalog_hdu = query.cached_region_to_hdu(coord, radius, args.catalog)
+    if(catalog_hdu is not None):
+        extra_hdus.append(catalog_hdu)
+
+    #jobs of the queue stop here if their frame went to another worker, see job_queue.py
+    if(getattr(args, "lease_check", None) is not None):
+        args.lease_check()
+
+    #updating file
+    profiling.begin("write")
+    write_wcs_to_hdr(fits_image_filename, wcsprm, extra_hdus, getattr(args, "compress", None), getattr(args, "output_mode", "copy"))
+    profiling.end()
+
+
+    print("overall time taken")
+    print(datetime.now()-StartTime)
+
+    #find_matches_keep_catalog_info gives squared distances
+    return {"wcs": WCS(wcsprm.to_header()).to_header_string(), "n_matches": len(matched_distances),
+            "rms_px": float(np.sqrt(np.mean(matched_distances))) if len(matched_distances) > 0 else None, "mode": mode}
+
+
+def run_job(fits_image_filename, args):
+    """Solve a frame taken from the job queue, see job_queue.py. Plots are only saved, not shown."""
+    s.PRECISION = args.precision
+    renderer = diagnostics.DiagnosticRenderer() if args.save_images else None
+    #frames of one field were submitted with the catalog region of their cluster, the first of them on a worker downloads it
+    batch_schedule.prefetch_region(getattr(args, "cluster_region", None), args.catalog)
+    try:
+        with profiling.frame_profiler(fits_image_filename, getattr(args, "profile", False)):
+            return solve_frame(fits_image_filename, args, datetime.now(), renderer)
+    finally:
+        if(renderer is not None):
+            renderer.close()
+
+
 def main():
     """Perform astrometry for the given file."""
     print("Program version: 1.0")
     StartTime = datetime.now()
     args = parseArguments()
+    s.PRECISION = args.precision
 
     if(args.show_images):
         plt.ioff()
@@ -343,252 +875,49 @@ def main():
                 fits_image_filenames.append(path+"/"+file)
         print(fits_image_filenames)
 
-    for fits_image_filename in fits_image_filenames:
-        print("")
-        print(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-        print("> Astrometry for {} ".format(fits_image_filename))
-
-        with fits.open(fits_image_filename) as hdul:
-            #print(hdul.info())
-            if(args.verbose):
-                print("if image is not at first position in the fits file the program will break later on")
-            #print(hdul[0].header)
-
-            hdu = hdul[0]
-            #hdu.verify('fix')
-            hdr = hdu.header
-
-
-            image_or = hdul[0].data.astype(float)
-            median = np.nanmedian(image_or)
-            image_or[np.isnan(image_or)]=median
-            image = image_or - median
-
-        observation = find_sources(image, args.vignette)
-        #print(observation)
-
-        positions = (observation['xcenter'], observation['ycenter'])
-        apertures = CircularAperture(positions, r=4.)
-
-
-        #world coordinates
-        print(">Info found in the file -- (CRVAl: position of central pixel (CRPIX) on the sky)")
-        print(WCS(hdr))
-
-        hdr["NAXIS1"] = image.shape[0]
-        hdr["NAXIS2"] = image.shape[1]
-
-        #wcsprm = Wcsprm(hdr.tostring().encode('utf-8')) #everything else gave me errors with python 3, seemed to make problems with pc conversios, so i wwitched to the form below
-        wcsprm = WCS(hdr).wcs
-        wcsprm_original = WCS(hdr).wcs
-        if(args.verbose):
-            print(WCS(wcsprm.to_header()))
-        wcsprm, fov_radius, INCREASE_FOV_FLAG, PIXSCALE_UNCLEAR = read_additional_info_from_header(wcsprm, hdr, args.ra, args.dec, args.projection_ra, args.projection_dec)
-        if(args.verbose):
-            print(WCS(wcsprm.to_header()))
-
-        #print(wcsprm)
-        #wcsprm.pc = [[2, 0],[0,1]]
-
-
-        #Possibly usefull examples of how to use wcsprm:
-        #print(wcsprm.set())
-        #print(wcsprm.get_pc())
-        #pc = wcsprm.get_pc()
-        #print(np.linalg.det(pc))
-        #print(wcsprm.get_cdelt())
-        #wcs.fix()
-        #print(wcsprm.print_contents())
-        #print(repr(hdr.update(wcsprm.to_header().encode('utf-8')))) #not working
-
-        #hdu.verify("fix")
-        #print(repr(hdr))
-        #wcs.wcs_pix2world(pixcrd, 1)
-        #wcs.wcs_world2pix(world, 1)
-        #wcs.wcs.crpix = [-234.75, 8.3393]
-        # wcs.wcs.cdelt = np.array([-0.066667, 0.066667])
-        # wcs.wcs.crval = [0, -90]
-        # wcs.wcs.ctype = ["RA---AIR", "DEC--AIR"]
-        # wcs.wcs.set_pv([(2, 1, 45.0)])
-        # For historical compatibility, three alternate specifications of the linear transformations
-        # are available in wcslib. The canonical PCi_ja with CDELTia, CDi_ja, and the deprecated CROTAia
-        # keywords. Although the latter may not formally co-exist with PCi_ja,
-        # the approach here is simply to ignore them if given in conjunction with PCi_ja.
-        # has_pc, has_cd and has_crota can be used to determine which of these alternatives are present in the header.
-        # These alternate specifications of the linear transformation matrix are translated immediately to PCi_ja by set
-        # and are nowhere visible to the lower-level routines. In particular, set resets cdelt to unity if CDi_ja is present
-        # (and no PCi_ja). If no CROTAia is associated with the latitude axis, set reverts to a unity PCi_ja matrix.
-
-
-
-
-
-        #get rough coordinates
-        #print(hdr["RA"])
-        #coord = SkyCoord(hdr["RA"], hdr["DEC"], unit=(u.hourangle, u.deg), frame="icrs")
-        coord = SkyCoord(wcsprm.crval[0], wcsprm.crval[1], unit=(u.deg, u.deg), frame="icrs")
-        if(not PIXSCALE_UNCLEAR):
-            if(wcsprm.crpix[0] < 0 or wcsprm.crpix[1] < 0 or wcsprm.crpix[0] > image.shape[0] or wcsprm.crpix[1] > image.shape[1] ):
-                print("central value outside of the image, moving it to the center")
-                coord_radec = wcsprm.p2s([[image.shape[0]/2, image.shape[1]/2]], 0)["world"][0]
-                coord = SkyCoord(coord_radec[0], coord_radec[1], unit=(u.deg, u.deg), frame="icrs")
-                #print(wcsprm)
-
-
-
-        #better: put in nice wrapper! with repeated tries and maybe try synchron!
-        print(">Dowloading catalog data")
-        radius = u.Quantity(fov_radius, u.arcmin)#will prob need more
-        catalog_data = query.get_data(coord, radius, args.catalog)
-        #reference = reference.query("mag <20")
-        max_sources = 500
-        if(INCREASE_FOV_FLAG):
-            max_sources= max_sources*2.25 #1.5 times the radius, so 2.25 the area
-        if(catalog_data.shape[0]>max_sources):
-            catalog_data = catalog_data.nsmallest(400, "mag")
-
-        if(args.catalog == "GAIA" and catalog_data.shape[0] < 5):
-            print("GAIA seems to not have enough objects, will enhance with PS1")
-            catalog_data2 = query.get_data(coord, radius, "PS")
-            catalog_data = pd.concat([catalog_data, catalog_data2])
-            #apertures_catalog = CircularAperture(wcs.wcs_world2pix(catalog_data[["ra", "dec"]], 1), r=5.)
-            print("Now we have a total of {} sources. Keep in mind that there might be duplicates now  since we combined 2 catalogs".format(catalog_data.shape[0]))
-        elif(args.catalog == "PS" and (catalog_data is None or catalog_data.shape[0] < 5)):
-            print("We seem to be outside the PS footprint, enhance with GAIA data")
-            catalog_data2 = query.get_data(coord, radius, "GAIA")
-            catalog_data = pd.concat([catalog_data, catalog_data2])
-            #apertures_catalog = CircularAperture(wcs.wcs_world2pix(catalog_data[["ra", "dec"]], 1), r=5.)
-            print("Now we have a total of {} sources. Keep in mind that there might be duplicates now since we combined 2 catalogs".format(catalog_data.shape[0]))
-
-        #remove duplicates in catalog?
-
-        apertures_catalog = CircularAperture(wcsprm.s2p(catalog_data[["ra", "dec"]], 1)['pixcrd'], r=5.)
-
-
-        #plotting what we have, I keep it in the detector field, world coordinates are more painfull to plot
-        fig = plt.figure()
-        fig.canvas.set_window_title('Input for {}'.format(fits_image_filename))
-        plt.xlabel("pixel x direction")
-        plt.ylabel("pixel y direction")
-        plt.title("Input - red: catalog sources, blue: detected sources in img")
-        plt.imshow(image,cmap='Greys', origin='lower', norm=LogNorm())
-        apertures.plot(color='blue', lw=1.5, alpha=0.5)
-        apertures_catalog.plot(color='red', lw=1.5, alpha=0.5)
-
-        plt.xlim(-200,image.shape[0]+200)
-        plt.ylim(-200,image.shape[1]+200)
-        if(args.save_images):
-            name_parts = fits_image_filename.rsplit('.', 1)
-            plt.savefig(name_parts[0]+"_image_before.pdf")
-
-        ###tranforming to match the sources
-        print("---------------------------------")
-        print(">Finding the transformation")
-        if(args.rotation_scaling):
-            print("Finding scaling and rotation")
-            wcsprm = register.get_scaling_and_rotation(observation, catalog_data, wcsprm, scale_guessed=PIXSCALE_UNCLEAR, verbose=args.verbose)
-        if(args.xy_transformation):
-            print("Finding offset")
-            wcsprm,_,_ = register.offset_with_orientation(observation, catalog_data, wcsprm, fast=False , INCREASE_FOV_FLAG=INCREASE_FOV_FLAG, verbose= args.verbose)
-
-        #correct subpixel error
-        obs_x, obs_y, cat_x, cat_y, distances = register.find_matches(observation, catalog_data, wcsprm, threshold=3)
-        rms = np.sqrt(np.mean(np.square(distances)))
-        best_score = len(obs_x)/(rms+10) #start with current best score
-        fine_transformation = False
-        if(args.fine_transformation):
-            for i in [2,3,5,8,10,6,4, 20,2,1,0.5]:
-                wcsprm_new, score = register.fine_transformation(observation, catalog_data, wcsprm, threshold=i)
-                if(score> best_score):
-                    wcsprm = wcsprm_new
-                    best_score = score
-                    fine_transformation = True
-            if not fine_transformation:
-                print("Fine transformation did not improve result so will be discarded.")
-            else:
-                print("Fine transformation applied to improve result")
-        #register.calculate_rms(observation, catalog_data,wcs)
-
-        #make wcsprim more physical by moving scaling to cdelt, out of the pc matrix
-        wcs =WCS(wcsprm.to_header())
-        if(args.verbose):
-            print(wcs)
-
-        from astropy.wcs import utils
-        scales = utils.proj_plane_pixel_scales(wcs)
-        print(scales)
-        cdelt = wcsprm.get_cdelt()
-        print(cdelt)
-        scale_ratio = scales/cdelt
-        #print(scale_ratio)
-        pc = np.array(wcsprm.get_pc())
-        pc[0,0] = pc[0,0]/scale_ratio[0]
-        pc[1,0] = pc[1,0]/scale_ratio[1]
-        pc[0,1] = pc[0,1]/scale_ratio[0]
-        pc[1,1] = pc[1,1]/scale_ratio[1]
-        wcsprm.pc = pc
-        wcsprm.cdelt = scales
-        if(args.verbose):
-            print("moved scaling info to CDelt")
-            print(WCS(wcsprm.to_header()))
-
-        #WCS difference before and after
-        print("> Compared to the input the Wcs was changed by: ")
-        scales_original = utils.proj_plane_pixel_scales(WCS(hdr))
-        print("WCS got scaled by {} in x direction and {} in y direction".format(scales[0]/scales_original[0], scales[1]/scales_original[1]))
-        #sources:
-        #https://math.stackexchange.com/questions/2113634/comparing-two-rotation-matrices
-        #https://stackoverflow.com/questions/2827393/angles-between-two-n-dimensional-vectors-in-python/13849249#13849249
-        def unit_vector(vector):
-            """ Returns the unit vector of the vector.  """
-            return vector / max(np.linalg.norm(vector), 1e-10)
-        def matrix_angle( B, A ):
-            """ comment cos between vectors or matrices """
-            Aflat = A.reshape(-1)
-            Aflat = unit_vector(Aflat)
-            Bflat = B.reshape(-1)
-            Bflat = unit_vector(Bflat)
-            #return np.arccos((np.dot( Aflat, Bflat ) / max( np.linalg.norm(Aflat) * np.linalg.norm(Bflat), 1e-10 )))
-            return np.arccos(np.clip(np.dot(Aflat, Bflat), -1.0, 1.0))
-        #print(matrix_angle(wcsprm.get_pc(), wcsprm_original.get_pc()) /2/np.pi*360)
-        rotation_angle = matrix_angle(wcsprm.get_pc(), wcsprm_original.get_pc()) /2/np.pi*360
-        if((wcsprm.get_pc() @ wcsprm_original.get_pc() )[0,1] > 0):
-            text = "counterclockwise"
-        else:
-            text = "clockwise"
-        print("Rotation of WCS by an angle of {} deg ".format(rotation_angle)+text)
-        old_central_pixel = wcsprm_original.s2p([wcsprm.crval], 0)["pixcrd"][0]
-        print("x offset: {} px, y offset: {} px ".format(wcsprm.crpix[0]- old_central_pixel[0], wcsprm.crpix[1]- old_central_pixel[1]))
-
-
-        #check final figure
-        fig = plt.figure()
-        fig.canvas.set_window_title('Result for {}'.format(fits_image_filename))
-        plt.xlabel("pixel x direction")
-        plt.ylabel("pixel y direction")
-        plt.title("Result - red: catalog sources, blue: detected sources in img")
-        plt.imshow(image,cmap='Greys', origin='lower', norm=LogNorm())
-        apertures.plot(color='blue', lw=1.5, alpha=0.5)
-        #apertures_catalog = CircularAperture(wcs.wcs_world2pix(catalog_data[["ra", "dec"]], 1), r=5.)
-        apertures_catalog = CircularAperture(wcsprm.s2p(catalog_data[["ra", "dec"]], 1)['pixcrd'], r=5.)
-
-        apertures_catalog.plot(color='red', lw=1.5, alpha=0.5)
-        if(args.save_images):
-            name_parts = fits_image_filename.rsplit('.', 1)
-            plt.savefig(name_parts[0]+"_image_after.pdf")
-
-        print("--- Evaluate how good the transformation is ----")
-        register.calculate_rms(observation, catalog_data,wcsprm)
-
-
-        #updating file
-        write_wcs_to_hdr(fits_image_filename, wcsprm)
+    manifest = None
+    if(args.manifest is not None):
+        manifest = solve_manifest.SolveManifest(args.manifest)
+        key = solve_manifest.settings_key(args)
+        settings_description = solve_manifest.solve_settings(args)
 
+    #frames of the same field are solved together and share one catalog download
+    if(args.schedule and len(fits_image_filenames) > 1):
+        clusters = batch_schedule.cluster_frames(fits_image_filenames, [catalog_cone(f, args) for f in fits_image_filenames])
+        print("{} frames in {} groups on the sky".format(len(fits_image_filenames), len(clusters)))
+    else:
+        clusters = [batch_schedule.FrameCluster([f]) for f in fits_image_filenames]
+
+    if(args.queue is not None):
+        queue = job_queue.JobQueue(args.queue)
+        n_new = 0
+        for cluster in clusters:
+            n_new = n_new + queue.submit("astrometry", cluster.filenames, args, cluster.region())
+        queue.close()
+        print("Added {} frames to the queue {}".format(n_new, args.queue))
+        job_queue.work(args.queue)
+        print("-- finished --")
+        return
+
+    renderer = None
+    if(args.save_images or args.show_images):
+        renderer = diagnostics.DiagnosticRenderer(show=args.show_images)
+
+    for cluster in clusters:
+        for fits_image_filename in cluster.filenames:
+            def solve():
+                cluster.prefetch(args.catalog)
+                with profiling.frame_profiler(fits_image_filename, args.profile):
+                    return solve_frame(fits_image_filename, args, StartTime, renderer)
+            if(manifest is None):
+                solve()
+            else:
+                manifest.run(fits_image_filename, key, solve, output_filename=output_filename(fits_image_filename, args.output_mode), settings=settings_description)
 
-        print("overall time taken")
-        print(datetime.now()-StartTime)
+    if(renderer is not None):
+        renderer.close()
         if(args.show_images):
-            plt.show()
+            renderer.show()
     print("-- finished --")
 
 
@@ -0,0 +1,117 @@
+"""Order the frames of a batch by their position on the sky.
+
+Frames of the same field are grouped into clusters. Each cluster downloads the
+catalog once for a region covering all its frames, so the frames are served
+from the catalog cache instead of querying one by one.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+
+import get_catalog_data as query
+import settings as s
+
+
+class FrameCluster:
+    """Frames that share one catalog region.
+
+    Parameters
+    ----------
+    filenames : list
+        fits files in the cluster
+    center : SkyCoord or None
+        center of the catalog region, None if the position of the frames is unknown
+    radius : Quantity or None
+        radius of the catalog region covering the catalog cones of all frames
+
+    """
+
+    def __init__(self, filenames, center=None, radius=None):
+        self.filenames = filenames
+        self.center = center
+        self.radius = radius
+        self.prefetched = False
+
+    def region(self):
+        """Catalog region [ra, dec, radius] in deg of the cluster, None if nothing is prefetched (single frame or unknown position)."""
+        if(len(self.filenames) < 2 or self.center is None):
+            return None
+        return [self.center.icrs.ra.deg, self.center.icrs.dec.deg, u.Quantity(self.radius, u.deg).value]
+
+    def prefetch(self, source):
+        """Download the catalog region of the cluster (only once and only for clusters with several frames)."""
+        if(self.prefetched):
+            return
+        self.prefetched = True
+        prefetch_region(self.region(), source)
+
+
+#regions prefetched by this process, a queue worker gets the region with every frame of the cluster
+_prefetched = set()
+
+
+def prefetch_region(region, source):
+    """Download a catalog region [ra, dec, radius] (deg), see FrameCluster.region. Each region is only prefetched once per process.
+
+    Failures are only reported, the frames then query the catalog separately.
+    """
+    if(region is None or (tuple(region), source) in _prefetched):
+        return
+    _prefetched.add((tuple(region), source))
+    try:
+        query.prefetch_region(SkyCoord(region[0], region[1], unit="deg"), region[2]*u.deg, source)
+    except Exception as e:
+        print("Could not download the region of the cluster ({!r}), the frames will query the catalog separately".format(e))
+
+
+def cluster_frames(filenames, cones, max_radius=None):
+    """Group frames so the catalog cones of each group fit into one region.
+
+    Greedy: the southernmost frame that is not assigned yet starts a cluster, all frames whose cone fits
+    into a region of max_radius around it are added.
+
+    Parameters
+    ----------
+    filenames : list
+        fits files
+    cones : list
+        (SkyCoord, radius Quantity) of the catalog query of each frame, None if unknown
+    max_radius : Quantity
+        largest catalog region, default SCHEDULE_MAX_RADIUS (arcmin) from settings
+
+    Returns
+    -------
+    clusters : list
+        FrameCluster, ordered by position on the sky. Frames with unknown position get their own cluster at the end.
+
+    """
+    if(max_radius is None):
+        max_radius = s.SCHEDULE_MAX_RADIUS*u.arcmin
+    max_radius = u.Quantity(max_radius, u.deg).value
+
+    known = [i for i, cone in enumerate(cones) if cone is not None]
+    unknown = [i for i, cone in enumerate(cones) if cone is None]
+    clusters = []
+    if(len(known) > 0):
+        positions = SkyCoord([cones[i][0] for i in known])
+        radii = np.array([u.Quantity(cones[i][1], u.deg).value for i in known])
+        remaining = np.argsort(positions.dec.deg + 1e-6*positions.ra.deg) #south to north
+        while(len(remaining) > 0):
+            seed = remaining[0]
+            distance = positions[seed].separation(positions[remaining]).deg
+            members = remaining[(distance + radii[remaining] <= max_radius) | (remaining == seed)]
+            radius = np.max(positions[seed].separation(positions[members]).deg + radii[members])
+            clusters.append(FrameCluster(sorted(filenames[known[i]] for i in members), positions[seed], radius*u.deg))
+            remaining = remaining[~np.isin(remaining, members)]
+
+    for i in unknown:
+        clusters.append(FrameCluster([filenames[i]]))
+    return clusters
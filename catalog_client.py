@@ -0,0 +1,223 @@
+"""Client layer for the catalog services (Vizier and the Gaia archive).
+
+Every catalog download goes through this module:
+- identical requests that are already running in another thread are not sent
+  again, the thread waits for the running one and gets its result (single
+  flight). With CATALOG_CACHE_DIR set, processes (e.g. the job queue workers)
+  wait for each other with a lock file, the later ones then find the region in
+  the cache directory.
+- at most CATALOG_MAX_CONCURRENT requests per service run at the same time in
+  a process.
+- failed requests are tried again with exponential backoff, up to
+  CATALOG_MAX_ATTEMPTS times and not after CATALOG_DEADLINE. Only transient
+  errors are retried (connection problems, timeouts, server errors, 429).
+- HTTP requests share one session per service, so connections are kept open
+  and reused.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import contextlib
+import hashlib
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import fcntl
+except ImportError: #no lock files on windows, processes then download on their own
+    fcntl = None
+
+import settings as s
+
+
+_lock = threading.Lock()
+#per service: pooled sessions and the semaphores bounding the concurrent requests
+_sessions = {}
+_limits = {}
+#requests running right now: {key: _Flight}
+_flights = {}
+
+
+def _reset():
+    """Forget sessions, semaphores and running requests, a forked process must not share them with its parent."""
+    global _lock
+    _lock = threading.Lock()
+    _sessions.clear()
+    _limits.clear()
+    _flights.clear()
+
+
+if(hasattr(os, "register_at_fork")):
+    os.register_at_fork(after_in_child=_reset)
+
+
+def session(service):
+    """HTTP session of the service, its connection pool holds CATALOG_MAX_CONCURRENT connections."""
+    with _lock:
+        if(service not in _sessions):
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=s.CATALOG_MAX_CONCURRENT, max_retries=0)
+            new_session = requests.Session()
+            new_session.mount("http://", adapter)
+            new_session.mount("https://", adapter)
+            _sessions[service] = new_session
+        return _sessions[service]
+
+
+def _limit(service):
+    with _lock:
+        if(service not in _limits):
+            _limits[service] = threading.BoundedSemaphore(s.CATALOG_MAX_CONCURRENT)
+        return _limits[service]
+
+
+def is_transient(error):
+    """True for errors where trying again can help: connection problems, timeouts, server errors (5xx) and 429.
+
+    HTTPErrors without a response (astroquery's TAP client raises these) are treated as transient. Other OSErrors
+    (e.g. a full disk or missing permissions) and invalid requests are not retried.
+    """
+    if(isinstance(error, requests.HTTPError)):
+        response = error.response
+        if(response is None):
+            return True
+        return response.status_code >= 500 or response.status_code in [408, 429]
+    #ChunkedEncodingError: the connection broke while the response was read
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                              ConnectionError, TimeoutError))
+
+
+def backoff(attempt):
+    """Seconds to wait before retry number attempt (1, 2, ...), doubled each time, with jitter so workers do not retry in step."""
+    delay = min(s.CATALOG_BACKOFF * 2**(attempt-1), s.CATALOG_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.)
+
+
+def call(service, request, deadline=None):
+    """Run request(timeout) with retries, at most CATALOG_MAX_CONCURRENT at a time for the service.
+
+    Parameters
+    ----------
+    service : str
+        name of the service, e.g. 'vizier' or 'gaia'
+    request : function
+        does one attempt, gets the timeout (seconds) of this attempt
+    deadline : float
+        seconds after which no further attempt is started, default CATALOG_DEADLINE from settings
+
+    Returns
+    -------
+    result
+        return value of request. The error of the last attempt is raised if all attempts failed
+
+    """
+    if(deadline is None):
+        deadline = s.CATALOG_DEADLINE
+    end = time.monotonic() + deadline
+    limit = _limit(service)
+    attempt = 1
+    while(True):
+        remaining = end - time.monotonic()
+        try:
+            if(not limit.acquire(timeout=max(remaining, 0.))):
+                raise TimeoutError("no free connection to {} before the deadline".format(service))
+            try:
+                return request(max(min(s.CATALOG_TIMEOUT, remaining), 1.))
+            finally:
+                limit.release()
+        except Exception as e:
+            delay = backoff(attempt)
+            if(not is_transient(e) or attempt >= s.CATALOG_MAX_ATTEMPTS or time.monotonic()+delay >= end):
+                print("{} request failed after {} attempts: {}".format(service, attempt, e))
+                raise
+            print("{} request failed ({}), trying again in {:.1f} s".format(service, e, delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+def post(service, url, data, deadline=None):
+    """POST with the pooled session of the service and retries (see call).
+
+    Returns
+    -------
+    response : requests.Response
+        successful response, HTTP errors are raised
+
+    """
+    def request(timeout):
+        response = session(service).post(url, data=data, timeout=timeout)
+        response.raise_for_status()
+        return response
+    return call(service, request, deadline)
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+@contextlib.contextmanager
+def _lock_file(key):
+    """Lock shared by the processes using the same CATALOG_CACHE_DIR, does nothing without a cache directory."""
+    if(s.CATALOG_CACHE_DIR is None or fcntl is None):
+        yield
+        return
+    directory = os.path.join(s.CATALOG_CACHE_DIR, ".locks")
+    os.makedirs(directory, exist_ok=True)
+    name = hashlib.sha1(repr(key).encode()).hexdigest()
+    with open(os.path.join(directory, name+".lock"), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def single_flight(key, download):
+    """Run download() once for all threads asking for the same key at the same time.
+
+    The first thread runs download, the others wait and get its result (or its error). Processes sharing the
+    CATALOG_CACHE_DIR run one after the other, download should look into the cache directory first.
+
+    Parameters
+    ----------
+    key : tuple
+        identifies the request, e.g. (catalog, ra, dec, radius, rows)
+    download : function
+        without arguments
+
+    """
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if(leader):
+            flight = _flights[key] = _Flight()
+    if(not leader):
+        flight.done.wait()
+        if(flight.error is not None):
+            raise flight.error
+        return flight.result
+    try:
+        with _lock_file(key):
+            flight.result = download()
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            del _flights[key]
+        flight.done.set()
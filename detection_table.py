@@ -0,0 +1,174 @@
+"""Store the source detections of a frame next to the image so they can be reused.
+
+astrometry.py saves the detection table (and the catalog sources it matched) as
+BINTABLE extensions in the _astro.fits output. photometry.py reads them back if
+the pixel data and the detection settings are unchanged, so the detection only
+has to run once per frame, and calibrates the zero point with the detections
+astrometry matched to its catalog. With a vignette astrometry only reads part of the
+image, the checksum then covers only that box, which is stored next to it
+(IMGBOX) so photometry can check the same pixels.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import hashlib
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+import settings as s
+
+
+DETECTION_EXTNAME = "DETECTIONS"
+MATCHED_CATALOG_EXTNAME = "MATCHEDCAT"
+
+
+def image_checksum(data, box=None):
+    """Checksum of the pixel data as read from the file.
+
+    Parameters
+    ----------
+    data : array
+        Pixel data of the image HDU
+    box : tuple, optional
+        (y0, y1, x0, x1), only the pixels in this box are hashed
+
+    Returns
+    -------
+    checksum : str
+        sha1 hex digest of the pixel values
+
+    """
+    if(box is not None):
+        y0, y1, x0, x1 = box
+        data = data[y0:y1, x0:x1]
+    data = np.ascontiguousarray(data)
+    checksum = hashlib.sha1()
+    checksum.update(str(data.dtype.str).encode("utf-8"))
+    checksum.update(str(data.shape).encode("utf-8"))
+    checksum.update(memoryview(data).cast("B"))
+    return checksum.hexdigest()
+
+
+def detection_key(vignette=3, binning=1):
+    """Short key describing the detection settings. Detections are only reused if the key agrees."""
+    parameters = "fwhm={};sigma={};absolute={};brightest={};vignette={}".format(
+        s.FWHM, s.DETECTION_SIGMA_THRESHOLD, s.DETECTION_ABSOLUTE_THRESHOLD, s.N_BRIGHTEST_SOURCES, vignette)
+    if(binning > 1):
+        #only the matched sources have full resolution positions
+        parameters += ";binning={}".format(binning)
+    return hashlib.sha1(parameters.encode("utf-8")).hexdigest()[:16]
+
+
+def _set_checksum(header, checksum, box):
+    header["IMGSUM"] = (checksum, "sha1 of pixel data")
+    if(box is not None):
+        header["IMGBOX"] = (",".join(str(int(v)) for v in box), "y0,y1,x0,x1 of the pixels in IMGSUM")
+
+
+def stored_box(header):
+    """Pixel box (y0, y1, x0, x1) the stored checksum covers, None for the whole image."""
+    if("IMGBOX" not in header):
+        return None
+    return tuple(int(v) for v in header["IMGBOX"].split(","))
+
+
+def detections_to_hdu(observation, checksum, key, aperture_radius, box=None, vignette=3):
+    """Convert the detection table into a BINTABLE extension.
+
+    Parameters
+    ----------
+    observation : dataframe
+        Detected sources with xcenter, ycenter and aperture_sum
+    checksum : str
+        Checksum of the image the sources were detected in, see image_checksum
+    key : str
+        Detection settings, see detection_key
+    aperture_radius : float
+        Radius in pixel used for aperture_sum
+    box : tuple, optional
+        Pixel box the checksum covers, None for the whole image
+    vignette : float
+        Vignette used for the detection, lets read_detections rebuild the key
+
+    Returns
+    -------
+    hdu : BinTableHDU
+
+    """
+    hdu = fits.table_to_hdu(Table.from_pandas(observation.reset_index(drop=True)))
+    hdu.header["EXTNAME"] = DETECTION_EXTNAME
+    _set_checksum(hdu.header, checksum, box)
+    hdu.header["DETKEY"] = (key, "hash of the detection settings")
+    hdu.header["DETVIG"] = (vignette, "vignette of the detection")
+    hdu.header["APRAD"] = (float(aperture_radius), "aperture radius of aperture_sum in pixel")
+    return hdu
+
+
+def matched_catalog_to_hdu(obs_matched, cat_matched, checksum, box=None):
+    """Convert the catalog sources matched to detections into a BINTABLE extension.
+
+    The column detection_id refers to the id column of the detection table.
+    """
+    cat_matched = cat_matched.reset_index(drop=True).copy()
+    cat_matched["detection_id"] = obs_matched["id"].values
+    hdu = fits.table_to_hdu(Table.from_pandas(cat_matched))
+    hdu.header["EXTNAME"] = MATCHED_CATALOG_EXTNAME
+    _set_checksum(hdu.header, checksum, box)
+    return hdu
+
+
+def update_checksums(hdul, data):
+    """Recompute IMGSUM of the stored tables from data, e.g. after lossy compression changed the pixels."""
+    for extname in [DETECTION_EXTNAME, MATCHED_CATALOG_EXTNAME]:
+        if(extname in hdul):
+            header = hdul[extname].header
+            header["IMGSUM"] = image_checksum(data, stored_box(header))
+
+
+def read_detections(hdul, data, key=None):
+    """Read a stored detection table if it is still valid for this image and these settings.
+
+    Parameters
+    ----------
+    hdul : HDUList
+        Opened fits file
+    data : array
+        Current pixel data, hashed over the box stored with the detections
+    key : str, optional
+        Current detection settings, None to accept the detections for the vignette they were made with
+
+    Returns
+    -------
+    observation : dataframe or None
+        Stored detections, None if there are none or they are outdated
+    aperture_radius : float or None
+        Radius in pixel used for the stored aperture_sum
+
+    """
+    if(DETECTION_EXTNAME not in hdul):
+        return None, None
+    hdu = hdul[DETECTION_EXTNAME]
+    if(key is None):
+        key = detection_key(hdu.header.get("DETVIG", 3))
+    if(hdu.header.get("DETKEY") != key or hdu.header.get("IMGSUM") != image_checksum(data, stored_box(hdu.header))):
+        print("Stored detections do not match the image or the detection settings, will detect again")
+        return None, None
+    observation = Table(hdu.data).to_pandas()
+    return observation, hdu.header.get("APRAD")
+
+
+def read_matched_catalog(hdul, data):
+    """Read the stored catalog sources matched by astrometry. Returns None if missing or outdated."""
+    if(MATCHED_CATALOG_EXTNAME not in hdul):
+        return None
+    hdu = hdul[MATCHED_CATALOG_EXTNAME]
+    if(hdu.header.get("IMGSUM") != image_checksum(data, stored_box(hdu.header))):
+        return None
+    return Table(hdu.data).to_pandas()
@@ -0,0 +1,189 @@
+"""Diagnostic plots that are rendered next to the solving.
+
+Figures are drawn in a background thread with the object oriented matplotlib
+interface (pyplot is not thread safe) and saved there. Figures that should pop
+up are kept as rendered images and shown by the main thread at the end of the
+run. Overview plots use a block averaged quick-look version of the image,
+target views only a cutout, so the full resolution image is never rendered.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import queue
+import threading
+import traceback
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import LogNorm
+from matplotlib.collections import EllipseCollection
+
+import settings as s
+
+
+def block_average(image, factor):
+    """Average factor x factor blocks of the image. Rows and columns that do not fill a block are dropped."""
+    if(factor <= 1):
+        return image
+    ny = image.shape[0]//factor
+    nx = image.shape[1]//factor
+    return image[:ny*factor, :nx*factor].reshape(ny, factor, nx, factor).mean(axis=(1, 3))
+
+
+def image_pyramid(image, max_size=None):
+    """Halve the image with 2x2 block averages until it is at most max_size pixels on each side.
+
+    Parameters
+    ----------
+    image : 2d array
+    max_size : int
+        largest side of the last level, default PLOT_MAX_SIZE from settings
+
+    Returns
+    -------
+    levels : list
+        the image and all halved versions, level i is binned by 2**i
+
+    """
+    if(max_size is None):
+        max_size = s.PLOT_MAX_SIZE
+    levels = [image]
+    while(max(levels[-1].shape) > max_size and min(levels[-1].shape) >= 2):
+        levels.append(block_average(levels[-1], 2))
+    return levels
+
+
+def quicklook(image, max_size=None):
+    """Smallest level of the image pyramid and its binning factor.
+
+    The result is a float32 copy, so the image can change after the plot was submitted.
+    """
+    levels = image_pyramid(image, max_size)
+    factor = 2**(len(levels)-1)
+    return np.array(levels[-1], dtype=np.float32), factor
+
+
+def cutout(image, x, y, half_size=None):
+    """Cutout around the pixel position (x, y) and the pixel coordinates of its lower left corner."""
+    if(half_size is None):
+        half_size = s.PLOT_CUTOUT_HALF_SIZE
+    x0 = max(int(x)-half_size, 0)
+    y0 = max(int(y)-half_size, 0)
+    return np.array(image[y0:int(y)+half_size+1, x0:int(x)+half_size+1], dtype=np.float32), (x0, y0)
+
+
+def add_circles(ax, positions, radius, color, **kwargs):
+    """Circles of the given radius (in data units) at the positions (n, 2), drawn as one collection instead of one patch each."""
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    circles = EllipseCollection(2*radius, 2*radius, 0, units='xy', offsets=positions, offset_transform=ax.transData,
+                                facecolors='none', edgecolors=color, linewidths=1.5, alpha=0.5, **kwargs)
+    ax.add_collection(circles)
+    return circles
+
+
+def draw_overview(fig, image, factor, shape, detections, catalog, title):
+    """Quick-look image with detected (blue) and catalog (red) sources, axes in full resolution pixels.
+
+    Parameters
+    ----------
+    fig : Figure
+    image : 2d array
+        quick-look image, see quicklook
+    factor : int
+        binning of the quick-look image
+    shape : tuple
+        shape of the full resolution image
+    detections, catalog : array
+        pixel positions (n, 2) of the detected sources and the catalog sources
+    title : str
+
+    """
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_xlabel("pixel x direction")
+    ax.set_ylabel("pixel y direction")
+    ax.set_title(title)
+    ax.imshow(image, cmap='Greys', origin='lower', norm=LogNorm(),
+              extent=(-0.5, image.shape[1]*factor-0.5, -0.5, image.shape[0]*factor-0.5))
+    add_circles(ax, detections, 4., color='blue')
+    add_circles(ax, catalog, 5., color='red')
+    ax.set_xlim(-200, shape[0]+200)
+    ax.set_ylim(-200, shape[1]+200)
+
+
+class DiagnosticRenderer:
+    """Renders figures in a background thread, fed by a bounded queue.
+
+    Parameters
+    ----------
+    show : bool
+        keep the rendered figures to show them with show() at the end
+    max_queued : int
+        figures waiting to be rendered, submit blocks if the queue is full. Default PLOT_QUEUE_SIZE from settings
+
+    """
+
+    def __init__(self, show=False, max_queued=None):
+        if(max_queued is None):
+            max_queued = s.PLOT_QUEUE_SIZE
+        self.show_figures = show
+        self.rendered = []
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, draw, filename=None, window_title=None, figsize=None, **data):
+        """Queue a figure. draw(fig, **data) draws on a new Figure, which is saved to filename if given.
+
+        Only pass arrays that are not changed afterwards (e.g. from quicklook or cutout).
+        """
+        if(filename is None and not self.show_figures):
+            return
+        self._queue.put((draw, filename, window_title, figsize, data))
+
+    def _run(self):
+        while(True):
+            item = self._queue.get()
+            if(item is None):
+                self._queue.task_done()
+                return
+            draw, filename, title, figsize, data = item
+            try:
+                fig = Figure(figsize=figsize)
+                canvas = FigureCanvasAgg(fig)
+                draw(fig, **data)
+                if(filename is not None):
+                    fig.savefig(filename)
+                if(self.show_figures):
+                    canvas.draw()
+                    self.rendered.append((title, fig.get_size_inches(), np.asarray(canvas.buffer_rgba()).copy()))
+            except Exception:
+                traceback.print_exc()
+                print("Could not render the figure {}".format(title if title is not None else filename))
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """Wait until all queued figures are rendered."""
+        if(self._thread.is_alive()):
+            self._queue.put(None)
+            self._thread.join()
+
+    def show(self):
+        """Show the rendered figures, call from the main thread."""
+        self.close()
+        for title, size, rgba in self.rendered:
+            fig = plt.figure(figsize=size)
+            if(title is not None):
+                fig.canvas.manager.set_window_title(title)
+            ax = fig.add_axes([0, 0, 1, 1])
+            ax.imshow(rgba)
+            ax.axis("off")
+        self.rendered = []
+        plt.show()
@@ -15,16 +15,405 @@ written in python 3
 #from astropy.coordinates import SkyCoord
 from astroquery.gaia import Gaia
 from astroquery.vizier import Vizier
+from astroquery.vizier import conf as vizier_conf
+from astroquery.utils.tap.core import TapPlus
 
 from astropy.coordinates import SkyCoord
 from astropy import units as u
-#import pandas as pd
+from astropy.io import fits
+from astropy.io import votable
+from astropy.table import Table
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+import io
+import os
+
+import catalog_client
+import image_io
+import settings as s
+
+
+
+
+
+
+#columns kept from each survey, union of what astrometry and photometry need
+SUPERSET_COLUMNS = {"PS": ["ra", "ra_error", "dec", "dec_error", "gmag", "e_gmag", "rmag", "e_rmag", "imag", "e_imag", "zmag", "e_zmag", "ymag", "e_ymag"],
+                    "2MASS": ["ra", "dec", "Jmag", "e_Jmag", "Hmag", "e_Hmag", "Kmag", "e_Kmag"],
+                    "GAIA": ["ra", "ra_error", "dec", "dec_error", "phot_g_mean_mag", "phot_bp_mean_mag", "phot_rp_mean_mag"]}
+#magnitudes used to get the brightest magnitude for astrometry
+ASTROMETRY_MAGNITUDES = {"PS": ["gmag", "rmag", "imag", "zmag", "ymag"],
+                         "2MASS": ["Jmag", "Kmag", "Hmag"],
+                         "GAIA": ["phot_g_mean_mag"]}
+#columns requested from Vizier, they are renamed to SUPERSET_COLUMNS
+VIZIER_COLUMNS = {"PS": ["RAJ2000", "e_RAJ2000", "DEJ2000", "e_DEJ2000", "gmag", "e_gmag", "rmag", "e_rmag", "imag", "e_imag", "zmag", "e_zmag", "ymag", "e_ymag"],
+                  "2MASS": ["RAJ2000", "DEJ2000", "Jmag", "e_Jmag", "Hmag", "e_Hmag", "Kmag", "e_Kmag"]}
+#magnitude used on the server for the magnitude limit (CATALOG_MAG_LIMIT) and to only get the CATALOG_MAX_ROWS brightest sources
+SORT_MAGNITUDE = {"PS": "rmag", "2MASS": "Jmag", "GAIA": "phot_g_mean_mag"}
+CATALOG_EXTNAME = "CATALOG"
+#unit of ra_error and dec_error of each survey as downloaded (converted to mas for astrometry) and the typical position error (mas) for sources without errors
+POSITION_ERROR_UNIT = {"PS": u.arcsec, "GAIA": u.mas}
+TYPICAL_POSITION_ERROR = {"GAIA": 1., "PS": 20., "2MASS": 80.}
+
+#regions already downloaded in this run: {source: [(ra, dec, radius in deg, dataframe), ...]}
+_catalog_cache = {}
+#TAP service for CATALOG_GAIA_URL, created on first use
+_gaia_service = None
+
+
+def catalog_name(source):
+    """Translate the different ways to name a catalog into PS, 2MASS or GAIA."""
+    if(source in ["PS", "PANSTARRS", "Panstarrs", "PS1", "PS_photometry"]):
+        return "PS"
+    if(source in ["GAIA", "GAIADR1"]):
+        return "GAIA"
+    if(source in ["2MASS", "TWOMASS", "2mass", "twomass"]):
+        return "2MASS"
+    return source
+
+
+def _angular_distance(ra1, dec1, ra2, dec2):
+    """Angular distance in degrees (haversine formula), inputs in degrees."""
+    ra1, dec1, ra2, dec2 = np.radians(ra1), np.radians(dec1), np.radians(ra2), np.radians(dec2)
+    a = np.sin((dec2-dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2-ra1)/2)**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+def _cut_to_cone(catalog_data, ra, dec, radius):
+    """Only keep the sources within radius (deg) of ra, dec."""
+    distance = _angular_distance(ra, dec, catalog_data["ra"].values, catalog_data["dec"].values)
+    return catalog_data[distance <= radius].reset_index(drop=True)
+
+
+def _cached_region(source, ra, dec, radius):
+    """Downloaded region that contains the cone, it becomes the most recently used one. None if there is none."""
+    regions = _catalog_cache.get(source, [])
+    for i, entry in enumerate(regions):
+        cached_ra, cached_dec, cached_radius, _ = entry
+        if(_angular_distance(ra, dec, cached_ra, cached_dec) + radius <= cached_radius*(1+1e-9)):
+            regions.append(regions.pop(i))
+            return entry
+    return None
+
+
+def _from_cache(source, ra, dec, radius):
+    """Look for a downloaded region that contains the requested cone."""
+    entry = _cached_region(source, ra, dec, radius)
+    if(entry is None):
+        return None
+    return _cut_to_cone(entry[3], ra, dec, radius)
+
+
+def _add_to_cache(source, ra, dec, radius, catalog_data, write_to_disk=True):
+    """Keep a region for the rest of the run (and in CATALOG_CACHE_DIR).
+
+    Regions that are already covered by a kept one are not added again. Only the CATALOG_CACHE_MAX_REGIONS most
+    recently used regions per catalog are kept in memory.
+    """
+    if(_cached_region(source, ra, dec, radius) is not None):
+        return
+    regions = _catalog_cache.setdefault(source, [])
+    regions.append((ra, dec, radius, catalog_data))
+    del regions[:-s.CATALOG_CACHE_MAX_REGIONS]
+    if(write_to_disk and s.CATALOG_CACHE_DIR is not None):
+        os.makedirs(s.CATALOG_CACHE_DIR, exist_ok=True)
+        filename = os.path.join(s.CATALOG_CACHE_DIR, "{}_{:.5f}_{:+.5f}_{:.5f}.fits".format(source, ra, dec, radius))
+        hdu = catalog_to_hdu(catalog_data, source, ra, dec, radius)
+        #other processes sharing the cache directory may read the region while it is written
+        image_io.write_atomic(filename, lambda temporary: hdu.writeto(temporary, overwrite=True))
+
+
+def _load_disk_cache(source, ra, dec, radius):
+    """Add the region of the catalog cache directory that contains the cone (deg) to the cache of this run.
+
+    The center and radius of each region are part of its file name, only the file that is needed is opened.
+    Unreadable files (e.g. left by a crash) are skipped, the region is then downloaded again.
+    """
+    if(s.CATALOG_CACHE_DIR is None or not os.path.isdir(s.CATALOG_CACHE_DIR)):
+        return
+    for filename in sorted(os.listdir(s.CATALOG_CACHE_DIR)):
+        if(not filename.startswith(source+"_") or not filename.endswith(".fits")):
+            continue
+        try:
+            cached_ra, cached_dec, cached_radius = [float(part) for part in filename[len(source)+1:-len(".fits")].split("_")]
+        except ValueError:
+            continue
+        #the file name is rounded to 1e-5 deg, _from_cache does the exact check with the header values
+        if(_angular_distance(ra, dec, cached_ra, cached_dec) + radius <= cached_radius + 1e-4):
+            try:
+                with fits.open(os.path.join(s.CATALOG_CACHE_DIR, filename)) as hdul:
+                    load_catalog_hdu(hdul)
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                print("Could not read the cached catalog region {} ({}), skipping it".format(filename, e))
+                continue
+            if(_cached_region(source, ra, dec, radius) is not None):
+                return
+
+
+def catalog_to_hdu(catalog_data, source, ra, dec, radius):
+    """Store a downloaded region as a BINTABLE extension.
+
+    Parameters
+    ----------
+    catalog_data : dataframe
+        superset catalog data, see get_superset_data
+    source : str
+        PS, 2MASS or GAIA
+    ra, dec, radius : float
+        center and radius of the region in degrees
+
+    Returns
+    -------
+    hdu : BinTableHDU
+
+    """
+    hdu = fits.table_to_hdu(Table.from_pandas(catalog_data))
+    hdu.header["EXTNAME"] = CATALOG_EXTNAME
+    hdu.header["CATNAME"] = (source, "catalog of the sources")
+    hdu.header["CATRA"] = (ra, "center of the region [deg]")
+    hdu.header["CATDEC"] = (dec, "center of the region [deg]")
+    hdu.header["CATRAD"] = (radius, "radius of the region [deg]")
+    return hdu
+
+
+def cached_region_to_hdu(coord, radius, source):
+    """BINTABLE extension with the downloaded region that contains the given cone, None if it was not downloaded."""
+    source = catalog_name(source)
+    ra = coord.icrs.ra.deg
+    dec = coord.icrs.dec.deg
+    radius_deg = u.Quantity(radius, u.deg).value
+    entry = _cached_region(source, ra, dec, radius_deg)
+    if(entry is None):
+        return None
+    cached_ra, cached_dec, cached_radius, catalog_data = entry
+    return catalog_to_hdu(catalog_data, source, cached_ra, cached_dec, cached_radius)
+
+
+def load_catalog_hdu(hdul):
+    """Make the catalog region stored in a fits file (e.g. the _astro.fits output) available to later queries.
+
+    Returns
+    -------
+    source : str or None
+        catalog of the stored region, None if the file contains none
+
+    """
+    if(CATALOG_EXTNAME not in hdul):
+        return None
+    hdu = hdul[CATALOG_EXTNAME]
+    hdr = hdu.header
+    catalog_data = Table(hdu.data).to_pandas()
+    _add_to_cache(hdr["CATNAME"], hdr["CATRA"], hdr["CATDEC"], hdr["CATRAD"], catalog_data, write_to_disk=False)
+    return hdr["CATNAME"]
+
+
+def _gaia():
+    """Gaia archive of astroquery or the TAP service at CATALOG_GAIA_URL."""
+    global _gaia_service
+    if(s.CATALOG_GAIA_URL is None):
+        return Gaia
+    if(_gaia_service is None):
+        _gaia_service = TapPlus(url=s.CATALOG_GAIA_URL)
+    return _gaia_service
+
+
+def _query_GAIA(coord, radius, max_rows=None):
+    """Brightest sources in the cone, only the SUPERSET_COLUMNS. Selection and ordering are done on the server."""
+    if(max_rows is None):
+        max_rows = s.CATALOG_MAX_ROWS
+    table = getattr(Gaia, "MAIN_GAIA_TABLE", None) or "gaiadr2.gaia_source"
+    adql = ("SELECT TOP {} {} FROM {} "
+            "WHERE 1=CONTAINS(POINT('ICRS', ra, dec), CIRCLE('ICRS', {}, {}, {})) "
+            "AND {} < {} "
+            "ORDER BY {} ASC").format(max_rows, ", ".join(SUPERSET_COLUMNS["GAIA"]), table,
+                                      coord.icrs.ra.deg, coord.icrs.dec.deg, u.Quantity(radius, u.deg).value,
+                                      SORT_MAGNITUDE["GAIA"], s.CATALOG_MAG_LIMIT, SORT_MAGNITUDE["GAIA"])
+    #the TAP client of astroquery has no timeout per request, only the retries and the deadline apply
+    r = catalog_client.call("gaia", lambda timeout: _gaia().launch_job_async(adql).get_results())
+    #r.pprint()
+    #r.show_in_browser()
+
+    catalog_data = r.to_pandas()
+    return catalog_data
+
+
+def _vizier(source, max_rows=None):
+    """Vizier instance that only requests the needed columns, sorted by brightness, with magnitude and row limit."""
+    if(max_rows is None):
+        max_rows = s.CATALOG_MAX_ROWS
+    columns = []
+    for column in VIZIER_COLUMNS[source]:
+        if(column == SORT_MAGNITUDE[source]):
+            column = "+"+column #sort ascending, brightest first
+        columns.append(column)
+    return Vizier(columns=columns, column_filters={SORT_MAGNITUDE[source]: "<{}".format(s.CATALOG_MAG_LIMIT)}, row_limit=max_rows)
+
+
+def _parse_votable(content):
+    """Tables with rows in a VOTable response of Vizier, columns named by their names (not IDs), invalid values masked."""
+    tables = votable.parse(io.BytesIO(content), verify="ignore", invalid="mask")
+    return [table.to_table(use_names_over_ids=True) for table in tables.iter_tables() if len(table.array) > 0]
+
+
+def _query_vizier(source, coord, radius, catalog, max_rows=None):
+    """Cone search in a Vizier catalog, sent with the pooled session and retries of catalog_client.
+
+    astroquery builds the request, the HTTP request is done here and the VOTable is parsed with astropy.
+
+    Returns
+    -------
+    tables : list
+        astropy Tables, empty if nothing was found
+
+    """
+    vizier = _vizier(source, max_rows)
+    payload = vizier.query_region(coord, radius=radius, catalog=catalog, get_query_payload=True)
+    url = s.CATALOG_VIZIER_URL
+    if(url is None):
+        url = "https://{}/viz-bin/votable".format(vizier_conf.server)
+    response = catalog_client.post("vizier", url, payload)
+    return _parse_votable(response.content)
+
+
+def _query_PS(coord, radius, max_rows=None):
+    j = _query_vizier("PS", coord, radius, "II/349/ps1", max_rows)
+    if (not j):
+        return None
+    r = j[0]
+    #r.pprint()
+    #r.show_in_browser()
+
+    catalog_data = r.to_pandas()
+    catalog_data.rename(index=str, columns={"RAJ2000": "ra", "e_RAJ2000":"ra_error", "DEJ2000": "dec", "e_DEJ2000":"dec_error"}, inplace=True)
+    return catalog_data
+
+
+def _query_2MASS(coord, radius, max_rows=None):
+    #astrometry and photometry used to query II/246 and II/246/out, the only table in II/246 is II/246/out
+    j = _query_vizier("2MASS", coord, radius, "II/246/out", max_rows)
+    if (not j):
+        return None
+    r = j[0]
+
+    catalog_data = r.to_pandas()
+    catalog_data.rename(index=str, columns={"RAJ2000": "ra", "DEJ2000": "dec"}, inplace=True)
+    return catalog_data
+
+
+def get_superset_data(coord, radius, source, max_rows=None):
+    """Get all columns needed by astrometry and photometry for a region. Each region is only downloaded once.
+
+    The region is downloaded with at least the radius CATALOG_MIN_RADIUS (settings) so the photometry of the same frame can use it as well.
+    Previously downloaded regions (in this run, stored in an _astro.fits file or in CATALOG_CACHE_DIR) that contain the requested region are used instead of a new query.
+    Downloads go through catalog_client: failed requests are retried and identical requests running at the same time are only sent once.
+
+    Parameters
+    ----------
+    coord  : SkyCoord
+        Position to search.
+    radius : float*unit
+        Radius of search cone.
+    source : str
+        Catalog to query, 'PS', '2MASS' or 'GAIA'
+    max_rows : int
+        Number of brightest sources downloaded, default CATALOG_MAX_ROWS from settings
+
+    Returns
+    -------
+    catalog_data : dataframe
+        ra (deg), dec (deg) and the columns in SUPERSET_COLUMNS of the catalog. None if nothing was found.
+
+    """
+    source = catalog_name(source)
+    ra = coord.icrs.ra.deg
+    dec = coord.icrs.dec.deg
+    radius_deg = u.Quantity(radius, u.deg).value
+
+    catalog_data = _from_cache(source, ra, dec, radius_deg)
+    if(catalog_data is None):
+        _load_disk_cache(source, ra, dec, radius_deg)
+        catalog_data = _from_cache(source, ra, dec, radius_deg)
+    if(catalog_data is not None):
+        print("Using {} sources from {} that were already downloaded".format(catalog_data.shape[0], source))
+        return catalog_data
+
+    query_radius = max(radius_deg, s.CATALOG_MIN_RADIUS/60.)
+    #frames of the same field solved at the same time (threads or job queue workers) share one download
+    key = (source, round(ra, 5), round(dec, 5), round(query_radius, 5), max_rows)
+    catalog_data = catalog_client.single_flight(key, lambda: _download(source, coord, query_radius, max_rows))
+    if(catalog_data is None):
+        return None
+    return _cut_to_cone(catalog_data, ra, dec, radius_deg)
+
+
+def _download(source, coord, query_radius, max_rows):
+    """Download the region and add it to the cache, unless another process downloaded it in the meantime."""
+    ra = coord.icrs.ra.deg
+    dec = coord.icrs.dec.deg
+    _load_disk_cache(source, ra, dec, query_radius)
+    catalog_data = _from_cache(source, ra, dec, query_radius)
+    if(catalog_data is not None):
+        return catalog_data
+    query_functions = {"PS": _query_PS, "2MASS": _query_2MASS, "GAIA": _query_GAIA}
+    catalog_data = query_functions[source](coord, u.Quantity(query_radius, u.deg), max_rows)
+    if(catalog_data is None):
+        return None
+    columns = [column for column in SUPERSET_COLUMNS[source] if column in catalog_data.columns]
+    catalog_data = catalog_data[columns].reset_index(drop=True)
+    _add_to_cache(source, ra, dec, query_radius, catalog_data)
+    return catalog_data
 
-#import settings as s
 
+def prefetch_region(coord, radius, source):
+    """Download one region that covers several frames, so the queries for the single frames are served from the cache.
 
+    The row limit is scaled with the area (relative to CATALOG_MIN_RADIUS), so the frames get the same source density
+    as with their own query.
+    """
+    radius_deg = u.Quantity(radius, u.deg).value
+    area_factor = max(1., (radius_deg/(s.CATALOG_MIN_RADIUS/60.))**2)
+    print("Downloading {} for a region with radius {:.3g} arcmin covering several frames".format(catalog_name(source), radius_deg*60))
+    return get_superset_data(coord, radius, source, max_rows=int(s.CATALOG_MAX_ROWS*area_factor))
 
 
+def downloaded_region(coord, radius, source):
+    """Downloaded region a cone of get_data is cut from.
+
+    Returns
+    -------
+    key : tuple
+        catalog, ra, dec and radius (deg) of the region, None if the cone is not in a downloaded region
+    catalog_data : dataframe
+        sources of the region with the columns of get_data
+
+    """
+    source = catalog_name(source)
+    entry = _cached_region(source, coord.icrs.ra.deg, coord.icrs.dec.deg, u.Quantity(radius, u.deg).value)
+    if(entry is None):
+        return None, None
+    ra, dec, region_radius, catalog_data = entry
+    #rounded like the file names of CATALOG_CACHE_DIR, so a region read back from there has the same key
+    return (source, round(ra, 5), round(dec, 5), round(region_radius, 5)), _astrometry_view(catalog_data, source)
+
+
+def _errors_to_mas(catalog_data, source):
+    """Copy of the superset with ra_error and dec_error in mas (see POSITION_ERROR_UNIT)."""
+    catalog_data = catalog_data.copy()
+    if(source in POSITION_ERROR_UNIT):
+        factor = (1*POSITION_ERROR_UNIT[source]).to(u.mas).value
+        for column in ["ra_error", "dec_error"]:
+            if(column in catalog_data.columns):
+                catalog_data[column] = catalog_data[column].astype(float)*factor
+    return catalog_data
+
+
+def _astrometry_view(catalog_data, source):
+    """Reduce the superset to ra, (ra_error), dec, (dec_error), mag. The position errors are converted to mas."""
+    catalog_data = _errors_to_mas(catalog_data, source)
+    catalog_data["mag"] = catalog_data[ASTROMETRY_MAGNITUDES[source]].min(axis=1) #there should not be an issue with -999 values since in Vizier nulls are used fro missing values not -999
+    columns = [column for column in ["ra", "ra_error", "dec", "dec_error", "mag"] if column in catalog_data.columns]
+    return catalog_data[columns]
 
 
 def get_GAIA_data(coord, radius):
@@ -43,14 +432,8 @@ def get_GAIA_data(coord, radius):
         table with the objects including the following info: ra (deg), ra_error (milliarcsec), dec (deg), dec_error (milliarcsec), mag
 
     """
-    j = Gaia.cone_search_async(coord, radius)
-    r = j.get_results()
-    #r.pprint()
-    #r.show_in_browser()
-
-    catalog_data = r.to_pandas()
-    catalog_data["mag"] = catalog_data["phot_g_mean_mag"]
-    catalog_data = catalog_data[["ra", "ra_error", "dec", "dec_error", "mag"]]
+    catalog_data = get_superset_data(coord, radius, "GAIA")
+    catalog_data = _astrometry_view(catalog_data, "GAIA")
     print("Found {} sources in GAIA within a radius of {}".format(catalog_data.shape[0], radius))
     #columns: ra, ra_error, dec, dec_error, mag
     return catalog_data
@@ -72,19 +455,10 @@ def get_PS_data(coord, radius):
         table with the objects including the following info: ra (deg), ra_error (milliarcsec), dec (deg), dec_error (milliarcsec), mag
 
     """
-    Vizier.ROW_LIMIT = -1
-    j = Vizier.query_region(coord, radius=radius, catalog="II/349/ps1")
-    if (j==[]):
+    catalog_data = get_superset_data(coord, radius, "PS")
+    if (catalog_data is None):
         return None
-    r = j[0]
-    #r.pprint()
-    #r.show_in_browser()
-
-    catalog_data = r.to_pandas()
-    magnitudes = ["gmag", "rmag", "imag", "zmag", "ymag"]
-    catalog_data["mag"] = catalog_data[magnitudes].min(axis=1) #there should not be an issue with -999 values since in Vizier nulls are used fro missing values not -999
-    catalog_data.rename(index=str, columns={"RAJ2000": "ra", "e_RAJ2000":"ra_error", "DEJ2000": "dec", "e_DEJ2000":"dec_error"}, inplace=True)
-    catalog_data = catalog_data[["ra", "ra_error", "dec", "dec_error", "mag"]]
+    catalog_data = _astrometry_view(catalog_data, "PS")
     #print(catalog_data)
     #columns: ra, ra_error, dec, dec_error, mag
     #
@@ -123,15 +497,10 @@ def get_PS_photometry_data(ra=0, dec=0, radius=60, coord=None, band="z"):
     radius = u.Quantity(radius, u.arcsec)
     if(coord == None):
         coord = SkyCoord(ra, dec, unit=(u.deg, u.deg), frame="icrs")
-    Vizier.ROW_LIMIT = -1
-    j = Vizier.query_region(coord, radius=radius, catalog="II/349/ps1")
-    if (j==[]):
+    catalog_data = get_superset_data(coord, radius, "PS")
+    if (catalog_data is None):
         return None
-    r = j[0]
-
-
-    catalog_data = r.to_pandas()
-    catalog_data.rename(index=str, columns={"RAJ2000": "ra", "e_RAJ2000":"ra_error", "DEJ2000": "dec", "e_DEJ2000":"dec_error"}, inplace=True)
+    catalog_data = _errors_to_mas(catalog_data, "PS")
     #columns: ra, ra_error, dec, dec_error, mag
     #
     print("Found {} sources in PS1 within a radius of {}".format(catalog_data.shape[0], radius))
@@ -161,18 +530,10 @@ def get_2MASS_data(coord, radius):
     """
 
     #coord = SkyCoord(ra=ra*u.deg,dec=dec*u.deg, frame="icrs")
-    Vizier.ROW_LIMIT = -1
-    j = Vizier.query_region(coord, radius=radius, catalog="II/246/out")
-    if (j==[]):
+    catalog_data = get_superset_data(coord, radius, "2MASS")
+    if (catalog_data is None):
         return None
-    r = j[0]
-
-
-    catalog_data = r.to_pandas()
-    magnitudes = ["Jmag", "Kmag", "Hmag"]
-    catalog_data["mag"] = catalog_data[magnitudes].min(axis=1) #there should not be an issue with -999 values since in Vizier nulls are used fro missing values not -999
-    catalog_data.rename(index=str, columns={"RAJ2000": "ra", "DEJ2000": "dec"}, inplace=True)
-    catalog_data = catalog_data[["ra", "dec", "mag"]]
+    catalog_data = _astrometry_view(catalog_data, "2MASS")
     print("WARNING: 2MASS has no error for the positions.")
     #columns: ra, ra_error, dec, dec_error, mag
     #
@@ -213,15 +574,9 @@ def get_2MASS_photometry_data(ra=0, dec=0, radius=60, coord=None, band="z"):
     radius = u.Quantity(radius, u.arcsec)
     if(coord == None):
         coord = SkyCoord(ra, dec, unit=(u.deg, u.deg), frame="icrs")
-    Vizier.ROW_LIMIT = -1
-    j = Vizier.query_region(coord, radius=radius, catalog="II/246")
-    if (j==[]):
+    catalog_data = get_superset_data(coord, radius, "2MASS")
+    if (catalog_data is None):
         return None
-    r = j[0]
-
-
-    catalog_data = r.to_pandas()
-    catalog_data.rename(index=str, columns={"RAJ2000": "ra", "DEJ2000": "dec"}, inplace=True)
     #columns: ra, ra_error, dec, dec_error, mag
     #
     print("Found {} sources in 2MASS within a radius of {}".format(catalog_data.shape[0], radius))
@@ -261,6 +616,83 @@ def get_data(pos, radius, source):
     if(source == "2MASS" or source == "TWOMASS" or source == "2mass" or source =="twomass"):
         return get_2MASS_data(pos, radius)
 
+def _position_error(catalog_data, source):
+    """Position error in mas of each source (errors in mas as returned by get_data), the typical error of the survey where it is not given."""
+    error = np.full(catalog_data.shape[0], np.nan)
+    if("ra_error" in catalog_data.columns and "dec_error" in catalog_data.columns):
+        error = np.hypot(catalog_data["ra_error"].values.astype(float), catalog_data["dec_error"].values.astype(float))
+    return np.where(np.isfinite(error), error, TYPICAL_POSITION_ERROR.get(source, np.inf))
+
+
+def merge_catalogs(catalogs, radius=None):
+    """Combine the catalogs of several surveys without duplicates.
+
+    Entries of different surveys within radius of each other are the same star, only the entry with the
+    smallest position error is kept. Close pairs within one survey are kept, they are separate stars.
+    The cross match uses a KD-tree on unit vectors, so it runs in about n log n.
+
+    Parameters
+    ----------
+    catalogs : list
+        (source, dataframe) for each survey, dataframes as returned by get_data (None is skipped)
+    radius : float
+        match radius in arcsec, default CATALOG_MERGE_RADIUS from settings
+
+    Returns
+    -------
+    catalog_data : dataframe
+        ra (deg), ra_error (mas), dec (deg), dec_error (mas), mag of the kept entries and the column surveys with
+        all surveys the star was found in (e.g. "GAIA+PS"). None if all catalogs are None.
+
+    """
+    if(radius is None):
+        radius = s.CATALOG_MERGE_RADIUS
+    parts = []
+    for source, catalog_data in catalogs:
+        if(catalog_data is None or catalog_data.shape[0] == 0):
+            continue
+        catalog_data = catalog_data.reset_index(drop=True).copy()
+        catalog_data["position_error"] = _position_error(catalog_data, source)
+        catalog_data["surveys"] = source
+        parts.append(catalog_data)
+    if(len(parts) == 0):
+        return None
+    combined = pd.concat(parts, ignore_index=True)
+
+    ra = np.radians(combined["ra"].values.astype(float))
+    dec = np.radians(combined["dec"].values.astype(float))
+    unit_vectors = np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+    chord = 2*np.sin(np.radians(radius/3600.)/2)
+    neighbours = cKDTree(unit_vectors).query_ball_point(unit_vectors, chord)
+
+    #best astrometry first, each kept entry absorbs the entries of the other surveys around it
+    surveys = combined["surveys"].values
+    order = np.argsort(combined["position_error"].values, kind="stable")
+    merged = np.zeros(combined.shape[0], dtype=bool)
+    keep = []
+    found_in = []
+    for i in order:
+        if(merged[i]):
+            continue
+        found = {surveys[i]}
+        for j in neighbours[i]:
+            if(not merged[j] and j != i and surveys[j] != surveys[i]):
+                merged[j] = True
+                found.add(surveys[j])
+        merged[i] = True
+        keep.append(i)
+        found_in.append("+".join(sorted(found)))
+
+    keep = np.array(keep, dtype=int)
+    catalog_data = combined.iloc[keep].copy()
+    catalog_data["surveys"] = found_in
+    #back to the order of the input catalogs
+    catalog_data = catalog_data.iloc[np.argsort(keep, kind="stable")].drop(columns="position_error").reset_index(drop=True)
+    n_duplicates = combined.shape[0] - catalog_data.shape[0]
+    print("Combined {} catalogs: {} sources, {} duplicates within {} arcsec removed".format(len(parts), catalog_data.shape[0], n_duplicates, radius))
+    return catalog_data
+
+
 def get_photometry_data(pos, radius, band, source="auto"):
     """Query databases.
 
@@ -16,21 +16,213 @@ import matplotlib.pyplot as plt
 #from scipy.signal import correlate2d
 
 
+import collections
 import copy
+import glob
+import hashlib
+import os
+import threading
+import scipy.fft
 
 import settings as s
+import profiling
+import image_io
 
 
+#per thread buffers for the histograms, so the large arrays are not allocated again for every histogram
+_histogram_buffers = threading.local()
+#catalog side of the scale and rotation search (histograms of the catalog pairs and their Fourier transforms)
+#for the last PAIR_CACHE_SIZE keys, most recently used last
+_spectrum_cache = collections.OrderedDict()
+_spectrum_lock = threading.Lock()
+
+
+def float_type():
+    """Float type of the image and the registration arrays. float32 if PRECISION in settings is 'single', otherwise float64."""
+    if(s.PRECISION == "single"):
+        return np.float32
+    return np.float64
+
+
+def histogram_buffer(name, shape, dtype=np.float64):
+    """Reusable array for a histogram. The content is overwritten by the next call with the same name in this thread."""
+    buffers = getattr(_histogram_buffers, "buffers", None)
+    if(buffers is None):
+        buffers = _histogram_buffers.buffers = {}
+    buffer = buffers.get(name)
+    if(buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype):
+        buffer = buffers[name] = np.empty(shape, dtype=dtype)
+    return buffer
+
+
+def histogram_uniform(x, y, x_start, x_binwidth, n_x, y_start, y_binwidth, n_y, out=None):
+    """2D histogram for uniform bins. Same result as np.histogram2d with the edges x_start + i*x_binwidth (i=0..n_x) but faster.
+
+    The coordinates are directly converted to integer bin indices and counted. With out and few values (less than one
+    per 128 bins, e.g. the pairs of the brightest detections) they are added to out directly, otherwise np.bincount
+    is faster even though it needs a temporary array of the full size.
+    Values outside of the edges are ignored, values on the last edge are counted in the last bin (like np.histogram2d).
+
+    Parameters
+    ----------
+    x, y : array
+        coordinates
+    x_start, y_start : float
+        first edge
+    x_binwidth, y_binwidth : float
+        width of the bins
+    n_x, n_y : int
+        number of bins
+    out : array
+        optional contiguous (n_x, n_y) array the counts are written to, see histogram_buffer
+
+    Returns
+    -------
+    H : array
+        counts with shape (n_x, n_y)
+
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    #numpy float64 scalars would turn float32 coordinates into float64 temporaries
+    if(x.dtype == np.float32):
+        x_start, x_binwidth = np.float32(x_start), np.float32(x_binwidth)
+    if(y.dtype == np.float32):
+        y_start, y_binwidth = np.float32(y_start), np.float32(y_binwidth)
+    index_x = np.floor((x - x_start)/x_binwidth).astype(np.intp)
+    index_y = np.floor((y - y_start)/y_binwidth).astype(np.intp)
+    #the last edge belongs to the last bin
+    index_x[(index_x == n_x) & (x <= x_start + n_x*x_binwidth)] = n_x-1
+    index_y[(index_y == n_y) & (y <= y_start + n_y*y_binwidth)] = n_y-1
+    valid = (index_x >= 0) & (index_x < n_x) & (index_y >= 0) & (index_y < n_y)
+    index = index_x[valid]*n_y + index_y[valid]
+    if(out is None):
+        return np.bincount(index, minlength=n_x*n_y).reshape(n_x, n_y)
+    out.fill(0)
+    if(len(index) < out.size//128):
+        np.add.at(out.reshape(-1), index, 1)
+    else:
+        out.reshape(-1)[:] = np.bincount(index, minlength=out.size)
+    return out
+
+
+
+class Detections:
+    """Detected sources as contiguous arrays, used by all registration functions instead of the dataframe.
+
+    Parameters
+    ----------
+    x, y : array
+        pixel positions (xcenter, ycenter)
+    flux : array
+        aperture sums, used to select the brightest sources
+    rows : array
+        row of each source in the dataframe it was made from
+
+    """
+    __slots__ = ("x", "y", "flux", "rows")
+
+    def __init__(self, x, y, flux, rows=None):
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.ascontiguousarray(y, dtype=np.float64)
+        self.flux = np.ascontiguousarray(flux, dtype=np.float64)
+        self.rows = np.arange(len(self.x)) if rows is None else rows
+
+    @classmethod
+    def from_dataframe(cls, observation):
+        return cls(observation["xcenter"].values, observation["ycenter"].values, observation["aperture_sum"].values)
+
+    def __len__(self):
+        return len(self.x)
+
+    def take(self, index):
+        return Detections(self.x[index], self.y[index], self.flux[index], self.rows[index])
+
+    def brightest(self, n):
+        """The n sources with the largest aperture sum, brightest first (like dataframe.nlargest)."""
+        return self.take(_select(-self.flux, n))
+
+
+class CatalogSources:
+    """Catalog sources as contiguous arrays, used by all registration functions instead of the dataframe.
+
+    Parameters
+    ----------
+    radec : array
+        (n, 2) ra and dec in degrees, ready for wcsprm.s2p
+    mag : array
+        magnitudes, used to select the brightest sources
+    rows : array
+        row of each source in the dataframe it was made from
+
+    """
+    __slots__ = ("radec", "mag", "rows")
+
+    def __init__(self, radec, mag, rows=None):
+        self.radec = np.ascontiguousarray(radec, dtype=np.float64).reshape(-1, 2)
+        self.mag = np.ascontiguousarray(mag, dtype=np.float64)
+        self.rows = np.arange(len(self.mag)) if rows is None else rows
+
+    @classmethod
+    def from_dataframe(cls, catalog):
+        #photometry catalogs have band columns instead of mag, they are only matched by position
+        mag = catalog["mag"].values if "mag" in catalog.columns else np.full(len(catalog), np.nan)
+        return cls(catalog[["ra", "dec"]].values, mag)
+
+    def __len__(self):
+        return len(self.mag)
+
+    @property
+    def ra(self):
+        return self.radec[:, 0]
+
+    @property
+    def dec(self):
+        return self.radec[:, 1]
+
+    def take(self, index):
+        return CatalogSources(self.radec[index], self.mag[index], self.rows[index])
+
+    def brightest(self, n):
+        """The n sources with the smallest magnitude, brightest first (like dataframe.nsmallest)."""
+        return self.take(_select(self.mag, n))
+
+    def on_sensor(self, wcsprm):
+        """Pixel positions (n, 2) of the sources."""
+        if(len(self) == 0):
+            return np.empty((0, 2))
+        return wcsprm.s2p(self.radec, 1)['pixcrd']
+
+
+def _select(values, n):
+    """Indices of the n smallest values in increasing order, NaN is never selected. Ties keep the original order."""
+    valid = np.flatnonzero(~np.isnan(values))
+    return valid[np.argsort(values[valid], kind="stable")[:n]]
+
+
+def as_detections(observation):
+    """Detections for a dataframe of detected sources. Conversion is only done at the boundary, arrays are passed on as they are."""
+    if(isinstance(observation, Detections)):
+        return observation
+    return Detections.from_dataframe(observation)
+
+
+def as_catalog(catalog):
+    """CatalogSources for a catalog dataframe, see as_detections."""
+    if(isinstance(catalog, CatalogSources)):
+        return catalog
+    return CatalogSources.from_dataframe(catalog)
+
 
 def simple_offset(observation, catalog, wcsprm, report=""):
     """Get best offset in x, y direction.
 
     Parameters
     ----------
-    observation : dataframe
-        pandas dataframe with sources on the observation
-    catalog : dataframe
-        pandas dataframe with nearby sources from online catalogs with accurate astrometric information
+    observation : Detections or dataframe
+        sources on the observation
+    catalog : CatalogSources or dataframe
+        nearby sources from online catalogs with accurate astrometric information
     wcsprm
         Wold coordinates file
     report : str
@@ -42,19 +234,22 @@ def simple_offset(observation, catalog, wcsprm, report=""):
 
     """
     report = report+"simple_offset aproach via a histogram \n"
+    observation = as_detections(observation)
+    catalog = as_catalog(catalog)
 
     #catalog_on_sensor = wcsprm.wcs_world2pix(catalog[["ra", "dec"]], 1) #now using wcsprm
-    catalog_on_sensor = wcsprm.s2p(catalog[["ra", "dec"]], 1)
-    catalog_on_sensor  = catalog_on_sensor['pixcrd']
+    catalog_on_sensor = catalog.on_sensor(wcsprm)
     #catalog_on_sensor[:,1]
-    obs = [observation["xcenter"].values]
-    cat = np.array( [catalog_on_sensor[:,0] ])
+    obs = np.array( [observation.x], dtype=float_type())
+    cat = np.array( [catalog_on_sensor[:,0] ], dtype=float_type())
     distances_x =  (obs - cat.T).flatten()
 
-    obs = [observation["ycenter"].values]
-    cat = np.array( [catalog_on_sensor[:,1] ])
+    obs = np.array( [observation.y], dtype=float_type())
+    cat = np.array( [catalog_on_sensor[:,1] ], dtype=float_type())
     distances_y =  (obs - cat.T).flatten()
     #vectorized distances, better by a factor. Went from a second for this method to well below a second,
+    if(len(distances_x) == 0):
+        return wcsprm, 0, report+"No sources to compare, no offset found. \n"
 
     #plot to visualize if something is not working
     # plt.figure()
@@ -66,10 +261,11 @@ def simple_offset(observation, catalog, wcsprm, report=""):
 
     #hist = plt.figure()
     binwidth= s.OFFSET_BINWIDTH #would there be a reason to make it bigger than 1?
-    bins = [np.arange(min(distances_x), max(distances_x) + binwidth, binwidth), np.arange(min(distances_y), max(distances_y) + binwidth, binwidth)]
+    bins = [np.arange(np.min(distances_x), np.max(distances_x) + binwidth, binwidth), np.arange(np.min(distances_y), np.max(distances_y) + binwidth, binwidth)]
 
     #H, x_edges, y_edges,tmp = plt.hist2d(distances_x, distances_y, bins=bins) #to visualize for testing
-    H, x_edges, y_edges = np.histogram2d(distances_x, distances_y, bins=bins)
+    x_edges, y_edges = bins
+    H = histogram_uniform(distances_x, distances_y, x_edges[0], binwidth, len(x_edges)-1, y_edges[0], binwidth, len(y_edges)-1)
 
     #finding the peak for the x and y distance where the two sets overlap
     peak = np.argwhere(H == H.max())[0] #take fisrt peak
@@ -107,39 +303,43 @@ def rotate(wcsprm, rot):
     wcsprm.pc = pc_rotated
     return wcsprm
 
-def offset_with_orientation(observation, catalog, wcsprm, verbose=True, fast=False, report_global="", INCREASE_FOV_FLAG=False):
+def offset_with_orientation(observation, catalog, wcsprm, verbose=True, fast=False, report_global="", INCREASE_FOV_FLAG=False, return_signal_ratio=False):
     """Use simple_offset(...) but with trying 0,90,180,270 rotation.
 
     Parameters
     ----------
-    observation : dataframe
-        pandas dataframe with sources on the observation
-    catalog : dataframe
-        pandas dataframe with nearby sources from online catalogs with accurate astrometric information
+    observation : Detections or dataframe
+        sources on the observation
+    catalog : CatalogSources or dataframe
+        nearby sources from online catalogs with accurate astrometric information
     wcsprm
         Wcsprm file
     verbose : boolean
         Set to False to supress output to the console
     fast : boolean
         If true will run with subset of the sources to increase speed.
+    return_signal_ratio : boolean
+        Also return the signal of the best orientation divided by the median signal of all orientations,
+        0 if the median is 0
 
 
     Returns
     -------
-    wcs, signal, report
+    wcs, signal, report (, signal_ratio)
 
     """
-    observation = copy.copy(observation)
-    N_SOURCES = observation.shape[0]
+    observation = as_detections(observation)
+    catalog = as_catalog(catalog)
+    N_SOURCES = len(observation)
     if(fast):
         if(N_SOURCES > s.USE_N_SOURCES):
             N_SOURCES = s.USE_N_SOURCES
-        observation = observation.nlargest(N_SOURCES, 'aperture_sum')
+        observation = observation.brightest(N_SOURCES)
         if(INCREASE_FOV_FLAG):
             N_CATALOG = N_SOURCES *12
         else:
             N_CATALOG = N_SOURCES * 4
-        catalog = catalog.nsmallest(N_CATALOG, 'mag')
+        catalog = catalog.brightest(N_CATALOG)
     if(verbose):
         #print("--------------------------------------")
         #print("offset_with_orientation, seaching for offset while considering reflections and 0,90,180,270 rotations")
@@ -172,10 +372,16 @@ def offset_with_orientation(observation, catalog, wcsprm, verbose=True, fast=Fal
     i = np.argmax(signals)
     wcsprm = results[i][0]
     signal = signals[i]
+    if(median > 0):
+        signal_ratio = signal/median
+    else:
+        #most orientations have no source pair at all, the ratio would be inf or nan
+        print("Offset search failed: the median signal of the orientations is 0 (best signal {}), no signal ratio".format(signal))
+        signal_ratio = 0.
     #hist = results[i][3]
     report = results[i][2]
     report = report + "A total of {} sources from the fits file where used. \n".format(N_SOURCES)
-    report = report + "The signal (#stars) is {} times higher than noise outlierers for other directions. (more than 2 would be nice, typical: 8 for PS)\n".format(signals[i]/median)
+    report = report + "The signal (#stars) is {} times higher than noise outlierers for other directions. (more than 2 would be nice, typical: 8 for PS)\n".format(signal_ratio)
 
 
     if(verbose):
@@ -187,19 +393,101 @@ def offset_with_orientation(observation, catalog, wcsprm, verbose=True, fast=Fal
     off = wcsprm.crpix - wcsprm_global.crpix
     print("Found offset {:.3g} in x direction and {:.3g} in y direction".format(off[0], off[1]))
 
+    if(return_signal_ratio):
+        return wcsprm, signal, report, signal_ratio
     return wcsprm, signal, report
 
 
+def coarse_registration(observation, catalog, wcsprm, scale_guessed=False, rotation_scaling=True, xy_transformation=True, fast=True, INCREASE_FOV_FLAG=False, verbose=True, scale_factors=None, catalog_region=None):
+    """Scaling, rotation and offset. First tries with the brightest sources only and only uses all sources if that is not convincing.
+
+    The fast attempt uses the USE_N_SOURCES brightest sources. It is accepted if at least FASTMODE_THRESHOLD of them
+    are matched afterwards and the offset signal is FASTMODE_SIGNAL_RATIO times higher than the median of the other orientations.
+
+    Parameters
+    ----------
+    observation : Detections or dataframe
+        sources on the observation
+    catalog : CatalogSources or dataframe
+        nearby sources from online catalogs with accurate astrometric information
+    wcsprm
+        Wcsprm file
+    scale_guessed : boolean
+        Pixel scale is just a guess
+    rotation_scaling, xy_transformation : boolean
+        Steps to perform
+    fast : boolean
+        Set to False to always use all sources
+    verbose : boolean
+        Set to False to supress output to the console
+    scale_factors : array
+        bank of scale factors searched for the scale, see get_scaling_and_rotation
+    catalog_region : CatalogRegion
+        downloaded region the catalog was cut from, see get_scaling_and_rotation
+
+    Returns
+    -------
+    wcsprm, diagnostics
+        diagnostics is a dict with the mode that was used in the end ("fast" or "full")
+        and the match_fraction and signal_ratio of the fast attempt
+
+    """
+    diagnostics = {"mode": "full", "match_fraction": np.nan, "signal_ratio": np.nan}
+    observation = as_detections(observation)
+    catalog = as_catalog(catalog)
+    n_sources = min(s.USE_N_SOURCES, len(observation))
+    if(fast and n_sources < len(observation)):
+        observation_fast = observation.brightest(n_sources)
+        if(INCREASE_FOV_FLAG):
+            catalog_fast = catalog.brightest(n_sources*12)
+        else:
+            catalog_fast = catalog.brightest(n_sources*4)
+        wcsprm_fast = copy.copy(wcsprm)
+        print("Fast attempt with the {} brightest sources".format(n_sources))
+        if(rotation_scaling):
+            print("Finding scaling and rotation")
+            with profiling.stage("scale_rotation"):
+                wcsprm_fast = get_scaling_and_rotation(observation_fast, catalog_fast, wcsprm_fast, scale_guessed=scale_guessed, verbose=verbose, scale_factors=scale_factors, catalog_region=catalog_region)
+        if(xy_transformation):
+            print("Finding offset")
+            with profiling.stage("offset"):
+                wcsprm_fast, _, _, diagnostics["signal_ratio"] = offset_with_orientation(observation_fast, catalog_fast, wcsprm_fast, verbose=verbose, INCREASE_FOV_FLAG=INCREASE_FOV_FLAG, return_signal_ratio=True)
+        obs_x, _, _, _, _ = find_matches(observation_fast, catalog, wcsprm_fast, threshold=3)
+        diagnostics["match_fraction"] = len(obs_x)/n_sources
+
+        accepted = diagnostics["match_fraction"] >= s.FASTMODE_THRESHOLD
+        if(xy_transformation):
+            accepted = accepted and diagnostics["signal_ratio"] >= s.FASTMODE_SIGNAL_RATIO
+        print("Fast attempt: {:.0%} of the sources matched (required {:.0%}), signal is {:.3g} times the median of the other orientations (required {:.3g})".format(
+            diagnostics["match_fraction"], s.FASTMODE_THRESHOLD, diagnostics["signal_ratio"], s.FASTMODE_SIGNAL_RATIO))
+        if(accepted):
+            print("Fast attempt accepted")
+            diagnostics["mode"] = "fast"
+            return wcsprm_fast, diagnostics
+        print("Fast attempt not convincing, repeating with all {} sources".format(len(observation)))
+
+    if(rotation_scaling):
+        print("Finding scaling and rotation")
+        with profiling.stage("scale_rotation"):
+            wcsprm = get_scaling_and_rotation(observation, catalog, wcsprm, scale_guessed=scale_guessed, verbose=verbose, scale_factors=scale_factors, catalog_region=catalog_region)
+    if(xy_transformation):
+        print("Finding offset")
+        with profiling.stage("offset"):
+            wcsprm,_,_ = offset_with_orientation(observation, catalog, wcsprm, fast=False , INCREASE_FOV_FLAG=INCREASE_FOV_FLAG, verbose=verbose)
+    return wcsprm, diagnostics
+
+
 def calculate_dist(data_x, data_y):
-    data_x = np.array(data_x)
-    data_y = np.array(data_y)
+    data_x = np.array(data_x, dtype=float_type())
+    data_y = np.array(data_y, dtype=float_type())
 
     distances_x =  (data_x - data_x.T)
     distances_y =  (data_y - data_y.T)
 
     #only use off diagonal elements
-    distances_x = distances_x[np.where(~np.eye(distances_x.shape[0],dtype=bool))]
-    distances_y = distances_y[np.where(~np.eye(distances_y.shape[0],dtype=bool))]
+    off_diagonal = ~np.eye(distances_x.shape[0],dtype=bool) #boolean mask, np.where would create two int64 index arrays of the full size
+    distances_x = distances_x[off_diagonal]
+    distances_y = distances_y[off_diagonal]
 
     distances = np.sqrt(distances_x**2 + distances_y**2)
 
@@ -207,18 +495,19 @@ def calculate_dist(data_x, data_y):
 
 
 def calculate_log_dist(data_x, data_y):
-    log_distances = np.log(calculate_dist(data_x, data_y)+np.finfo(float).eps)
+    log_distances = np.log(calculate_dist(data_x, data_y)+np.finfo(float_type()).eps)
     return log_distances
 
 def calculate_angles(data_x, data_y):
     #plan: i need all pairs: vector differences, then angle with x axis.
     #so
-    data_x = np.array(data_x)
-    data_y = np.array(data_y)
+    data_x = np.array(data_x, dtype=float_type())
+    data_y = np.array(data_y, dtype=float_type())
     vec_x = data_x - data_x.T
     vec_y = data_y - data_y.T
-    vec_x = vec_x[np.where(~np.eye(vec_x.shape[0],dtype=bool))]
-    vec_y = vec_y[np.where(~np.eye(vec_y.shape[0],dtype=bool))]
+    off_diagonal = ~np.eye(vec_x.shape[0],dtype=bool)
+    vec_x = vec_x[off_diagonal]
+    vec_y = vec_y[off_diagonal]
     angles = np.arctan2(vec_x,vec_y)
     angles = angles % (2*np.pi) #make sure angles are between 0 and 2 pi
     angles[np.where(angles > np.pi)] = -1*(2*np.pi - angles[np.where(angles > np.pi)]) #shift to -pi to pi
@@ -261,7 +550,8 @@ def peak_with_histogram(obs_x, obs_y, cat_x, cat_y):
 
     plt.show()
 
-    H, x_edges, y_edges = np.histogram2d(distances_x, distances_y, bins=bins)
+    x_edges, y_edges = bins
+    H = histogram_uniform(distances_x, distances_y, x_edges[0], binwidth, len(x_edges)-1, y_edges[0], binwidth*10, len(y_edges)-1)
 
     peak = np.argwhere(H == H.max())[0] #take fisrt peak
 
@@ -273,17 +563,375 @@ def peak_with_histogram(obs_x, obs_y, cat_x, cat_y):
 
 def cross_corr_to_fourier_space(a):
     "Tranform 2D array into fourier space. Uses padding and normalization."
-    aa = (a - np.mean(a))/np.std(a)
+    std = np.std(a)
+    #empty histograms (no catalog pairs in the range) give no correlation instead of nan, like _normalized
+    aa = ((a - np.mean(a))/(std if std > 0 else 1)).astype(float_type(), copy=False)
     #aaa = np.pad(aa, (aa.shape[0]//2,aa.shape[0]//2), 'constant') #wraps around so half the size should be fine, padds 2D array with zeros
     aaa = np.pad(aa, (2,2), 'constant')
     #I think for the angle the padding is not relevant since it is cyclic, for the scale i just don't care about the extremes
-    ff_a = np.fft.fft2(aaa)
+    ff_a = scipy.fft.fft2(aaa) #keeps single precision (complex64) for float32 input
     return ff_a
 
-def peak_with_cross_correlation(log_distance_obs, angle_obs, log_distance_cat, angle_cat, scale_guessed=False):
+def correlate_histograms(H_obs, H_cat, frequency_cut=0.02, ff_cat=None):
+    """Cross correlation of two histograms via FFT with a cut of the lowest frequencies. The zero shift is moved to the middle.
+
+    frequency_cut is relative to the highest frequency. For a grid that is coarser by a factor use frequency_cut*factor to cut the same frequencies.
+    If the transform of H_cat (cross_corr_to_fourier_space) is already known it can be given as ff_cat, H_cat is then not used.
+    """
+    ff_obs = cross_corr_to_fourier_space(H_obs)
+    if(ff_cat is None):
+        ff_cat = cross_corr_to_fourier_space(H_cat)
+
+
+    cross_corr = ff_obs*np.conj(ff_cat)
+    cross_corr[low_frequencies(ff_obs.shape, frequency_cut)] = 0 ##how to choose the frequency cut off?
+
+
+    cross_corr = np.real(scipy.fft.ifft2(cross_corr))
+    cross_corr = np.fft.fftshift(cross_corr) #zero shift is at (0,0), this move it to the middle
+    return cross_corr
+
+
+def low_frequencies(shape, frequency_cut):
+    """Mask of the frequencies removed from the cross correlation, see correlate_histograms."""
+    step = 1 # maybe in arcsec??, this is usually the timestep to get a frequency
+    frequ = np.fft.fftfreq(int(np.prod(shape)), d=step).reshape(shape)
+    max_frequ = np.max(frequ)#frequ are symmatric - to +
+    threshold = frequency_cut* max_frequ #todo make threshold changable
+    return (frequ<threshold)&(frequ>-threshold)
+
+
+def _fast_shape(shape):
+    return tuple(scipy.fft.next_fast_len(n+4, real=True) for n in shape)
+
+
+def _normalized(H, axes):
+    mean = np.mean(H, axis=axes, keepdims=True)
+    std = np.std(H, axis=axes, keepdims=True)
+    std[std == 0] = 1 #empty histograms (no catalog pairs in the range) give no correlation instead of nan
+    return ((H - mean)/std).astype(float_type(), copy=False)
+
+
+def histogram_stack_to_fourier_space(H_stack, workers=None):
+    """Normalized and padded real FFT of each histogram of a stack (n, ...), the catalog side of correlate_histogram_stack."""
+    if(workers is None):
+        workers = s.FFT_WORKERS
+    return scipy.fft.rfft2(_normalized(H_stack, (1,2)), s=_fast_shape(H_stack.shape[1:]), axes=(-2,-1), workers=workers)
+
+
+def correlate_histogram_stack(H_obs, H_cat_stack, frequency_cut=0.02, workers=None, ff_cat_stack=None):
+    """Cross correlation of one histogram with each histogram of a stack (n, ...), like correlate_histograms for each of them.
+
+    All transforms of the stack are done in one batched real FFT call, split over workers threads (default FFT_WORKERS
+    from settings). The histograms are padded to sizes the FFT handles fast instead of by only 2 bins.
+    If the transforms of the stack (histogram_stack_to_fourier_space) are already known they can be given as ff_cat_stack.
+    """
+    if(workers is None):
+        workers = s.FFT_WORKERS
+    shape = _fast_shape(H_obs.shape)
+    if(ff_cat_stack is None):
+        ff_cat_stack = histogram_stack_to_fourier_space(H_cat_stack, workers)
+
+    ff_obs = scipy.fft.rfft2(_normalized(H_obs, None), s=shape)
+    ff_stack = ff_cat_stack * np.conj(ff_obs)[np.newaxis]
+    np.conj(ff_stack, out=ff_stack)
+    ff_stack[:, low_frequencies(ff_stack.shape[1:], frequency_cut)] = 0
+    cross_corr = scipy.fft.irfft2(ff_stack, s=shape, axes=(-2,-1), workers=workers)
+    return np.fft.fftshift(cross_corr, axes=(-2,-1))
+
+
+def peak_in_correlation(cross_corr):
+    """Find the peak with sub bin accuracy and the signal (sum of the 3x3 bins around the peak).
+
+    Returns
+    -------
+    peak : array
+        index of the highest bin
+    peak_x_subpixel, peak_y_subpixel : float
+        sub bin offset of the true peak relative to the highest bin
+    signal : float
+
+    """
+    peak = np.argwhere(cross_corr == cross_corr.max())[0] #take fisrt peak
+
+    around_peak = cross_corr[peak[0]-1:peak[0]+2, peak[1]-1:peak[1]+2]
+
+    #finding the sub pixel shift of the true peak
+    # print("sub pixel offset:")
+    if(np.sum(around_peak) == 0):
+        return peak, 0., 0., np.sum(around_peak)
+    peak_x_subpixel = np.sum(np.sum(around_peak, axis=1)*(np.arange(around_peak.shape[0])+1))/np.sum(around_peak)-2#should be peak[0] offset
+    peak_y_subpixel = np.sum(np.sum(around_peak, axis=0)*(np.arange(around_peak.shape[1])+1))/np.sum(around_peak)-2#should be peak[1] offset
+
+    signal = np.sum(cross_corr[peak[0]-1:peak[0]+2, peak[1]-1:peak[1]+2])   #sum up signal in fixed aperture 1 pixel in each direction around the peak, so a 3x3 array, total 9 pixel
+    #signal_wide = np.sum(cross_corr[peak[0]-4:peak[0]+5, peak[1]-4:peak[1]+5])
+    # #report = report+"signal wide (64pixel) - signal (9pixel)  = {}. If this value is large then there might be rotation or scaling issues. \n".format(signal_wide-signal)
+    # #aperture = 9 #pixel
+    # ##signal wide: 64 pixel total
+    # # print(signal, signal_wide)
+    return peak, peak_x_subpixel, peak_y_subpixel, signal
+
+
+def downsample_histogram(H, factor):
+    """Sum blocks of factor x factor bins. The histogram is padded with zeros to a multiple of the factor."""
+    n0 = -(-H.shape[0]//factor)*factor
+    n1 = -(-H.shape[1]//factor)*factor
+    H = np.pad(H, ((0, n0-H.shape[0]), (0, n1-H.shape[1])), 'constant')
+    return H.reshape(n0//factor, factor, n1//factor, factor).sum(axis=(1,3))
+
+
+def correlation_window(H_obs, H_cat, center, half_width):
+    """Cross correlation of two histograms, only for shifts within half_width bins around center.
+
+    The sum runs only over the filled bins of H_obs, so this is cheap compared to the FFT of the full grid.
+    The angle axis (second axis) is cyclic. The result is divided by the standard deviations of the histograms and
+    the mean of the window is subtracted, but unlike correlate_histograms the low frequencies are not removed. It is
+    only meant to locate the peak within the window, its values can not be compared to the FFT correlation.
+
+    Parameters
+    ----------
+    H_obs, H_cat : array
+        histograms
+    center : tuple
+        shift in bins around which the window is calculated
+    half_width : int
+        window goes from center-half_width to center+half_width
+
+    Returns
+    -------
+    window : array
+        correlation, window[i,j] is the shift (center[0]-half_width+i, center[1]-half_width+j)
+
+    """
+    n0, n1 = H_cat.shape
+    obs_i0, obs_i1 = np.nonzero(H_obs)
+    weights = H_obs[obs_i0, obs_i1]
+    shifts_0 = np.arange(center[0]-half_width, center[0]+half_width+1)
+    shifts_1 = np.arange(center[1]-half_width, center[1]+half_width+1)
+    cat_i1 = (obs_i1[:, np.newaxis] - shifts_1[np.newaxis, :]) % n1
+
+    window = np.zeros((len(shifts_0), len(shifts_1)))
+    for k, shift_0 in enumerate(shifts_0):
+        cat_i0 = obs_i0 - shift_0
+        valid = (cat_i0 >= 0) & (cat_i0 < n0)
+        window[k] = weights[valid] @ H_cat[cat_i0[valid][:, np.newaxis], cat_i1[valid]]
+
+    norm = np.std(H_obs)*np.std(H_cat)
+    window = (window - np.mean(window)) / (norm if norm > 0 else 1)
+    return window
+
+
+def sky_tile(ra, dec):
+    """Index (dec, ra) of the PAIR_CACHE_TILE (settings) sky tile of a position in degrees and the center of the tile."""
+    tile = s.PAIR_CACHE_TILE/60
+    index = (int(np.floor(dec/tile)), int(np.floor(ra*np.cos(np.deg2rad(dec))/tile)))
+    dec_center = (index[0]+0.5)*tile
+    return index, ((index[1]+0.5)*tile/max(np.cos(np.deg2rad(dec_center)), 1e-6), dec_center)
+
+
+class CatalogRegion:
+    """Downloaded catalog region the catalog of a frame was cut from, see get_catalog_data.downloaded_region.
+
+    Frames of a field (e.g. dithers) are cut from the same region but each around its own center. The catalog pairs of
+    the scale and rotation search are instead made from a cut around the sky tile of the frame (sources_like), which is
+    the same for all frames with their center in that tile, so they can share the histograms.
+
+    Parameters
+    ----------
+    key : tuple
+        catalog, ra, dec and radius of the region
+    sources : CatalogSources
+        sources of the region
+    center : tuple
+        ra, dec (deg) of the catalog cone of the frame
+    radius : float
+        radius (deg) of the catalog cone of the frame
+
+    """
+    __slots__ = ("key", "sources", "center", "radius")
+
+    def __init__(self, key, sources, center, radius):
+        self.key = key
+        self.sources = sources
+        self.center = center
+        self.radius = radius
+
+    def sources_like(self, catalog):
+        """Sources of the region around the sky tile of the frame, with the density of catalog.
+
+        The cut has the radius of the frame cone plus one PAIR_CACHE_TILE (settings) around the tile center, so it covers
+        the cone of every frame in the tile. Only the brightest sources are used, as many per area as catalog has. Their
+        number is rounded up on a grid of PAIR_SOURCES_STEP, so frames whose cones hold a slightly different number of
+        sources get the same selection.
+
+        Returns
+        -------
+        key : tuple
+            region key followed by the tile, the radius of the cut and the number of sources
+        sources : CatalogSources
+
+        """
+        index, (ra, dec) = sky_tile(*self.center)
+        cut_radius = np.ceil((self.radius + np.sqrt(0.5)*s.PAIR_CACHE_TILE/60)*600)/600 #half the tile diagonal, rounded up to 0.1 arcmin
+        ra1, dec1, ra2, dec2 = np.radians(ra), np.radians(dec), np.radians(self.sources.ra), np.radians(self.sources.dec)
+        haversine = np.sin((dec2-dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2-ra1)/2)**2
+        inside = self.sources.take(np.flatnonzero(2*np.arcsin(np.sqrt(np.clip(haversine, 0, 1))) <= np.radians(cut_radius)))
+        n = max(len(catalog), 1)*(cut_radius/self.radius)**2
+        n = int(np.ceil(s.PAIR_SOURCES_STEP**np.ceil(np.log(n)/np.log(s.PAIR_SOURCES_STEP))))
+        return self.key + (index, cut_radius, n), inside.brightest(n)
+
+
+class CatalogPairs:
+    """Log distances and angles of all pairs of catalog sources projected with a wcs, calculated when first needed.
+
+    The pairs do not change if only the reference pixel changes, so the frames of a field can share the histograms
+    made from them. With a region the pairs are made from a cut of the downloaded region around the sky tile of the
+    frame (CatalogRegion.sources_like), which is the same for all frames of the field in that tile. key identifies the pairs by the region
+    (or the catalog sources without one), the projection, the linear part of the wcs and the sky tile (PAIR_CACHE_TILE
+    in settings) of the projection center. Moving the projection center to another tile gives another key, so
+    histograms are not reused for a field that is projected too differently.
+
+    Parameters
+    ----------
+    catalog : CatalogSources
+    wcsprm
+        Wcsprm the sources are projected with
+    region : CatalogRegion, optional
+        region catalog was cut from. Not used if it would need more than PAIR_REGION_MAX_SOURCES sources
+
+    """
+    def __init__(self, catalog, wcsprm, region=None):
+        self.catalog = catalog
+        self.wcsprm = wcsprm
+        self.region_key = None
+        if(region is not None):
+            region_key, sources = region.sources_like(catalog)
+            if(region_key[-1] <= s.PAIR_REGION_MAX_SOURCES):
+                self.catalog = sources
+                self.region_key = region_key
+        self._pairs = None
+
+    def pairs(self):
+        """log distances and angles"""
+        if(self._pairs is None):
+            on_sensor = self.catalog.on_sensor(self.wcsprm)
+            cat_x = np.array([on_sensor[:,0]])
+            cat_y = np.array([on_sensor[:,1]])
+            self._pairs = (calculate_log_dist(cat_x, cat_y), calculate_angles(cat_x, cat_y))
+        return self._pairs
+
+    def key(self):
+        tile_index, _ = sky_tile(*self.wcsprm.crval)
+        linear = self.wcsprm.get_cdelt()[:, np.newaxis] * self.wcsprm.get_pc()
+        sources = self.region_key
+        if(sources is None):
+            sources = hashlib.sha1(self.catalog.radec.tobytes()).hexdigest()
+        return (tile_index, tuple(self.wcsprm.ctype), tuple(float("{:.6e}".format(value)) for value in linear.ravel()), sources)
+
+
+def _evict_spectrum_files():
+    """Remove the least recently used pairs_*.npz files in CATALOG_CACHE_DIR beyond PAIR_CACHE_MAX_FILES (settings)."""
+    files = []
+    for filename in glob.glob(os.path.join(s.CATALOG_CACHE_DIR, "pairs_*.npz")):
+        try:
+            files.append((os.path.getmtime(filename), filename))
+        except OSError:
+            #removed by another process
+            continue
+    files.sort()
+    for _, filename in files[:max(len(files)-s.PAIR_CACHE_MAX_FILES, 0)]:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def _load_spectrum(filename):
+    """Stored spectrum, None if there is none (or another process removed it). Loading marks the file as recently used."""
+    try:
+        with np.load(filename) as stored:
+            spectrum = {name: stored[name] for name in stored.files}
+        os.utime(filename)
+    except (OSError, ValueError):
+        return None
+    return spectrum
+
+
+def cached_spectrum(key, calculate):
+    """Catalog side of the scale and rotation search for key, calculate() if it is not known yet.
+
+    The last PAIR_CACHE_SIZE results (settings) are kept in memory. With CATALOG_CACHE_DIR set they are also stored there,
+    so later runs and other workers on the same field find them. Only the PAIR_CACHE_MAX_FILES most recently used files are kept.
+
+    Parameters
+    ----------
+    key : tuple
+        CatalogPairs.key() followed by the parameters of the grid, the first entry is the sky tile
+    calculate : function
+        without arguments, returns a dict of arrays
+
+    Returns
+    -------
+    spectrum : dict
+        arrays, must not be changed
+
+    """
+    with _spectrum_lock:
+        if(key in _spectrum_cache):
+            _spectrum_cache.move_to_end(key)
+            return _spectrum_cache[key]
+
+    filename = None
+    spectrum = None
+    if(s.CATALOG_CACHE_DIR is not None):
+        filename = os.path.join(s.CATALOG_CACHE_DIR, "pairs_{:+d}_{:+d}_{}.npz".format(*key[0], hashlib.sha1(repr(key).encode()).hexdigest()[:16]))
+        spectrum = _load_spectrum(filename)
+    if(spectrum is None):
+        spectrum = calculate()
+        if(filename is not None):
+            os.makedirs(s.CATALOG_CACHE_DIR, exist_ok=True)
+            def write(temporary):
+                with open(temporary, "wb") as f:
+                    np.savez(f, **spectrum)
+            image_io.write_atomic(filename, write)
+            _evict_spectrum_files()
+
+    with _spectrum_lock:
+        _spectrum_cache[key] = spectrum
+        while(len(_spectrum_cache) > s.PAIR_CACHE_SIZE):
+            _spectrum_cache.popitem(last=False)
+    return spectrum
+
+
+def sparse_histogram(H):
+    """Filled bins of a histogram, the catalog histograms are stored like this. See dense_histogram."""
+    index = np.flatnonzero(H)
+    return {"index": index.astype(np.int32), "counts": H.ravel()[index].astype(np.int32)}
+
+
+def dense_histogram(spectrum, out, first_row=0):
+    """Write the rows first_row to first_row+out.shape[0] of a histogram stored with sparse_histogram to out."""
+    start = first_row*out.shape[1]
+    index = spectrum["index"]
+    inside = (index >= start) & (index < start+out.size)
+    out.fill(0)
+    out.reshape(-1)[index[inside]-start] = spectrum["counts"][inside]
+    return out
+
+
+def distance_grid_maximum(log_distance_obs):
+    """Upper edge of the log distance grid: the largest distance on the image rounded up to a multiple of PAIR_GRID_STEP (settings).
+
+    Frames of a field then mostly have the same grid and share the catalog histograms.
+    """
+    return np.ceil(np.max(log_distance_obs)/s.PAIR_GRID_STEP)*s.PAIR_GRID_STEP
+
+
+def peak_with_cross_correlation(log_distance_obs, angle_obs, log_distance_cat, angle_cat, scale_guessed=False, n_bins_dist=None, n_bins_angle=None, pyramid_factor=None, catalog_pairs=None):
     """Find the relation between the two sets. Either the positional offset (not used for that at the moment) or the scale+angle between them.
 
-    This is using cross correlation
+    This is using cross correlation. With pyramid_factor > 1 the correlation is first done on a grid that is coarser by that factor
+    in each direction and only a small window around the coarse peak is calculated at full resolution.
 
     Parameters
     ----------
@@ -295,72 +943,86 @@ def peak_with_cross_correlation(log_distance_obs, angle_obs, log_distance_cat, a
         first axis to consider of catalog data (log distance)
     angle_cat: array
         first axis to consider of catalog data (angle)
+    scale_guessed : boolean
+        Use the full range of distances if the pixel scale is just a guess
+    n_bins_dist : int
+        Number of bins in log distance, default SCALE_ROTATION_BINS_DIST from settings
+    n_bins_angle : int
+        Number of bins in angle, default SCALE_ROTATION_BINS_ANGLE from settings
+    pyramid_factor : int
+        Coarse grid factor, default SCALE_ROTATION_PYRAMID_FACTOR from settings. 1 to always use the full grid
+    catalog_pairs : CatalogPairs
+        If given, log_distance_cat and angle_cat are taken from it (pass None for them) and the catalog histogram is
+        cached, see cached_spectrum. Not for scale_guessed, the grid then depends on the catalog pairs
 
     Returns
     -------
-    x_shift, y_shift
+    scaling, rotation, signal
 
     """
+    if(n_bins_dist is None):
+        n_bins_dist = s.SCALE_ROTATION_BINS_DIST
+    if(n_bins_angle is None):
+        n_bins_angle = s.SCALE_ROTATION_BINS_ANGLE
+    if(pyramid_factor is None):
+        pyramid_factor = s.SCALE_ROTATION_PYRAMID_FACTOR
+
     if(scale_guessed==False):
         minimum_distance = np.log(8)#minimum pixel distance
-        maximum_distance = max(log_distance_obs)
+        maximum_distance = distance_grid_maximum(log_distance_obs)
     else:
+        if(catalog_pairs is not None):
+            log_distance_cat, angle_cat = catalog_pairs.pairs()
+            catalog_pairs = None
         #broader distance range if the scale is just a guess so there is a higher chance to find the correct one
-        minimum_distance = min([min(log_distance_cat), min(log_distance_obs)])
-        maximum_distance = max([max(log_distance_cat), max(log_distance_obs)])
+        minimum_distance = min([np.min(log_distance_cat), np.min(log_distance_obs)])
+        maximum_distance = max([np.max(log_distance_cat), np.max(log_distance_obs)])
 
-    bins_dist, binwidth_dist = np.linspace(minimum_distance, maximum_distance, 3000, retstep=True)
+    bins_dist, binwidth_dist = np.linspace(minimum_distance, maximum_distance, n_bins_dist, retstep=True)
     # print(binwidth_dist)
     # print(np.e**(binwidth_dist))
-    bins_ang, binwidth_ang = np.linspace(min([min(angle_cat), min(angle_obs)]), max([max(angle_cat),max(angle_obs)]), 360*3, retstep=True)
+    bins_ang, binwidth_ang = np.linspace(-np.pi, np.pi, n_bins_angle, retstep=True) #angles of pairs are within -pi to pi
     #print(binwidth_ang/2/np.pi*360)
-    bins = [bins_dist, bins_ang]#min max of both
-    H_obs, x_edges_obs, y_edges_obs = np.histogram2d(log_distance_obs, angle_obs, bins=bins)
-    H_cat, x_edges_cat, y_edges_cat = np.histogram2d(log_distance_cat,angle_cat, bins=bins)
-
-    #print(bins)
-    H_obs = (H_obs- np.mean(H_obs))/ np.std(H_obs)
-    H_cat = (H_cat- np.mean(H_cat))/ np.std(H_cat)
-
-    ff_obs = cross_corr_to_fourier_space(H_obs)
-    ff_cat = cross_corr_to_fourier_space(H_cat)
-
-
-    cross_corr = ff_obs*np.conj(ff_cat)
-
-    #frequency cut off
-    step = 1 # maybe in arcsec??, this is usually the timestep to get a frequency
-    frequ = np.fft.fftfreq(ff_obs.size, d=step).reshape(ff_obs.shape)
-    max_frequ = np.max(frequ)#frequ are symmatric - to +
-    threshold = 0.02* max_frequ #todo make threshold changable
-    #print(threshold)
-    cross_corr[(frequ<threshold)&(frequ>-threshold)] = 0 ##how to choose the frequency cut off?
-
-
-    cross_corr = np.real(np.fft.ifft2(cross_corr))
-    cross_corr = np.fft.fftshift(cross_corr) #zero shift is at (0,0), this move it to the middle
+    shape = (len(bins_dist)-1, len(bins_ang)-1)
+    H_obs = histogram_uniform(log_distance_obs, angle_obs, bins_dist[0], binwidth_dist, shape[0], bins_ang[0], binwidth_ang, shape[1], out=histogram_buffer("obs", shape, float_type()))
 
+    def catalog_spectrum():
+        #full resolution histogram (stored sparse) and the transform used for the first correlation
+        if(catalog_pairs is not None):
+            log_distance, angle = catalog_pairs.pairs()
+        else:
+            log_distance, angle = log_distance_cat, angle_cat
+        H_cat = histogram_uniform(log_distance, angle, bins_dist[0], binwidth_dist, shape[0], bins_ang[0], binwidth_ang, shape[1], out=histogram_buffer("cat", shape, float_type()))
+        spectrum = sparse_histogram(H_cat)
+        spectrum["ff"] = cross_corr_to_fourier_space(downsample_histogram(H_cat, pyramid_factor) if pyramid_factor > 1 else H_cat)
+        return spectrum
+
+    if(catalog_pairs is not None):
+        key = catalog_pairs.key() + ("histogram", n_bins_dist, n_bins_angle, pyramid_factor, round(minimum_distance, 6), round(maximum_distance, 6), float_type().__name__)
+        spectrum = cached_spectrum(key, catalog_spectrum)
+    else:
+        spectrum = catalog_spectrum()
 
-    peak = np.argwhere(cross_corr == cross_corr.max())[0] #take fisrt peak
+    if(pyramid_factor > 1):
+        #coarse grid to find the neighbourhood of the peak
+        cross_corr = correlate_histograms(downsample_histogram(H_obs, pyramid_factor), None, frequency_cut=0.02*pyramid_factor, ff_cat=spectrum["ff"])
+        peak, peak_x_subpixel, peak_y_subpixel, signal = peak_in_correlation(cross_corr)
+        coarse_shift = (peak + [peak_x_subpixel, peak_y_subpixel] - np.array(cross_corr.shape)//2) * pyramid_factor
 
-    around_peak = cross_corr[peak[0]-1:peak[0]+2, peak[1]-1:peak[1]+2]
-
-    #finding the sub pixel shift of the true peak
-    # print("sub pixel offset:")
-    peak_x_subpixel = np.sum(np.sum(around_peak, axis=1)*(np.arange(around_peak.shape[0])+1))/np.sum(around_peak)-2#should be peak[0] offset
-    peak_y_subpixel = np.sum(np.sum(around_peak, axis=0)*(np.arange(around_peak.shape[1])+1))/np.sum(around_peak)-2#should be peak[1] offset
+        H_cat = dense_histogram(spectrum, histogram_buffer("cat", shape, float_type()))
+        #the window has no low frequency cut, so the signal of the coarse grid stays the confidence value
+        x_shift, y_shift, _ = refine_peak(H_obs, H_cat, coarse_shift, pyramid_factor, binwidth_dist, binwidth_ang)
+    else:
+        #print(bins)
+        #normalization happens in cross_corr_to_fourier_space
+        cross_corr = correlate_histograms(H_obs, None, ff_cat=spectrum["ff"])
+        peak, peak_x_subpixel, peak_y_subpixel, signal = peak_in_correlation(cross_corr)
 
-    signal = np.sum(cross_corr[peak[0]-1:peak[0]+2, peak[1]-1:peak[1]+2])   #sum up signal in fixed aperture 1 pixel in each direction around the peak, so a 3x3 array, total 9 pixel
-    #signal_wide = np.sum(cross_corr[peak[0]-4:peak[0]+5, peak[1]-4:peak[1]+5])
-    # #report = report+"signal wide (64pixel) - signal (9pixel)  = {}. If this value is large then there might be rotation or scaling issues. \n".format(signal_wide-signal)
-    # #aperture = 9 #pixel
-    # ##signal wide: 64 pixel total
-    # # print(signal, signal_wide)
-    middle_x = cross_corr.shape[0]/2#is that corroct? yes I think so, shape is uneven number and index counting starts at 0
-    middle_y = cross_corr.shape[1]/2
+        middle_x = cross_corr.shape[0]/2#is that corroct? yes I think so, shape is uneven number and index counting starts at 0
+        middle_y = cross_corr.shape[1]/2
 
-    x_shift = (peak[0]+peak_x_subpixel-middle_x)*binwidth_dist
-    y_shift = (peak[1]+peak_y_subpixel-middle_y)*binwidth_ang
+        x_shift = (peak[0]+peak_x_subpixel-middle_x)*binwidth_dist
+        y_shift = (peak[1]+peak_y_subpixel-middle_y)*binwidth_ang
 
     scaling= np.e**(-x_shift)
     rotation = y_shift#/2/np.pi*360 maybe easier in rad
@@ -373,6 +1035,166 @@ def peak_with_cross_correlation(log_distance_obs, angle_obs, log_distance_cat, a
 
     return scaling, rotation, signal
 
+def refine_peak(H_obs, H_cat, coarse_shift, pyramid_factor, binwidth_dist, binwidth_ang):
+    """Peak of the full resolution correlation in a small window around the shift (in full resolution bins) found on the coarse grid.
+
+    Returns
+    -------
+    x_shift, y_shift : float
+        shift in log distance and angle
+    signal : float
+        signal in the window, only comparable to other windows (see correlation_window). Use the signal of the
+        coarse grid as confidence
+
+    """
+    half_width = pyramid_factor//2 + 2
+    center = np.round(coarse_shift).astype(int)
+    window = correlation_window(H_obs, H_cat, center, half_width)
+    peak, peak_x_subpixel, peak_y_subpixel, signal = peak_in_correlation(window[1:-1, 1:-1])
+    x_shift = (center[0]-half_width+1 + peak[0]+peak_x_subpixel)*binwidth_dist
+    y_shift = (center[1]-half_width+1 + peak[1]+peak_y_subpixel)*binwidth_ang
+    return x_shift, y_shift, signal
+
+
+def scale_hypotheses(wcsprm, pixscale_range, step=None):
+    """Bank of scale factors for the wcs, so the pixel scales go from pixscale_range[0] to pixscale_range[1] in steps of the factor step.
+
+    Parameters
+    ----------
+    wcsprm
+        Wcsprm with the guessed pixel scale
+    pixscale_range : list
+        smallest and largest plausible pixel scale in arcsec/pixel
+    step : float
+        ratio of neighbouring pixel scales, default SCALE_HYPOTHESIS_STEP from settings
+
+    Returns
+    -------
+    scale_factors : array
+        factors for scale(wcsprm, factor)
+
+    """
+    if(step is None):
+        step = s.SCALE_HYPOTHESIS_STEP
+    guessed = np.sqrt(np.abs(np.linalg.det(wcsprm.get_pc()) * np.prod(wcsprm.get_cdelt())))*3600 #arcsec/pixel
+    n_hypotheses = int(np.ceil(np.log(pixscale_range[1]/pixscale_range[0])/np.log(step))) + 1
+    pixscales = pixscale_range[0] * step**np.arange(n_hypotheses)
+    return pixscales/guessed
+
+
+def peak_with_scale_hypotheses(log_distance_obs, angle_obs, log_distance_cat, angle_cat, scale_factors, n_bins_dist=None, n_bins_angle=None, pyramid_factor=None, catalog_pairs=None):
+    """Scale and rotation between the two sets if the pixel scale is unknown, searched for a bank of scale factors in one pass.
+
+    For each scale factor the catalog distances are shifted to the distances that factor predicts on the image, so the
+    histograms of all hypotheses are on the same grid as for a known pixel scale (from 8 pixels to the largest distance
+    on the image). The stack of histograms is correlated with the histogram of the image in one batched FFT on the coarse
+    grid (pyramid_factor). Each hypothesis only covers the shifts up to half the step to its neighbours, the one with
+    the most significant peak is refined at full resolution.
+
+    Parameters
+    ----------
+    log_distance_obs, angle_obs : array
+        pairs of the observations
+    log_distance_cat, angle_cat : array
+        pairs of the catalog sources, projected with the guessed wcs
+    scale_factors : array
+        hypotheses, see scale_hypotheses
+    n_bins_dist, n_bins_angle, pyramid_factor : int
+        see peak_with_cross_correlation
+    catalog_pairs : CatalogPairs
+        see peak_with_cross_correlation, the histograms and transforms of the hypotheses are then cached
+
+    Returns
+    -------
+    scaling, rotation : float
+    signal : float
+        height of the peak on the coarse grid in standard deviations of the correlation
+
+    """
+    if(n_bins_dist is None):
+        n_bins_dist = s.SCALE_ROTATION_BINS_DIST
+    if(n_bins_angle is None):
+        n_bins_angle = s.SCALE_ROTATION_BINS_ANGLE
+    if(pyramid_factor is None):
+        pyramid_factor = s.SCALE_ROTATION_PYRAMID_FACTOR
+    pyramid_factor = max(pyramid_factor, 1)
+    scale_factors = np.asarray(scale_factors, dtype=float)
+
+    bins_dist, binwidth_dist = np.linspace(np.log(8), distance_grid_maximum(log_distance_obs), n_bins_dist, retstep=True)
+    bins_ang, binwidth_ang = np.linspace(-np.pi, np.pi, n_bins_angle, retstep=True)
+    shape = (len(bins_dist)-1, len(bins_ang)-1)
+    coarse_shape = (-(-shape[0]//pyramid_factor), -(-shape[1]//pyramid_factor))
+
+    H_obs = histogram_uniform(log_distance_obs, angle_obs, bins_dist[0], binwidth_dist, shape[0], bins_ang[0], binwidth_ang, shape[1], out=histogram_buffer("obs", shape, float_type()))
+    H_obs_coarse = downsample_histogram(H_obs, pyramid_factor)
+
+    #a larger pixel scale makes all distances on the image shorter by the same factor, so the histogram of a hypothesis is
+    #the catalog histogram shifted by log(scale factor) (rounded to full resolution bins). One histogram covering all
+    #shifts is made, the coarse histograms of the hypotheses are differences of its cumulative sum
+    offsets = np.round(np.log(scale_factors)/binwidth_dist).astype(int)
+    first = offsets.min()
+    n_wide = coarse_shape[0]*pyramid_factor + offsets.max() - first
+
+    def catalog_spectrum():
+        #full resolution wide histogram (stored sparse, the best hypothesis is refined with it) and the transforms of the stack
+        if(catalog_pairs is not None):
+            log_distance, angle = catalog_pairs.pairs()
+        else:
+            log_distance, angle = log_distance_cat, angle_cat
+        H_wide = histogram_uniform(log_distance, angle, bins_dist[0]+first*binwidth_dist, binwidth_dist, n_wide,
+                                   bins_ang[0], binwidth_ang, shape[1])
+        spectrum = sparse_histogram(H_wide)
+        H_wide = np.pad(H_wide, ((0, 0), (0, coarse_shape[1]*pyramid_factor-shape[1])), 'constant')
+        H_wide = H_wide.reshape(n_wide, coarse_shape[1], pyramid_factor).sum(axis=2)
+        cumulative = np.zeros((n_wide+1, coarse_shape[1]), dtype=float_type())
+        np.cumsum(H_wide, axis=0, out=cumulative[1:])
+        edges = (offsets - first)[:, np.newaxis] + pyramid_factor*np.arange(coarse_shape[0]+1)
+        H_cat_stack = np.diff(cumulative[edges], axis=1)
+        #the distribution of the pair distances gives a broad ramp in the correlation that depends on how much the ranges
+        #overlap, without the mean over the angles of each distance bin only the pattern of the pairs is correlated
+        H_cat_stack -= np.mean(H_cat_stack, axis=2, keepdims=True)
+        spectrum["ff"] = histogram_stack_to_fourier_space(H_cat_stack)
+        return spectrum
+
+    if(catalog_pairs is not None):
+        key = catalog_pairs.key() + ("hypotheses", n_bins_dist, n_bins_angle, pyramid_factor, round(bins_dist[-1], 6), float_type().__name__, tuple(offsets.tolist()))
+        spectrum = cached_spectrum(key, catalog_spectrum)
+    else:
+        spectrum = catalog_spectrum()
+
+    H_obs_coarse = H_obs_coarse - np.mean(H_obs_coarse, axis=1, keepdims=True)
+    cross_corr = correlate_histogram_stack(H_obs_coarse, None, frequency_cut=0.02*pyramid_factor, ff_cat_stack=spectrum["ff"])
+
+    #each hypothesis only covers shifts up to half the distance to its neighbours, the rest is covered by the neighbours.
+    #The hypotheses are compared by the height of the peak in units of the scatter of their correlation
+    if(len(scale_factors) > 1):
+        spacing = np.max(np.diff(np.sort(offsets)))
+    else:
+        spacing = np.log(s.SCALE_HYPOTHESIS_STEP)/binwidth_dist
+    half_range = int(np.ceil(spacing/2/pyramid_factor)) + 1
+    middle = np.array(cross_corr.shape[1:])//2
+    rows = slice(max(middle[0]-half_range, 1), min(middle[0]+half_range+1, cross_corr.shape[1]-1))
+    best = None
+    for k in range(len(scale_factors)):
+        window = cross_corr[k, rows]
+        peak = np.array(np.unravel_index(np.argmax(window), window.shape)) + [rows.start, 0]
+        around_peak = np.take(cross_corr[k, peak[0]-1:peak[0]+2], [peak[1]-1, peak[1], peak[1]+1], axis=1, mode="clip")
+        scatter = np.std(cross_corr[k])
+        if(scatter == 0): #no catalog pairs within the distances on the image for this scale
+            continue
+        significance = (np.mean(around_peak) - np.median(cross_corr[k])) / scatter
+        if(best is None or significance > best[1]):
+            best = (k, significance, (peak - middle) * pyramid_factor)
+    if(best is None):
+        return 1., 0., 0.
+    k, significance, coarse_shift = best
+
+    H_cat = dense_histogram(spectrum, histogram_buffer("cat", shape, float_type()), first_row=offsets[k]-first)
+    x_shift, y_shift, _ = refine_peak(H_obs, H_cat, coarse_shift, pyramid_factor, binwidth_dist, binwidth_ang)
+    scaling = np.e**(offsets[k]*binwidth_dist - x_shift)
+    return scaling, y_shift, significance
+
+
 def scale(wcsprm, scale_factor):
     pc = wcsprm.get_pc()
     pc_scaled =scale_factor* pc
@@ -380,53 +1202,67 @@ def scale(wcsprm, scale_factor):
     return wcsprm
 
 
-def get_scaling_and_rotation(observation, catalog, wcsprm, scale_guessed, verbose=True, report_global={}): #INCREASE_FOV_FLAG=False
+def get_scaling_and_rotation(observation, catalog, wcsprm, scale_guessed, verbose=True, report_global={}, scale_factors=None, catalog_region=None): #INCREASE_FOV_FLAG=False
     """Calculate the scaling and rotation compared to the catalog based on the method of Kaiser et al. (1999).
 
     This should be quite similar to the approach by SCAMP.
 
     Parameters
     ----------
-    observation : dataframe
-        pandas dataframe with sources on the observation
-    catalog : dataframe
-        pandas dataframe with nearby sources from online catalogs with accurate astrometric information
+    observation : Detections or dataframe
+        sources on the observation
+    catalog : CatalogSources or dataframe
+        nearby sources from online catalogs with accurate astrometric information
     wcsprm
         Wcsprm file
     verbose : boolean
         Set to False to supress output to the console
+    scale_factors : array
+        If given, the pixel scale is searched with this bank of scale factors (see peak_with_scale_hypotheses) instead of
+        one wide histogram for a guessed scale
+    catalog_region : CatalogRegion
+        downloaded region the catalog was cut from. The catalog pairs are then made from the region, so frames cut
+        from it share them (see CatalogPairs). Not used for a guessed scale without scale_factors, the grid then
+        depends on the catalog pairs
 
 
     Returns
     -------
-    wcs, signal, report
+    wcs
+        scaled and rotated, unchanged if neither orientation gave a correlation peak
 
     """
-    catalog_on_sensor = wcsprm.s2p(catalog[["ra", "dec"]], 1)
-    catalog_on_sensor  = catalog_on_sensor['pixcrd']
-    obs_x = [observation["xcenter"].values]
-    cat_x = np.array( [catalog_on_sensor[:,0] ])
-    obs_y = [observation["ycenter"].values]
-    cat_y = np.array( [catalog_on_sensor[:,1] ])
+    observation = as_detections(observation)
+    obs_x = [observation.x]
+    obs_y = [observation.y]
 
     log_distances_obs = calculate_log_dist(obs_x, obs_y)
-    log_distances_cat = calculate_log_dist(cat_x, cat_y)
-
     angles_obs = calculate_angles(obs_x,obs_y)
-    angles_cat = calculate_angles(cat_x, cat_y)
+    #the catalog side only depends on the catalog and the wcs, it is cached for the frames of the same field
+    if(scale_guessed and scale_factors is None):
+        catalog_region = None
+    catalog_pairs = CatalogPairs(as_catalog(catalog), wcsprm, catalog_region)
 
 
-    scaling, rotation, signal = peak_with_cross_correlation(log_distances_obs, angles_obs, log_distances_cat, angles_cat, scale_guessed= scale_guessed)
-    scaling_reflected, rotation_reflected, signal_reflected =  peak_with_cross_correlation(log_distances_obs, -angles_obs, log_distances_cat, angles_cat, scale_guessed=scale_guessed)
+    if(scale_factors is not None):
+        scaling, rotation, signal = peak_with_scale_hypotheses(log_distances_obs, angles_obs, None, None, scale_factors, catalog_pairs=catalog_pairs)
+        scaling_reflected, rotation_reflected, signal_reflected = peak_with_scale_hypotheses(log_distances_obs, -angles_obs, None, None, scale_factors, catalog_pairs=catalog_pairs)
+    else:
+        scaling, rotation, signal = peak_with_cross_correlation(log_distances_obs, angles_obs, None, None, scale_guessed= scale_guessed, catalog_pairs=catalog_pairs)
+        scaling_reflected, rotation_reflected, signal_reflected =  peak_with_cross_correlation(log_distances_obs, -angles_obs, None, None, scale_guessed=scale_guessed, catalog_pairs=catalog_pairs)
 
+    if(max(signal, signal_reflected) <= 0):
+        #no catalog pairs in the distance range of the image or an empty correlation, a ratio would be inf or nan
+        print("Scale and rotation search failed: no correlation peak for either orientation, the wcs is not changed")
+        return wcsprm
     if(signal_reflected > signal):
         is_reflected = True
-        confidence = signal_reflected/signal
+        confidence = signal_reflected/signal if signal > 0 else np.inf
         scaling = scaling_reflected
         rotation = rotation_reflected
     else:
         is_reflected = False
-        confidence = signal/signal_reflected
+        confidence = signal/signal_reflected if signal_reflected > 0 else np.inf
 
     rot = rotation_matrix(rotation)
     if(is_reflected):
@@ -458,71 +1294,58 @@ def calculate_rms(observation, catalog, wcsprm):
     on_sky = wcsprm.p2s([[0,0],[1,1]], 0)["world"]
     px_scale = np.sqrt((on_sky[0,0]-on_sky[1,0])**2+(on_sky[0,1]-on_sky[1,1])**2)
     px_scale = px_scale*60*60 #in arcsec
-    obs_x, obs_y, cat_x, cat_y, distances = find_matches(observation, catalog, wcsprm, threshold=3)
-    rms = np.sqrt(np.mean(np.square(distances)))
-    print("Within 3  pixel or {:.3g} arcsec {} sources where matched. The rms is {:.3g} pixel or {:.3g} arcsec".format(px_scale*3, len(obs_x), rms, rms*px_scale))
-    obs_x, obs_y, cat_x, cat_y, distances = find_matches(observation, catalog, wcsprm, threshold=5)
-    rms = np.sqrt(np.mean(np.square(distances)))
-    print("Within 5  pixel or {:.3g} arcsec {} sources where matched. The rms is {:.3g} pixel or {:.3g} arcsec".format(px_scale*5,len(obs_x), rms, rms*px_scale))
-    obs_x, obs_y, cat_x, cat_y, distances = find_matches(observation, catalog, wcsprm, threshold=s.RMS_PX_THRESHOLD)
-    rms = np.sqrt(np.mean(np.square(distances)))
-    print("Within {} pixel or {:.3g} arcsec {} sources where matched. The rms is {:.3g} pixel or {:.3g} arcsec".format(s.RMS_PX_THRESHOLD, px_scale*s.RMS_PX_THRESHOLD,len(obs_x), rms, rms*px_scale))
+    #the nearest catalog source does not depend on the threshold, so it is only searched once
+    observation = as_detections(observation)
+    distances, _ = nearest_catalog_source(observation, as_catalog(catalog).on_sensor(wcsprm))
+    for threshold, label in [(3, "3 "), (5, "5 "), (s.RMS_PX_THRESHOLD, str(s.RMS_PX_THRESHOLD))]:
+        matched = distances[distances < threshold]
+        rms = np.sqrt(np.mean(np.square(matched)))
+        print("Within {} pixel or {:.3g} arcsec {} sources where matched. The rms is {:.3g} pixel or {:.3g} arcsec".format(label, px_scale*threshold, len(matched), rms, rms*px_scale))
 
 
-def find_matches_keep_catalog_info(observation, catalog, wcsprm, threshold=5):
-    catalog_on_sensor = wcsprm.s2p(catalog[["ra", "dec"]], 1)
-    catalog_on_sensor  = catalog_on_sensor['pixcrd']
-    obs_x = [observation["xcenter"].values]
-    cat_x = np.array( [catalog_on_sensor[:,0] ])
-    obs_y = [observation["ycenter"].values]
-    cat_y = np.array( [catalog_on_sensor[:,1] ])
+def nearest_catalog_source(observation, catalog_on_sensor):
+    """Squared distance to and index of the closest catalog source for each detected source.
+
+    Parameters
+    ----------
+    observation : Detections
+    catalog_on_sensor : array
+        (n, 2) pixel positions of the catalog sources
 
-    distances_x =  (obs_x - cat_x.T)#.flatten()
-    distances_y =  (obs_y - cat_y.T)#.flatten()
-    obs_x = obs_x[0]
-    obs_y = obs_y[0]
-    cat_x = cat_x[0]
-    cat_y = cat_y[0]
+    """
+    if(len(catalog_on_sensor) == 0):
+        return np.full(len(observation), np.inf), np.zeros(len(observation), dtype=int)
+    distances_x =  (observation.x.astype(float_type())[np.newaxis, :] - catalog_on_sensor[:,0].astype(float_type())[:, np.newaxis])
+    distances_y =  (observation.y.astype(float_type())[np.newaxis, :] - catalog_on_sensor[:,1].astype(float_type())[:, np.newaxis])
+    squared = distances_x**2 + distances_y**2
+    matches = np.argmin(squared, axis=0)
+    distances = squared[matches, np.arange(squared.shape[1])]
+    return distances, matches
 
 
-    #find closest points to each source in observaion
-    distances = np.min(distances_x**2 + distances_y**2, axis=0)
-    matches = np.argmin(distances_x**2 + distances_y**2, axis=0)
+def find_matches_keep_catalog_info(observation, catalog, wcsprm, threshold=5):
+    """Like find_matches, but returns the matched rows of the dataframes (observation and catalog have to be dataframes)."""
+    detections = as_detections(observation)
+    distances, matches = nearest_catalog_source(detections, as_catalog(catalog).on_sensor(wcsprm))
 
     #search for all matches within threshold
     obs_matched = observation.iloc[distances<threshold]
-    #obs_y = obs_y[distances<threshold]
     cat_matched = catalog.iloc[matches[distances<threshold]]
-    #cat_y = cat_y[matches[distances<threshold]]
     distances = distances[distances < threshold]
     return obs_matched, cat_matched, distances
 
 def find_matches(observation, catalog, wcsprm, threshold=5):
-    catalog_on_sensor = wcsprm.s2p(catalog[["ra", "dec"]], 1)
-    catalog_on_sensor  = catalog_on_sensor['pixcrd']
-    #catalog_on_sensor[:,1]
-    obs_x = [observation["xcenter"].values]
-    cat_x = np.array( [catalog_on_sensor[:,0] ])
-    obs_y = [observation["ycenter"].values]
-    cat_y = np.array( [catalog_on_sensor[:,1] ])
-
-    distances_x =  (obs_x - cat_x.T)#.flatten()
-    distances_y =  (obs_y - cat_y.T)#.flatten()
-    obs_x = obs_x[0]
-    obs_y = obs_y[0]
-    cat_x = cat_x[0]
-    cat_y = cat_y[0]
-
+    observation = as_detections(observation)
+    catalog_on_sensor = as_catalog(catalog).on_sensor(wcsprm)
 
     #find closest points to each source in observaion
-    distances = np.min(distances_x**2 + distances_y**2, axis=0)
-    matches = np.argmin(distances_x**2 + distances_y**2, axis=0)
+    distances, matches = nearest_catalog_source(observation, catalog_on_sensor)
 
     #search for all matches within threshold
-    obs_x = obs_x[distances<threshold]
-    obs_y = obs_y[distances<threshold]
-    cat_x = cat_x[matches[distances<threshold]]
-    cat_y = cat_y[matches[distances<threshold]]
+    obs_x = observation.x[distances<threshold]
+    obs_y = observation.y[distances<threshold]
+    cat_x = catalog_on_sensor[matches[distances<threshold], 0]
+    cat_y = catalog_on_sensor[matches[distances<threshold], 1]
     distances = distances[distances < threshold]
     return obs_x, obs_y, cat_x, cat_y, distances
 
@@ -536,10 +1359,10 @@ def fine_transformation(observation, catalog, wcsprm, threshold=1, verbose=True)
 
     Parameters
     ----------
-    observation : dataframe
-        pandas dataframe with sources on the observation
-    catalog : dataframe
-        pandas dataframe with nearby sources from online catalogs with accurate astrometric information
+    observation : Detections or dataframe
+        sources on the observation
+    catalog : CatalogSources or dataframe
+        nearby sources from online catalogs with accurate astrometric information
     wcsprm
         Wcsprm file
     threshold : float
@@ -555,8 +1378,10 @@ def fine_transformation(observation, catalog, wcsprm, threshold=1, verbose=True)
     wcsprm_original = wcsprm
     wcsprm = copy.copy(wcsprm)
 
+    observation = as_detections(observation)
+    catalog = as_catalog(catalog)
     if(threshold == 20):
-        observation = observation.nlargest(5, "aperture_sum")
+        observation = observation.brightest(5)
         #print("using 5 brightest sources")
     obs_x, obs_y, cat_x, cat_y, _ = find_matches(observation, catalog, wcsprm, threshold=threshold)
     if(len(obs_x)<4):
@@ -0,0 +1,242 @@
+"""Reading and writing the image of a fits file, plain or tile compressed, and writing only its WCS.
+
+Archives often keep frames as tile compressed fits (CompImageHDU, e.g. RICE_1).
+The image is then not in the primary HDU but in the first extension, and
+reading hdul[0].data gives nothing. The functions here find the image HDU in
+both cases. Parts of the image are read through hdu.section, for compressed
+images only the tiles overlapping the requested region are decompressed.
+
+Instead of a full copy of the frame, the WCS can be written to a sidecar file
+(<name>.wcs or <name>.head) or into the header of the frame itself.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+import settings as s
+
+
+def image_hdu_index(hdul):
+    """Index of the first HDU with a 2d image (primary, image extension or compressed image).
+
+    Files opened with disable_image_compression=True show compressed images as binary tables (ZIMAGE = T),
+    these count as images as well.
+    """
+    for i, hdu in enumerate(hdul):
+        if(isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)) and hdu.header.get("NAXIS", 0) == 2):
+            return i
+        if(_is_compressed_table(hdu)):
+            return i
+    raise ValueError("no 2d image found in {}".format(hdul.filename()))
+
+
+def image_hdu(hdul):
+    """The HDU with the image, see image_hdu_index."""
+    return hdul[image_hdu_index(hdul)]
+
+
+def _is_compressed_table(hdu):
+    return isinstance(hdu, fits.BinTableHDU) and hdu.header.get("ZIMAGE", False) and hdu.header.get("ZNAXIS", 0) == 2
+
+
+def is_compressed(hdu):
+    return isinstance(hdu, fits.CompImageHDU) or _is_compressed_table(hdu)
+
+
+def image_header(filename):
+    """Header of the image HDU, without reading any pixel data."""
+    with fits.open(filename) as hdul:
+        return image_hdu(hdul).header.copy()
+
+
+def vignette_box(shape, vignette):
+    """Rows and columns (y0, y1, x0, x1) covering the vignette circle of astrometry.find_sources, the whole image for vignette >= 1."""
+    ny, nx = shape
+    sidelength = max(shape)
+    radius = vignette * sidelength/2
+    center = sidelength/2
+    y0 = int(np.clip(np.floor(center-radius), 0, ny))
+    y1 = int(np.clip(np.ceil(center+radius)+1, 0, ny))
+    x0 = int(np.clip(np.floor(center-radius), 0, nx))
+    x1 = int(np.clip(np.ceil(center+radius)+1, 0, nx))
+    return y0, y1, x0, x1
+
+
+def read_pixels(hdu, box=None):
+    """Pixel data of the image HDU.
+
+    Parameters
+    ----------
+    hdu : PrimaryHDU, ImageHDU or CompImageHDU
+    box : tuple
+        (y0, y1, x0, x1) to only read this part of the image. For compressed images only the tiles
+        overlapping the box are decompressed. None reads the whole image
+
+    Returns
+    -------
+    data : array
+
+    """
+    if(box is None):
+        return hdu.data
+    y0, y1, x0, x1 = box
+    return hdu.section[y0:y1, x0:x1]
+
+
+def is_lossy_compression(data):
+    """True if compress changes the pixel values: float images with OUTPUT_QUANTIZE_LEVEL set in settings.py."""
+    return np.issubdtype(data.dtype, np.floating) and s.OUTPUT_QUANTIZE_LEVEL is not None
+
+
+def compress(hdu, compression_type):
+    """Tile compressed copy of an image HDU (header and data).
+
+    Float images are compressed without loss by default. Only GZIP can store them unquantized, so other compression
+    types are replaced by GZIP_2 for them. With OUTPUT_QUANTIZE_LEVEL in settings.py they are quantized instead
+    (lossy, as usual for RICE_1) and keep the requested compression type.
+    """
+    header = hdu.header.copy()
+    for keyword in ["SIMPLE", "EXTEND", "XTENSION", "PCOUNT", "GCOUNT"]:
+        header.remove(keyword, ignore_missing=True)
+    quantize_level = s.OUTPUT_QUANTIZE_LEVEL
+    if(np.issubdtype(hdu.data.dtype, np.floating) and quantize_level is None):
+        #quantize_level 0 stores the floats as they are, which only the GZIP algorithms support
+        quantize_level = 0
+        if(not compression_type.startswith("GZIP")):
+            print("{} would round the float image, using GZIP_2 instead (set OUTPUT_QUANTIZE_LEVEL for lossy compression)".format(compression_type))
+            compression_type = "GZIP_2"
+    if(quantize_level is None):
+        #integer images are never quantized
+        quantize_level = 16
+    return fits.CompImageHDU(data=hdu.data, header=header, compression_type=compression_type,
+                             quantize_level=quantize_level)
+
+
+def update_wcs(header, wcs_header):
+    """Replace the WCS cards of header by wcs_header. CD and PC matrices are removed first, so the old scaling does not survive."""
+    for old_parameter in ['CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', "PC1_1", "PC1_2", "PC2_1", "PC2_2"]:
+        if (old_parameter in header):
+            del header[old_parameter]
+    header.update(wcs_header)
+    return header
+
+
+def sidecar_filename(filename, kind):
+    """<name>.wcs (fits file with the WCS in the primary header) or <name>.head (text header as used by SCAMP and SWarp)."""
+    return filename.rsplit('.', 1)[0]+"."+kind
+
+
+def write_atomic(filename, write):
+    """Call write(temporary_filename) and move the result to filename, so readers never see a half written file."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    handle, temporary = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+    os.close(handle)
+    #mkstemp only allows the owner to read, use the permissions of the replaced file or the default ones
+    if(os.path.exists(filename)):
+        shutil.copymode(filename, temporary)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temporary, 0o666 & ~umask)
+    try:
+        write(temporary)
+        os.replace(temporary, filename)
+    except BaseException:
+        if(os.path.exists(temporary)):
+            os.remove(temporary)
+        raise
+
+
+def write_wcs_sidecar(filename, wcs_header, shape, extra_hdus=[]):
+    """Write the WCS (and the extensions like the detection table) to <name>.wcs next to the frame."""
+    primary = fits.PrimaryHDU()
+    primary.header.update(wcs_header)
+    primary.header["IMAGEW"] = (shape[1], "image width in pixel")
+    primary.header["IMAGEH"] = (shape[0], "image height in pixel")
+    hdul = fits.HDUList([primary]+list(extra_hdus))
+    sidecar = sidecar_filename(filename, "wcs")
+    write_atomic(sidecar, lambda temporary: hdul.writeto(temporary, overwrite=True))
+    return sidecar
+
+
+def write_head_sidecar(filename, wcs_header):
+    """Write the WCS cards as text header <name>.head next to the frame."""
+    sidecar = sidecar_filename(filename, "head")
+    def write(temporary):
+        with open(temporary, "w") as f:
+            f.write(wcs_header.tostring(sep="\n", endcard=True, padding=False)+"\n")
+    write_atomic(sidecar, write)
+    return sidecar
+
+
+def read_sidecar(filename):
+    """WCS header from <name>.wcs or <name>.head, whichever exists (.wcs first).
+
+    Returns
+    -------
+    wcs_header : Header or None
+    sidecar : str or None
+        filename of the sidecar, for .wcs files the extensions (detections, catalog) can be read from it
+
+    """
+    sidecar = sidecar_filename(filename, "wcs")
+    if(os.path.exists(sidecar)):
+        header = fits.getheader(sidecar)
+        for keyword in ["SIMPLE", "BITPIX", "NAXIS", "EXTEND", "IMAGEW", "IMAGEH"]:
+            header.remove(keyword, ignore_missing=True)
+        return header, sidecar
+    sidecar = sidecar_filename(filename, "head")
+    if(os.path.exists(sidecar)):
+        return fits.Header.fromtextfile(sidecar, endcard=True), sidecar
+    return None, None
+
+
+def update_header_in_place(filename, wcs_header):
+    """Write the new WCS into the header of the image HDU of the file itself.
+
+    The file is always replaced atomically (write_atomic), so readers and crashes never see a partly written header.
+    If the new header fits into the header blocks the file already has (cards removed and blank cards make room),
+    the file is copied byte for byte and only these blocks are overwritten in the copy. Otherwise the HDUs are written
+    to the temporary file again. Compressed images are updated in the header of their binary table, the tiles are
+    never recompressed.
+
+    Returns
+    -------
+    in_place : bool
+        True if the header fit into the existing header blocks, False if the HDUs had to be written again
+
+    """
+    with fits.open(filename, disable_image_compression=True) as hdul:
+        index = image_hdu_index(hdul)
+        header = update_wcs(hdul[index].header.copy(), wcs_header)
+        location = hdul.fileinfo(index)
+        available = location["datLoc"] - location["hdrLoc"]
+
+        #blank cards before END fill the reserved space, the data has to start at the same offset
+        cards = "".join(card.image for card in header.cards if card.image.strip() != "")
+        if(len(cards) + 80 <= available):
+            block = cards + " "*(available - len(cards) - 80) + "END".ljust(80)
+            def write(temporary):
+                shutil.copyfile(filename, temporary)
+                with open(temporary, "r+b") as f:
+                    f.seek(location["hdrLoc"])
+                    f.write(block.encode("ascii"))
+                    f.flush()
+                    os.fsync(f.fileno())
+            write_atomic(filename, write)
+            return True
+
+        hdul[index].header = header
+        write_atomic(filename, lambda temporary: hdul.writeto(temporary, overwrite=True))
+    return False
@@ -0,0 +1,420 @@
+"""Job queue for running astrometry and photometry on many nodes.
+
+The queue is a SQLite database, put it on storage that all nodes can reach.
+astrometry and photometry submit their frames with -queue, workers pull the
+frame jobs from the queue. A worker holds a lease on its job and renews it with
+heartbeats while it works. A job whose lease runs out (worker crashed or node
+lost) is handed to the next worker, failed jobs are retried up to
+QUEUE_MAX_ATTEMPTS times. A worker that lost its lease does not write the
+output of the job. Results are stored with the job.
+
+Frames of one field are submitted with the catalog region of their group. A
+worker keeps taking jobs of the region it worked on last and otherwise prefers
+regions no other worker is on, so each region is downloaded by one worker.
+
+Start workers on every node with
+    python job_queue.py queue.sqlite -workers 8
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from datetime import datetime
+from argparse import ArgumentParser, Namespace
+
+import pandas as pd
+
+import settings as s
+
+
+COLUMNS = ["id", "kind", "filename", "status", "attempts", "worker", "lease_until", "heartbeat",
+           "submitted", "started", "finished", "seconds", "result", "error", "arguments", "region"]
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _region_text(region):
+    """Catalog region [ra, dec, radius] as stored in the queue."""
+    if(region is None):
+        return None
+    return json.dumps([float(value) for value in region])
+
+
+class LeaseLost(Exception):
+    """The job was handed to another worker, its output must not be written."""
+
+
+class JobQueue:
+    """Queue database of frame jobs.
+
+    Parameters
+    ----------
+    filename : str
+        SQLite file, created if it does not exist
+    lease_seconds : float
+        A running job is handed to another worker if there was no heartbeat for this long, default QUEUE_LEASE_SECONDS from settings
+    max_attempts : int
+        Jobs that failed this often are not tried again, default QUEUE_MAX_ATTEMPTS from settings
+
+    """
+
+    def __init__(self, filename, lease_seconds=None, max_attempts=None):
+        if(lease_seconds is None):
+            lease_seconds = s.QUEUE_LEASE_SECONDS
+        if(max_attempts is None):
+            max_attempts = s.QUEUE_MAX_ATTEMPTS
+        self.filename = filename
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        #autocommit, transactions are started explicitly where several statements have to be atomic
+        self.connection = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, filename TEXT NOT NULL, arguments TEXT NOT NULL,
+            status TEXT NOT NULL, attempts INTEGER DEFAULT 0, worker TEXT, lease_until REAL, heartbeat TEXT,
+            submitted TEXT, started TEXT, finished TEXT, seconds REAL, result TEXT, error TEXT, region TEXT,
+            UNIQUE (kind, filename, arguments))""")
+        #queues created before the catalog region was stored with the jobs
+        if("region" not in [row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")]):
+            try:
+                self.connection.execute("ALTER TABLE jobs ADD COLUMN region TEXT")
+            except sqlite3.OperationalError:
+                #another worker added it at the same time
+                pass
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_region ON jobs (region, status, id)")
+
+    def submit(self, kind, filenames, args, region=None):
+        """Add a job per file. Jobs with the same kind, file and arguments that are already in the queue are not added again.
+
+        Parameters
+        ----------
+        kind : str
+            'astrometry' or 'photometry'
+        filenames : list
+            fits files, jobs are handed out in this order
+        args
+            parsed command line arguments, used by the worker for every file
+        region : list, optional
+            catalog region [ra, dec, radius] in deg shared by the files (see batch_schedule.FrameCluster.region),
+            the worker downloads it before the job. Not part of the job identity.
+
+        Returns
+        -------
+        n_new : int
+            number of jobs added
+
+        """
+        arguments = json.dumps({name: value for name, value in vars(args).items() if name not in ["input", "queue"]}, sort_keys=True, default=str)
+        region = _region_text(region)
+        submitted = _now()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            n_before = self.connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            self.connection.executemany("""INSERT OR IGNORE INTO jobs (kind, filename, arguments, status, submitted, region)
+                VALUES (?, ?, ?, 'queued', ?, ?)""", [(kind, os.path.abspath(filename), arguments, submitted, region) for filename in filenames])
+            n_after = self.connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return n_after - n_before
+
+    def claim(self, worker, region=None):
+        """Take the next job: a queued one or a running one whose lease ran out.
+
+        Jobs of the given catalog region come first, then jobs of regions no other worker is working on, so the
+        frames of a group stay on one worker and its region is only downloaded there.
+
+        Parameters
+        ----------
+        worker : str
+            name of the worker
+        region : list, optional
+            catalog region of the last job of the worker
+
+        Returns
+        -------
+        job : dict or None
+            id, kind, filename, region and arguments (Namespace, with the catalog region of the job as cluster_region),
+            None if there is nothing to do right now
+
+        """
+        now = time.time()
+        available = "(status='queued' OR (status='running' AND lease_until<?))"
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            #jobs whose worker vanished on the last allowed attempt are not tried again
+            self.connection.execute("""UPDATE jobs SET status='failed', finished=?, error='lease expired'
+                WHERE status='running' AND lease_until<? AND attempts>=?""", (_now(), now, self.max_attempts))
+            row = None
+            if(region is not None):
+                row = self.connection.execute("""SELECT id, kind, filename, arguments, region FROM jobs
+                    WHERE region=? AND {} ORDER BY id LIMIT 1""".format(available), (_region_text(region), now)).fetchone()
+            if(row is None):
+                row = self.connection.execute("""SELECT id, kind, filename, arguments, region FROM jobs
+                    WHERE {} AND (region IS NULL OR region NOT IN
+                        (SELECT region FROM jobs WHERE status='running' AND lease_until>=? AND region IS NOT NULL))
+                    ORDER BY id LIMIT 1""".format(available), (now, now)).fetchone()
+            if(row is None):
+                row = self.connection.execute("""SELECT id, kind, filename, arguments, region FROM jobs
+                    WHERE {} ORDER BY id LIMIT 1""".format(available), (now,)).fetchone()
+            if(row is not None):
+                self.connection.execute("""UPDATE jobs SET status='running', worker=?, attempts=attempts+1, lease_until=?,
+                    heartbeat=?, started=?, finished=NULL WHERE id=?""", (worker, now+self.lease_seconds, _now(), _now(), row[0]))
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        if(row is None):
+            return None
+        arguments = Namespace(**json.loads(row[3]))
+        arguments.cluster_region = json.loads(row[4]) if row[4] is not None else None
+        return {"id": row[0], "kind": row[1], "filename": row[2], "region": arguments.cluster_region, "arguments": arguments}
+
+    def heartbeat(self, job_id, worker):
+        """Renew the lease. Returns False if the job was handed to another worker in the meantime."""
+        cursor = self.connection.execute("UPDATE jobs SET lease_until=?, heartbeat=? WHERE id=? AND worker=? AND status='running'",
+                                         (time.time()+self.lease_seconds, _now(), job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, seconds, result=None):
+        """Store the result of a finished job. Returns False if the lease was lost and the result is discarded."""
+        cursor = self.connection.execute("""UPDATE jobs SET status='done', finished=?, seconds=?, result=?, error=NULL, lease_until=NULL
+            WHERE id=? AND worker=? AND status='running'""", (_now(), seconds, json.dumps(result, default=str), job_id, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, seconds, error):
+        """A failed job is queued again until it used up its attempts."""
+        cursor = self.connection.execute("""UPDATE jobs SET status=CASE WHEN attempts<? THEN 'queued' ELSE 'failed' END,
+            finished=?, seconds=?, error=?, lease_until=NULL WHERE id=? AND worker=? AND status='running'""",
+                                         (self.max_attempts, _now(), seconds, error, job_id, worker))
+        return cursor.rowcount == 1
+
+    def counts(self):
+        """Number of jobs per status."""
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def query(self, kind=None, status=None):
+        """Jobs as dataframe, optionally only of the given kind and status."""
+        sql = "SELECT {} FROM jobs WHERE 1=1".format(", ".join(COLUMNS))
+        parameters = []
+        if(kind is not None):
+            sql = sql + " AND kind=?"
+            parameters.append(kind)
+        if(status is not None):
+            sql = sql + " AND status=?"
+            parameters.append(status)
+        return pd.read_sql_query(sql + " ORDER BY id", self.connection, params=parameters)
+
+    def reset(self, status="failed"):
+        """Queue the jobs with the given status again with fresh attempts."""
+        cursor = self.connection.execute("UPDATE jobs SET status='queued', attempts=0, error=NULL WHERE status=?", (status,))
+        return cursor.rowcount
+
+    def close(self):
+        self.connection.close()
+
+
+class Heartbeat:
+    """Renews the lease of a job in a background thread while the job is running.
+
+    The thread uses its own connection, sqlite connections can not be shared between threads. The job calls check
+    before it writes its output.
+    """
+
+    def __init__(self, queue_filename, job_id, worker, interval=None):
+        if(interval is None):
+            interval = s.QUEUE_HEARTBEAT_SECONDS
+        self.queue_filename = queue_filename
+        self.job_id = job_id
+        self.worker = worker
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        queue = JobQueue(self.queue_filename)
+        try:
+            while(not self._stop.wait(self.interval)):
+                try:
+                    if(not queue.heartbeat(self.job_id, self.worker)):
+                        print("Lost the lease of job {}, another worker took it over".format(self.job_id))
+                        self.lost = True
+                        return
+                except sqlite3.OperationalError as e:
+                    print("Heartbeat of job {} failed ({!r}), trying again".format(self.job_id, e))
+        finally:
+            queue.close()
+
+    def check(self):
+        """Renew the lease now, raises LeaseLost if the job was handed to another worker.
+
+        After a successful check the job holds the lease for another lease time, enough to write its output.
+        """
+        if(not self.lost):
+            queue = JobQueue(self.queue_filename)
+            try:
+                self.lost = not queue.heartbeat(self.job_id, self.worker)
+            finally:
+                queue.close()
+        if(self.lost):
+            raise LeaseLost("job {} was handed to another worker".format(self.job_id))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def _run_astrometry(filename, args):
+    import astrometry
+    return astrometry.run_job(filename, args)
+
+
+def _run_photometry(filename, args):
+    import photometry
+    return photometry.run_job(filename, args)
+
+
+#kind of job -> function(filename, args) that returns the result. Before writing files it calls args.lease_check(), which raises LeaseLost if the job went to another worker
+HANDLERS = {"astrometry": _run_astrometry, "photometry": _run_photometry}
+
+
+def work(queue_filename, worker=None, max_jobs=None):
+    """Take jobs from the queue until it is drained.
+
+    A worker waits while other workers still hold jobs, since their leases may run out and the jobs come back.
+
+    Parameters
+    ----------
+    queue_filename : str
+        SQLite queue
+    worker : str
+        name of the worker, default host:pid
+    max_jobs : int
+        stop after this many jobs, default no limit
+
+    Returns
+    -------
+    n_jobs : int
+        number of jobs this worker ran
+
+    """
+    if(worker is None):
+        worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    queue = JobQueue(queue_filename)
+    n_jobs = 0
+    region = None
+    try:
+        while(max_jobs is None or n_jobs < max_jobs):
+            job = queue.claim(worker, region)
+            if(job is None):
+                if(queue.counts().get("running", 0) == 0):
+                    break
+                time.sleep(s.QUEUE_POLL_SECONDS)
+                continue
+            n_jobs = n_jobs + 1
+            region = job["region"]
+            print("Worker {} runs job {} ({} {})".format(worker, job["id"], job["kind"], job["filename"]))
+            start_time = time.time()
+            try:
+                with Heartbeat(queue_filename, job["id"], worker) as heartbeat:
+                    #the handler calls it before writing the output
+                    job["arguments"].lease_check = heartbeat.check
+                    result = HANDLERS[job["kind"]](job["filename"], job["arguments"])
+            except LeaseLost:
+                print("Job {} was taken over by another worker, stopped it before writing the output".format(job["id"]))
+                continue
+            except Exception as e:
+                traceback.print_exc()
+                print("Job {} failed: {!r}".format(job["id"], e))
+                queue.fail(job["id"], worker, time.time()-start_time, repr(e))
+                continue
+            if(not queue.complete(job["id"], worker, time.time()-start_time, result)):
+                print("Job {} was taken over by another worker, its result is discarded".format(job["id"]))
+    finally:
+        queue.close()
+    print("Worker {} finished after {} jobs".format(worker, n_jobs))
+    return n_jobs
+
+
+def run_workers(queue_filename, n_workers, max_jobs=None):
+    """Start local worker processes and wait until the queue is drained."""
+    if(n_workers <= 1):
+        return work(queue_filename, max_jobs=max_jobs)
+    host = socket.gethostname()
+    processes = [multiprocessing.Process(target=work, args=(queue_filename, "{}:{}:{}".format(host, os.getpid(), i), max_jobs))
+                 for i in range(n_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def parseArguments():
+    # Create argument parser
+    parser = ArgumentParser()
+    parser.add_argument("queue", help="SQLite queue, filled by astrometry or photometry with -queue", type=str)
+    parser.add_argument("-workers", "--workers", help="Number of local worker processes. Default 0: only show the status of the queue", type=int, default=0)
+    parser.add_argument("-max_jobs", "--max_jobs", help="Each worker stops after this many jobs", type=int, default=None)
+    parser.add_argument("-status", "--status", help="Only show jobs with this status (queued, running, done or failed)", type=str, default=None)
+    parser.add_argument("-kind", "--kind", help="Only show jobs of this kind (astrometry or photometry)", type=str, default=None)
+    parser.add_argument("-retry", "--retry", help="Set True to queue the failed jobs again", type=bool, default=False)
+    parser.add_argument("-o", "--output", help="Write the measurements of the finished photometry jobs to this table", type=str, default=None)
+    return parser.parse_args()
+
+
+def main():
+    """Run workers on a queue or show its status."""
+    args = parseArguments()
+    if(not os.path.exists(args.queue)):
+        print("ERROR: queue {} not found".format(args.queue))
+        return
+    if(args.retry):
+        queue = JobQueue(args.queue)
+        print("Queued {} failed jobs again".format(queue.reset("failed")))
+        queue.close()
+
+    if(args.workers > 0):
+        StartTime = datetime.now()
+        run_workers(args.queue, args.workers, args.max_jobs)
+        print("overall time taken")
+        print(datetime.now()-StartTime)
+
+    queue = JobQueue(args.queue)
+    jobs = queue.query(args.kind, args.status)
+    queue.close()
+    columns = ["id", "kind", "filename", "status", "attempts", "worker", "seconds", "finished", "error"]
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        print(jobs[columns])
+    print("")
+    print(jobs["status"].value_counts().to_string())
+
+    if(args.output is not None):
+        photometry_jobs = jobs[(jobs["kind"] == "photometry") & (jobs["status"] == "done")]
+        results = [pd.DataFrame(json.loads(result)["measurements"]) for result in photometry_jobs["result"]]
+        results = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+        results.to_csv(args.output, index=False)
+        print("Wrote {} measurements to {}".format(results.shape[0], args.output))
+
+
+if __name__ == '__main__':
+    main()
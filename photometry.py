@@ -18,22 +18,31 @@ import matplotlib.pyplot as plt
 # from sklearn.externals import joblib ##load pkl (pickle) file
 #
 from datetime import datetime
+import functools
+import multiprocessing
 #
 # #for parsing the arguments for the file
 from argparse import ArgumentParser
 
 import get_catalog_data as query
 import get_transformation as register
+import detection_table
+import job_queue
+import diagnostics
+import image_io
+import profiling
 import settings as s
+from aperture_sums import ApertureEngine
 
 #
 import astropy.units as u
 from astropy.io import fits
 from astropy.coordinates import SkyCoord
+from astropy.time import Time
 
 #import photutils
 from photutils import DAOStarFinder
-from photutils import aperture_photometry, CircularAperture
+from photutils import CircularAperture
 #from astropy.stats import mad_std
 from astropy.stats import sigma_clipped_stats
 from matplotlib.colors import LogNorm
@@ -43,6 +52,7 @@ from astropy.wcs import Wcsprm
 
 
 from astropy.table import Table
+from scipy.spatial import cKDTree
 
 import warnings
 import os
@@ -56,7 +66,7 @@ photometry r_eduardo_3_pisco_J_astro.fits -b J -name eduardo_3
 
 
 
-def find_sources(image, aperture):
+def find_sources(image, aperture, engine=None):
     """Find surces in the image. Uses DAOStarFinder with symmetric gaussian kernels. Only uses 5 sigma detections. It only gives the 200 brightest sources or less.
 
     Parameters
@@ -65,6 +75,8 @@ def find_sources(image, aperture):
         Observed image (without background)
     aperture : float
         aperture in pixel
+    engine : ApertureEngine
+        aperture sums for this image, created if not given
 
 
     Returns
@@ -79,26 +91,766 @@ def find_sources(image, aperture):
     #sigma = np.std(image)
     #print(bkg_sigma)
     #print(std)
-    daofind = DAOStarFinder(fwhm=4., threshold=5.*std, brightest=200)
+    #same settings as in astrometry.py so the detections stored by astrometry can be reused
+    daofind = DAOStarFinder(fwhm=s.FWHM, threshold=s.DETECTION_SIGMA_THRESHOLD *std, brightest=s.N_BRIGHTEST_SOURCES)
+    if(s.DETECTION_ABSOLUTE_THRESHOLD is not None):
+        daofind = DAOStarFinder(fwhm=s.FWHM, threshold=s.DETECTION_ABSOLUTE_THRESHOLD, brightest=s.N_BRIGHTEST_SOURCES)
     sources = daofind(image)
     for col in sources.colnames:
         sources[col].info.format = '%.8g'  # for consistent table output
     #print(sources)
 
-    positions = (sources['xcentroid'], sources['ycentroid'])
-    apertures = CircularAperture(positions, r=aperture)
-    phot_table = aperture_photometry(image, apertures)
-    for col in phot_table.colnames:
-        phot_table[col].info.format = '%.8g'  # for consistent table output
-    #print(phot_table)
-
-    observation = Table(phot_table).to_pandas()
+    if(engine is None):
+        engine = ApertureEngine(image)
+    observation = pd.DataFrame({"id": np.arange(1, len(sources)+1),
+                                "xcenter": np.array(sources['xcentroid']),
+                                "ycenter": np.array(sources['ycentroid'])})
+    observation["aperture_sum"] = engine.sum_circular(observation["xcenter"].values, observation["ycenter"].values, aperture)
 
     #through out candidates where the star finder messed up
     observation = observation.query("aperture_sum > "+str(5*std))
     return  observation
 
 
+def reuse_sources(image, aperture, stored_observation, stored_aperture, engine=None):
+    """Use the detections stored by astrometry instead of running the detection again.
+
+    Only the aperture sums are recalculated and only if the aperture differs from the stored one.
+
+    Parameters
+    ----------
+    image
+        Observed image (without background)
+    aperture : float
+        aperture in pixel
+    stored_observation : dataframe
+        Detections read from the _astro.fits file
+    stored_aperture : float
+        aperture in pixel used for the stored aperture_sum
+    engine : ApertureEngine
+        aperture sums for this image, created if not given
+
+    Returns
+    -------
+    observaion : dataframe
+        Pandas dataframe with the sources
+
+    """
+    print("Reusing {} sources detected by astrometry".format(stored_observation.shape[0]))
+    observation = stored_observation.copy()
+    if(stored_aperture is not None and np.isclose(stored_aperture, aperture)):
+        return observation
+    mean, median, std = sigma_clipped_stats(image, sigma=3.0)
+    if(engine is None):
+        engine = ApertureEngine(image)
+    observation["aperture_sum"] = engine.sum_circular(observation["xcenter"].values, observation["ycenter"].values, aperture)
+    observation = observation.query("aperture_sum > "+str(5*std))
+    return observation
+
+
+def load_targets(filename):
+    """Read a target list and build a spatial index for it. The list is only read once per run.
+
+    Parameters
+    ----------
+    filename : str
+        csv file with NAME, RA, DEC columns, RA and DEC in degrees
+
+    Returns
+    -------
+    targets : dataframe
+        Pandas dataframe with the targets
+    index : cKDTree
+        KD-tree on the unit vectors of the target positions
+
+    """
+    targets = pd.read_csv(filename)
+    ra = np.radians(targets["RA"].values.astype(float))
+    dec = np.radians(targets["DEC"].values.astype(float))
+    unit_vectors = np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+    index = cKDTree(unit_vectors)
+    print("Loaded {} targets from {}".format(targets.shape[0], filename))
+    return targets, index
+
+
+def targets_in_footprint(targets, index, wcsprm, shape, border=0):
+    """Find all targets inside the footprint of the image.
+
+    The KD-tree gives the candidates within the circle around the image center, the exact check is done in pixel space.
+
+    Parameters
+    ----------
+    targets : dataframe
+        Targets as returned by load_targets
+    index : cKDTree
+        Spatial index as returned by load_targets
+    wcsprm
+        World coordinates of the image
+    shape : tuple
+        Shape of the image
+    border : float
+        Targets closer than this to the edge of the image (in pixel) are not used
+
+    Returns
+    -------
+    targets_inside : dataframe
+        Targets within the image with their pixel positions in the columns x and y
+
+    """
+    ny, nx = shape
+    pixels = [[nx/2, ny/2], [0, 0], [nx, 0], [0, ny], [nx, ny]]
+    world = np.radians(wcsprm.p2s(pixels, 0)["world"])
+    vectors = np.column_stack([np.cos(world[:,1])*np.cos(world[:,0]), np.cos(world[:,1])*np.sin(world[:,0]), np.sin(world[:,1])])
+    #chord length to the furthest corner
+    radius = np.max(np.linalg.norm(vectors[1:]-vectors[0], axis=1))
+    candidates = index.query_ball_point(vectors[0], radius*1.01)
+    targets_inside = targets.iloc[sorted(candidates)].copy()
+    if(targets_inside.shape[0] == 0):
+        targets_inside["x"] = []
+        targets_inside["y"] = []
+        return targets_inside
+
+    pixcrd = wcsprm.s2p(targets_inside[["RA", "DEC"]].values.astype(float), 0)["pixcrd"]
+    targets_inside["x"] = pixcrd[:,0]
+    targets_inside["y"] = pixcrd[:,1]
+    inside = ((pixcrd[:,0] >= border) & (pixcrd[:,0] <= nx-1-border) &
+              (pixcrd[:,1] >= border) & (pixcrd[:,1] <= ny-1-border))
+    return targets_inside[inside]
+
+
+def detect_sources(image, aperture, stored=(None, None, None), engine=None):
+    """Detections stored by astrometry if they are available, otherwise run the detection (see reuse_sources and find_sources)."""
+    stored_observation, stored_aperture, _ = stored
+    if(stored_observation is not None):
+        return reuse_sources(image, aperture, stored_observation, stored_aperture, engine)
+    return find_sources(image, aperture, engine)
+
+
+def forced_calibration_sources(wcsprm, catalog_data, band_name, aperture, engine, mag_range=None):
+    """Aperture sums at the projected positions of catalog stars, used for the zero point instead of detected sources.
+
+    Only stars in the magnitude range, inside the image and without another catalog star within two apertures are used.
+    All apertures are summed in one call.
+
+    Parameters
+    ----------
+    wcsprm
+        World coordinates of the image
+    catalog_data : dataframe
+        Catalog as returned by get_photometry_data
+    band_name : str
+        Catalog column of the band
+    aperture : float
+        aperture in pixel
+    engine : ApertureEngine
+        aperture sums for this image
+    mag_range : list
+        brightest and faintest catalog magnitude, default FORCED_CALIBRATION_MAG_RANGE from settings
+
+    Returns
+    -------
+    obs_matched : dataframe
+        id (row in catalog_data), xcenter, ycenter, aperture_sum of the used stars
+    cat_matched : dataframe
+        the catalog rows of the used stars
+
+    """
+    #same projection as for the matching of detections, see register.find_matches
+    catalog_sources = register.as_catalog(catalog_data)
+    positions = catalog_sources.on_sensor(wcsprm)
+    mags = catalog_data[band_name].values.astype(float)
+    used = np.flatnonzero(isolated_catalog_stars(positions, mags, engine.image.shape, aperture, mag_range))
+
+    sums = engine.sum_circular(positions[used,0], positions[used,1], aperture)
+    std_apertures = engine.random_aperture_noise(aperture)
+    bright_enough = sums > s.FORCED_CALIBRATION_MIN_SNR*std_apertures
+    used = used[bright_enough]
+    obs_matched = pd.DataFrame({"id": used,
+                                "xcenter": positions[used,0],
+                                "ycenter": positions[used,1],
+                                "aperture_sum": sums[bright_enough]})
+    cat_matched = catalog_data.iloc[used]
+    return obs_matched, cat_matched
+
+
+def isolated_catalog_stars(positions, mags, shape, aperture, mag_range=None):
+    """Catalog stars usable for forced photometry: in the magnitude range, at least two apertures from the edge of the image and without another catalog star within two apertures.
+
+    Parameters
+    ----------
+    positions : array
+        (n, 2) pixel positions of the catalog stars
+    mags : array
+        catalog magnitudes
+    shape : tuple
+        shape of the image
+    aperture : float
+        aperture in pixel
+    mag_range : list
+        brightest and faintest catalog magnitude, default FORCED_CALIBRATION_MAG_RANGE from settings
+
+    Returns
+    -------
+    usable : array
+        boolean mask
+
+    """
+    if(mag_range is None):
+        mag_range = s.FORCED_CALIBRATION_MAG_RANGE
+    ny, nx = shape
+    border = 2*aperture
+    with np.errstate(invalid='ignore'):
+        usable = ((mags >= mag_range[0]) & (mags <= mag_range[1])
+                  & (positions[:,0] >= border) & (positions[:,0] <= nx-1-border)
+                  & (positions[:,1] >= border) & (positions[:,1] <= ny-1-border))
+
+    #throwing out blended stars: any other catalog star within two apertures
+    if(len(positions) > 1):
+        pairs = cKDTree(positions).query_pairs(2*aperture, output_type='ndarray')
+        usable[pairs.ravel()] = False
+    return usable
+
+
+def read_image(fits_image_filename, verbose=False):
+    """Read the image and header of a fits file and subtract the median.
+
+    Returns
+    -------
+    image, hdr
+    stored : tuple
+        detections stored by astrometry, the aperture they were measured with and the catalog sources astrometry
+        matched to them, (None, None, None) if not available
+
+    """
+    #astrometry run with -output wcs or head: the wcs (and for .wcs the detections and catalog) are next to the frame
+    wcs_header, sidecar = image_io.read_sidecar(fits_image_filename)
+    with fits.open(fits_image_filename) as hdul:
+        #print(hdul.info())
+        #print(hdul[0].header)
+
+        #first HDU with an image, for tile compressed files the first extension
+        hdu = image_io.image_hdu(hdul)
+        hdr = hdu.header
+
+
+        stored = detection_table.read_detections(hdul, hdu.data) + (detection_table.read_matched_catalog(hdul, hdu.data),)
+        #catalog region downloaded by astrometry, used instead of a new query if it covers the region
+        query.load_catalog_hdu(hdul)
+        if(wcs_header is not None and sidecar.endswith(".wcs")):
+            with fits.open(sidecar) as hdul_sidecar:
+                stored = detection_table.read_detections(hdul_sidecar, hdu.data) + (detection_table.read_matched_catalog(hdul_sidecar, hdu.data),)
+                query.load_catalog_hdu(hdul_sidecar)
+        image_or = hdu.data.astype(float)
+        image = image_or - np.median(image_or)
+
+    if(wcs_header is not None):
+        print("Using the wcs from {}".format(sidecar))
+        image_io.update_wcs(hdr, wcs_header)
+    return image, hdr, stored
+
+
+def read_frame(fits_image_filename):
+    """Read only the image (median subtracted) and the header with the wcs of a sidecar, for the time series mode.
+
+    Unlike read_image the image is not hashed and stored detections and catalog regions are not read, so nothing
+    is kept after the frame was measured.
+    """
+    with fits.open(fits_image_filename) as hdul:
+        hdu = image_io.image_hdu(hdul)
+        hdr = hdu.header.copy()
+        image = hdu.data.astype(float)
+    image -= np.median(image)
+    wcs_header, sidecar = image_io.read_sidecar(fits_image_filename)
+    if(wcs_header is not None):
+        image_io.update_wcs(hdr, wcs_header)
+    return image, hdr
+
+
+def aperture_in_pixel(wcsprm, aperture_arcsec):
+    """Translate the aperture from arcsec into pixel."""
+    on_sky = wcsprm.p2s([[0,0],[1,1]], 0)["world"]
+    px_scale = np.sqrt((on_sky[0,0]-on_sky[1,0])**2+(on_sky[0,1]-on_sky[1,1])**2)
+    px_scale = px_scale*60*60 #in arcsec
+    return aperture_arcsec / px_scale
+
+
+def calibrate_zeropoint(image, wcsprm, aperture, band, catalog="auto", stored=(None, None, None), engine=None, mode="detect", mag_range=None):
+    """Detect sources in the image and calibrate the zero point against the catalog.
+
+    In the forced mode nothing is detected, the apertures are placed on the projected catalog positions
+    (see forced_calibration_sources) and observation is None. If astrometry stored the detections it matched to its
+    catalog, only these are matched to the photometry catalog, so detections without a catalog star (cosmics, blends)
+    are not matched by chance.
+
+    Parameters
+    ----------
+    image
+        Observed image (without background)
+    wcsprm
+        World coordinates of the image
+    aperture : float
+        aperture in pixel
+    band : str
+        photometric band
+    catalog : str
+        catalog to use for the calibration, 'auto' to choose based on the band
+    stored : tuple
+        detections stored by astrometry, their aperture and the matched catalog sources, as returned by read_image
+    engine : ApertureEngine
+        aperture sums for this image, created if not given
+    mode : str
+        'detect' or 'forced'
+    mag_range : list
+        catalog magnitudes used in the forced mode, see forced_calibration_sources
+
+    Returns
+    -------
+    observation, catalog_data, obs_matched, cat_matched, ZP, ZP_median, band_name, catalog_name, mag_sys
+
+    """
+    if(engine is None):
+        engine = ApertureEngine(image)
+    observation = None
+    if(mode == "detect"):
+        profiling.begin("detect")
+        observation = detect_sources(image, aperture, stored, engine)
+
+    #get rough coordinates
+    profiling.begin("catalog")
+    coord = SkyCoord(wcsprm.crval[0], wcsprm.crval[1], unit=(u.deg, u.deg), frame="icrs")
+
+    #failed downloads are retried, see catalog_client.py
+    print(">Dowloading catalog data")
+    #WCS.calc_footprint(header=None, undistort=True, axes=None, center=True)
+    radius = u.Quantity(5, u.arcmin)#should be enough for all images
+    catalog_data, band_name, catalog_name, mag_sys = query.get_photometry_data(coord, radius, band, catalog)
+
+    #throwing out blended sources (should be improved, TODO)
+    profiling.begin("zeropoint")
+
+    if(mode == "forced"):
+        obs_matched, cat_matched = forced_calibration_sources(wcsprm, catalog_data, band_name, aperture, engine, mag_range)
+        print("Forced photometry on {} catalog stars".format(obs_matched.shape[0]))
+    else:
+        calibration_sources = observation
+        stored_observation, _, stored_matched = stored
+        if(stored_observation is not None and stored_matched is not None):
+            confirmed = observation[observation["id"].isin(stored_matched["detection_id"])]
+            if(confirmed.shape[0] > 0):
+                print("Calibrating with the {} sources astrometry matched to its catalog".format(confirmed.shape[0]))
+                calibration_sources = confirmed
+        obs_matched, cat_matched, distances = register.find_matches_keep_catalog_info(calibration_sources, catalog_data, wcsprm, threshold=3)
+        print("Found {} matches".format(obs_matched.shape[0]))
+
+    #mag = -2.5 log10(cts) + ZP
+    ZP = -1*(-2.5 *np.log10(obs_matched["aperture_sum"].values) - cat_matched[band_name].values)
+
+    #FIGURE OUT LINEAR RANGE TOTO
+    ZP_median = np.median(ZP[~np.isnan(ZP)])
+    profiling.end()
+    return observation, catalog_data, obs_matched, cat_matched, ZP, ZP_median, band_name, catalog_name, mag_sys
+
+
+BATCH_COLUMNS = ["frame", "target", "ra", "dec", "x", "y", "mag", "mag_err", "snr", "limiting_mag", "band", "mag_sys"]
+
+
+def measure_frame(fits_image_filename, targets, index, args):
+    """Forced photometry of all targets inside one frame.
+
+    Parameters
+    ----------
+    fits_image_filename : str
+        Frame with astrometric calibration
+    targets, index
+        Target list and its index, see load_targets
+    args
+        Parsed command line arguments
+
+    Returns
+    -------
+    results : dataframe
+        One row per target inside the frame, columns BATCH_COLUMNS
+
+    """
+    print("")
+    print(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
+    print("> Batch photometry for {} ".format(fits_image_filename))
+
+    profiling.begin("read")
+    image, hdr, stored = read_image(fits_image_filename, args.verbose)
+    wcsprm = Wcsprm(hdr.tostring().encode('utf-8'))
+    aperture = aperture_in_pixel(wcsprm, args.aperture)
+
+    targets_inside = targets_in_footprint(targets, index, wcsprm, image.shape, border=aperture)
+    print("{} targets are inside the image".format(targets_inside.shape[0]))
+    if(targets_inside.shape[0] == 0):
+        return pd.DataFrame(columns=BATCH_COLUMNS)
+
+    engine = ApertureEngine(image)
+    observation, catalog_data, obs_matched, cat_matched, ZP, ZP_median, band_name, catalog_name, mag_sys = calibrate_zeropoint(image, wcsprm, aperture, args.band, args.catalog, stored, engine,
+                                                                                                                            getattr(args, "calibration", "detect"), getattr(args, "mag_range", None))
+    profiling.begin("measure")
+    std_apertures = engine.random_aperture_noise(aperture)
+    sig5_limiting_mag_apertures = -2.5*np.log10(5*std_apertures) + ZP_median
+
+    #all targets of this frame in one call
+    fluxes = engine.sum_circular(targets_inside["x"].values, targets_inside["y"].values, aperture)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = fluxes / std_apertures
+        mag = -2.5 *np.log10(fluxes) + ZP_median
+        mag_err = 2.5 * np.log10(1+ 1/snr)
+
+    return pd.DataFrame({"frame": fits_image_filename,
+                         "target": targets_inside["NAME"].values,
+                         "ra": targets_inside["RA"].values,
+                         "dec": targets_inside["DEC"].values,
+                         "x": targets_inside["x"].values,
+                         "y": targets_inside["y"].values,
+                         "mag": mag,
+                         "mag_err": mag_err,
+                         "snr": snr,
+                         "limiting_mag": sig5_limiting_mag_apertures,
+                         "band": args.band,
+                         "mag_sys": mag_sys})
+
+
+def batch_photometry(fits_image_filenames, args):
+    """Measure all targets of a target list in all given frames.
+
+    The target list is loaded once. For each frame all targets inside the footprint are measured with one
+    aperture call (forced photometry at the target position) and the results of all frames are collected in a single table.
+
+    Parameters
+    ----------
+    fits_image_filenames : list
+        Frames with astrometric calibration
+    args
+        Parsed command line arguments
+
+    Returns
+    -------
+    results : dataframe
+        One row per frame and target with the columns frame, target, ra, dec, x, y, mag, mag_err, snr, limiting_mag, band, mag_sys
+
+    """
+    targets, index = load_targets(args.targets)
+    results = []
+    for fits_image_filename in fits_image_filenames:
+        with profiling.frame_profiler(fits_image_filename, args.profile):
+            results.append(measure_frame(fits_image_filename, targets, index, args))
+    results = [result for result in results if result.shape[0] > 0]
+
+    if(results):
+        results = pd.concat(results, ignore_index=True)
+    else:
+        results = pd.DataFrame(columns=BATCH_COLUMNS)
+    results.to_csv(args.output, index=False)
+    print("Wrote {} measurements to {}".format(results.shape[0], args.output))
+    return results
+
+
+#target lists already loaded by this worker, see run_job
+_targets_cache = {}
+
+
+def run_job(fits_image_filename, args):
+    """Batch photometry of one frame taken from the job queue, see job_queue.py.
+
+    Returns
+    -------
+    result : dict
+        measurements: the rows of measure_frame as records
+    """
+    if(args.targets not in _targets_cache):
+        _targets_cache[args.targets] = load_targets(args.targets)
+    targets, index = _targets_cache[args.targets]
+    with profiling.frame_profiler(fits_image_filename, getattr(args, "profile", False)):
+        results = measure_frame(fits_image_filename, targets, index, args)
+    return {"measurements": results.to_dict(orient="records")}
+
+
+
+LIGHTCURVE_COLUMNS = ["frame", "mjd", "exptime", "airmass", "target", "ra", "dec", "x", "y", "flux", "mag", "mag_err", "snr",
+                      "zp", "zp_err", "n_comparison", "limiting_mag", "band", "mag_sys"]
+
+
+def observation_time(hdr):
+    """Modified julian date of the middle of the exposure.
+
+    The start is taken from MJD-OBS, JD or DATE-OBS (with TIME-OBS if the date has no time), half of EXPTIME (or EXPOSURE) is added.
+
+    Returns
+    -------
+    mjd : float
+        nan if the header has no usable time
+    exptime : float
+        seconds, nan if not in the header
+
+    """
+    exptime = float(hdr.get("EXPTIME", hdr.get("EXPOSURE", np.nan)))
+    try:
+        if("MJD-OBS" in hdr):
+            start = float(hdr["MJD-OBS"])
+        elif("JD" in hdr):
+            start = float(hdr["JD"]) - 2400000.5
+        elif("DATE-OBS" in hdr):
+            date = str(hdr["DATE-OBS"]).strip()
+            if("T" not in date and "TIME-OBS" in hdr):
+                date = date+"T"+str(hdr["TIME-OBS"]).strip()
+            start = Time(date, scale="utc").mjd
+        else:
+            print("No observation time (MJD-OBS, JD or DATE-OBS) in the header")
+            return np.nan, exptime
+    except ValueError as e:
+        print("Could not read the observation time from the header: {}".format(e))
+        return np.nan, exptime
+    if(np.isfinite(exptime)):
+        return start + exptime/2/86400, exptime
+    return start, exptime
+
+
+def lightcurve_targets(args):
+    """Targets of the light curve: the -targets list, -name from targets.csv or the -ra -dec position."""
+    if(args.targets):
+        targets, _ = load_targets(args.targets)
+        return targets
+    if(args.name):
+        targets = pd.read_csv("targets.csv")
+        return targets[targets["NAME"] == args.name]
+    if(args.ra is not None and args.dec is not None):
+        return pd.DataFrame({"NAME": ["target"], "RA": [args.ra], "DEC": [args.dec]})
+    return pd.DataFrame({"NAME": [], "RA": [], "DEC": []})
+
+
+def select_comparison_stars(catalog_data, band_name, targets, wcsprm, shape, aperture, mag_range=None, max_stars=None):
+    """Comparison stars of a light curve, chosen once on the reference frame and then measured in every frame.
+
+    Stars are used if they are usable for forced photometry (see isolated_catalog_stars) and no target is within two apertures.
+    Of these the max_stars brightest are taken (default LIGHTCURVE_MAX_COMPARISON from settings).
+
+    Returns
+    -------
+    comparison : dataframe
+        the catalog rows of the comparison stars
+    """
+    if(max_stars is None):
+        max_stars = s.LIGHTCURVE_MAX_COMPARISON
+    positions = register.as_catalog(catalog_data).on_sensor(wcsprm)
+    mags = catalog_data[band_name].values.astype(float)
+    usable = isolated_catalog_stars(positions, mags, shape, aperture, mag_range)
+    if(targets.shape[0] > 0 and len(positions) > 0):
+        target_positions = register.CatalogSources(targets[["RA", "DEC"]].values.astype(float), np.zeros(targets.shape[0])).on_sensor(wcsprm)
+        distances, _ = cKDTree(target_positions).query(positions)
+        usable &= distances > 2*aperture
+    used = np.flatnonzero(usable)
+    used = used[np.argsort(mags[used], kind="stable")[:max_stars]]
+    return catalog_data.iloc[used]
+
+
+def measure_lightcurve_frame(fits_image_filename, radec, args):
+    """Aperture sums at fixed sky positions (targets and comparison stars) in one frame, see lightcurve_photometry.
+
+    Only the sums are returned, the image is not kept. Frames that can not be measured give None.
+
+    Returns
+    -------
+    measurement : dict
+        frame, mjd, exptime, airmass, x, y, flux (arrays in the order of radec) and the noise in an aperture
+    """
+    try:
+        with profiling.frame_profiler(fits_image_filename, args.profile):
+            profiling.begin("read")
+            image, hdr = read_frame(fits_image_filename)
+            wcsprm = Wcsprm(hdr.tostring().encode('utf-8'))
+            aperture = aperture_in_pixel(wcsprm, args.aperture)
+            mjd, exptime = observation_time(hdr)
+
+            profiling.begin("measure")
+            #same projection as for the forced calibration
+            positions = register.CatalogSources(radec, np.zeros(len(radec))).on_sensor(wcsprm)
+            engine = ApertureEngine(image)
+            ny, nx = image.shape
+            inside = ((positions[:,0] >= aperture) & (positions[:,0] <= nx-1-aperture) &
+                      (positions[:,1] >= aperture) & (positions[:,1] <= ny-1-aperture))
+            flux = np.full(len(positions), np.nan)
+            #targets and comparison stars in one call
+            flux[inside] = engine.sum_circular(positions[inside,0], positions[inside,1], aperture)
+            noise = engine.random_aperture_noise(aperture)
+            profiling.end()
+    except Exception as e:
+        print("Skipping {}: {}".format(fits_image_filename, e))
+        return None
+    return {"frame": fits_image_filename, "mjd": mjd, "exptime": exptime, "airmass": float(hdr.get("AIRMASS", np.nan)),
+            "x": positions[:,0], "y": positions[:,1], "flux": flux, "noise": noise}
+
+
+def frame_zeropoint(flux, noise, comparison_mags):
+    """Zero point of a frame from the comparison stars.
+
+    Stars below FORCED_CALIBRATION_MIN_SNR are not used, the zero points of the others are sigma clipped
+    (LIGHTCURVE_CLIP_SIGMA in settings) so a variable or disturbed comparison star does not shift the light curve.
+
+    Returns
+    -------
+    zp, zp_err : float
+        median zero point and its error (scatter of the used stars / sqrt(n)), nan if no star can be used
+    n_used : int
+
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        good = flux > s.FORCED_CALIBRATION_MIN_SNR*noise
+        zp = comparison_mags[good] + 2.5*np.log10(flux[good])
+    zp = zp[np.isfinite(zp)]
+    if(len(zp) == 0):
+        return np.nan, np.nan, 0
+    if(len(zp) < 3):
+        return np.median(zp), np.nan, len(zp)
+    clipped = np.abs(zp - np.median(zp)) <= s.LIGHTCURVE_CLIP_SIGMA*sigma_clipped_stats(zp, sigma=s.LIGHTCURVE_CLIP_SIGMA)[2]
+    zp = zp[clipped]
+    return np.median(zp), np.std(zp)/np.sqrt(len(zp)), len(zp)
+
+
+def lightcurve_photometry(fits_image_filenames, args):
+    """Light curves of the targets over a sequence of frames.
+
+    The catalog is read and the comparison stars are chosen once, on the first frame. Each frame is then only read
+    and the targets and comparison stars are measured with forced photometry in one aperture call, in parallel
+    processes (-workers, default LIGHTCURVE_WORKERS from settings). The zero point of each frame is fitted from the
+    comparison stars (see frame_zeropoint). The rows are written to the table as the frames come in, so the memory
+    does not grow with the length of the sequence.
+
+    Parameters
+    ----------
+    fits_image_filenames : list
+        Frames with astrometric calibration
+    args
+        Parsed command line arguments
+
+    Returns
+    -------
+    n_rows : int
+        number of rows written to args.output, columns LIGHTCURVE_COLUMNS
+
+    """
+    fits_image_filenames = sorted(fits_image_filenames)
+    targets = lightcurve_targets(args)
+    if(targets.shape[0] == 0):
+        print("ERROR: the light curve needs targets (-targets, -name or -ra -dec)")
+        return 0
+
+    #catalog and comparison stars from the first frame
+    print(">Choosing comparison stars on {}".format(fits_image_filenames[0]))
+    image, hdr = read_frame(fits_image_filenames[0])
+    wcsprm = Wcsprm(hdr.tostring().encode('utf-8'))
+    aperture = aperture_in_pixel(wcsprm, args.aperture)
+    shape = image.shape
+    del image
+    #catalog region stored by astrometry, only read from this frame
+    with fits.open(fits_image_filenames[0]) as hdul:
+        query.load_catalog_hdu(hdul)
+    corners = wcsprm.p2s([[0, 0], [shape[1], 0], [0, shape[0]], [shape[1], shape[0]]], 0)["world"]
+    coord = SkyCoord(wcsprm.crval[0], wcsprm.crval[1], unit=(u.deg, u.deg), frame="icrs")
+    radius = max(5., np.max(coord.separation(SkyCoord(corners[:,0], corners[:,1], unit=(u.deg, u.deg), frame="icrs")).arcmin))
+    print(">Dowloading catalog data")
+    catalog_data, band_name, catalog_name, mag_sys = query.get_photometry_data(coord, u.Quantity(radius, u.arcmin), args.band, args.catalog)
+    comparison = select_comparison_stars(catalog_data, band_name, targets, wcsprm, shape, aperture, args.mag_range)
+    comparison_mags = comparison[band_name].values.astype(float)
+    print("Using {} comparison stars from {}".format(comparison.shape[0], catalog_name))
+
+    n_targets = targets.shape[0]
+    radec = np.vstack([targets[["RA", "DEC"]].values.astype(float), comparison[["ra", "dec"]].values.astype(float)])
+    measure = functools.partial(measure_lightcurve_frame, radec=radec, args=args)
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    workers = min(workers, len(fits_image_filenames))
+    if(workers > 1):
+        pool = multiprocessing.Pool(workers)
+        measurements = pool.imap(measure, fits_image_filenames)
+    else:
+        pool = None
+        measurements = map(measure, fits_image_filenames)
+
+    n_rows = 0
+    pd.DataFrame(columns=LIGHTCURVE_COLUMNS).to_csv(args.output, index=False)
+    try:
+        for measurement in measurements:
+            if(measurement is None):
+                continue
+            flux = measurement["flux"]
+            zp, zp_err, n_used = frame_zeropoint(flux[n_targets:], measurement["noise"], comparison_mags)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                snr = flux[:n_targets] / measurement["noise"]
+                mag = -2.5 *np.log10(flux[:n_targets]) + zp
+                mag_err = 2.5 * np.log10(1+ 1/snr)
+            rows = pd.DataFrame({"frame": measurement["frame"],
+                                 "mjd": measurement["mjd"],
+                                 "exptime": measurement["exptime"],
+                                 "airmass": measurement["airmass"],
+                                 "target": targets["NAME"].values,
+                                 "ra": targets["RA"].values,
+                                 "dec": targets["DEC"].values,
+                                 "x": measurement["x"][:n_targets],
+                                 "y": measurement["y"][:n_targets],
+                                 "flux": flux[:n_targets],
+                                 "mag": mag,
+                                 "mag_err": mag_err,
+                                 "snr": snr,
+                                 "zp": zp,
+                                 "zp_err": zp_err,
+                                 "n_comparison": n_used,
+                                 "limiting_mag": -2.5*np.log10(5*measurement["noise"]) + zp,
+                                 "band": args.band,
+                                 "mag_sys": mag_sys}, columns=LIGHTCURVE_COLUMNS)
+            rows.to_csv(args.output, mode="a", header=False, index=False)
+            n_rows += rows.shape[0]
+            print("{}: zero point {:.3f} +- {:.3f} from {} comparison stars".format(measurement["frame"], zp, zp_err, n_used))
+    finally:
+        if(pool is not None):
+            pool.close()
+            pool.join()
+    print("Wrote {} measurements to {}".format(n_rows, args.output))
+    return n_rows
+
+
+
+
+def _plot_zeropoints(ax, catalog_mags, ZP, mag, band_name, zp_limits=None):
+    """Zero points of the calibration sources against their catalog magnitude."""
+    if(zp_limits is None):
+        zp_limits = (np.min(ZP)-1, np.max(ZP)+1)
+    ax.plot(catalog_mags, ZP, "o", markersize=20, label="catalog objects")
+    ax.set_ylim(*zp_limits)
+    if(mag):
+        ax.axvline(x=mag, linewidth=4, color="green", label="target")
+    ax.set_xlabel("catalog "+ band_name+" magnitude")
+    ax.set_ylabel("Zeropoint (should be constant in linear part of the detector)")
+    ax.legend()
+
+
+def draw_target_view(fig, image_cutout, cutout_origin, target, aperture_position, aperture, aperture_label, text,
+                     catalog_mags, ZP, mag, band_name, calibration_title, zp_limits):
+    """Cutout around the target with the aperture (left) and the photometric calibration (right), see diagnostics.py."""
+    ax = fig.add_subplot(1, 2, 1)
+    ax.set_xlabel("pixel x direction")
+    ax.set_ylabel("pixel y direction")
+    ax.set_title(text, size=20)
+    x0, y0 = cutout_origin
+    ax.imshow(image_cutout, cmap='Greys', origin='lower', norm=LogNorm(),
+              extent=(x0-0.5, x0+image_cutout.shape[1]-0.5, y0-0.5, y0+image_cutout.shape[0]-0.5))
+    ax.set_xlim(int(target[0])-20, int(target[0])+20)
+    ax.set_ylim(int(target[1])-20, int(target[1])+20)
+    CircularAperture(aperture_position, r=aperture).plot(ax=ax, color='blue', lw=1.5, alpha=0.5, label=aperture_label)
+    ax.plot(target[0], target[1], "+", color="red", markersize=20, linewidth=10, label="predicted target position")
+    ax.legend(bbox_to_anchor=(1.1, -0.1), ncol=2)
+
+    ax = fig.add_subplot(1, 2, 2)
+    ax.set_title(calibration_title)
+    _plot_zeropoints(ax, catalog_mags, ZP, mag, band_name, zp_limits)
+
+
+def draw_calibration(fig, catalog_mags, ZP, mag, band_name):
+    """Only the photometric calibration, if no target position was given."""
+    _plot_zeropoints(fig.add_subplot(1, 1, 1), catalog_mags, ZP, mag, band_name)
 
 
 def parseArguments():
@@ -136,6 +888,15 @@ def parseArguments():
 
     parser.add_argument("-a", "--aperture", help="Aperture in arcsec to use for extraction. Default 2 arcseconds.", type=float, default="2")
 
+    parser.add_argument("-calibration", "--calibration", help="'detect': zero point from the sources detected in the image and matched to the catalog. 'forced': apertures on the projected positions of catalog stars, no detection needed (the frame has to be astrometrically calibrated)", type=str, default=s.PHOTOMETRY_CALIBRATION, choices=["detect", "forced"])
+    parser.add_argument("-mag_range", "--mag_range", help="Brightest and faintest catalog magnitude used for the forced calibration. example: -mag_range 14 21", type=float, nargs=2, default=s.FORCED_CALIBRATION_MAG_RANGE)
+    parser.add_argument("-targets", "--targets", help="Batch mode: csv file with NAME, RA, DEC columns (degrees). All targets inside each frame are measured and written to one results table", type=str, default=None)
+    parser.add_argument("-o", "--output", help="Output table for batch mode", type=str, default="photometry_results.csv")
+    parser.add_argument("-profile", "--profile", help="Write a profile per frame: cProfile statistics (<frame>_profile_<stage>.pstats) and memory peak of each stage (read, detect, catalog, ...) with a summary in <frame>_profile.txt", action="store_true")
+    parser.add_argument("-queue", "--queue", help="Batch mode on many nodes: SQLite job queue on shared storage. The frames are added to the queue and measured by this and all other workers on the queue (start more and collect the table with job_queue.py)", type=str, default=None)
+    parser.add_argument("-lightcurve", "--lightcurve", help="Time series mode: the targets (-targets, -name or -ra -dec) and comparison stars chosen once on the first frame are measured in all frames, the light curves with the zero point of each frame and the time from the header are written to the -o table", action="store_true")
+    parser.add_argument("-workers", "--workers", help="Frames measured in parallel in the time series mode, 0 for one process per core", type=int, default=s.LIGHTCURVE_WORKERS)
+
 
 
 
@@ -153,266 +914,231 @@ def parseArguments():
     return args
 
 
-def main():
-    """Perform photometry for the given file."""
-    print("Program version: 0.1")
-    StartTime = datetime.now()
-    args = parseArguments()
-
-
-    if(args.ignore_warnings):
-        warnings.simplefilter('ignore', UserWarning)
-
-
-    fits_image_filenames = args.input
-    #print(fits_image_filenames)
-
-    #for directories search for appropriate fits files
-    if(os.path.isdir(fits_image_filenames[0])):
-        print("detected a directory. Will search for fits files in it that already have astrometry calibration and therefor contain _astro")
-        path = fits_image_filenames[0]
-        fits_image_filenames = []
-        for file in os.listdir(path):
-            if file.endswith(".fits") and "_astro" in file:
-                fits_image_filenames.append(path+"/"+file)
-        print(fits_image_filenames)
+def photometry_frame(fits_image_filename, args, renderer, StartTime):
+    """Photometry of the target (-ra -dec or -name) in one frame, the figure is rendered by renderer."""
+    print("")
+    print(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
+    print("> Photometry for {} ".format(fits_image_filename))
 
-    for fits_image_filename in fits_image_filenames:
-        print("")
-        print(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-        print("> Photometry for {} ".format(fits_image_filename))
+    profiling.begin("read")
+    image, hdr, stored = read_image(fits_image_filename, args.verbose)
 
-        with fits.open(fits_image_filename) as hdul:
-            #print(hdul.info())
-            if(args.verbose):
-                print("if image is not at first position in the fits file the program will break later on")
-            #print(hdul[0].header)
+    wcsprm = Wcsprm(hdr.tostring().encode('utf-8')) #everything else gave me errors with python 3
 
-            hdu = hdul[0]
-            hdr = hdu.header
+    #tranlating aperture into pixel:
+    aperture = aperture_in_pixel(wcsprm, args.aperture)  #aperture n pixel
+    print("aperture")
 
+    engine = ApertureEngine(image)
+    observation, catalog_data, obs_matched, cat_matched, ZP, ZP_median, band_name, catalog_name, mag_sys = calibrate_zeropoint(image, wcsprm, aperture, args.band, args.catalog, stored, engine,
+                                                                                                                            args.calibration, args.mag_range)
+    MAG_CALC = True
+    if(obs_matched.shape[0] == 0):
+        MAG_CALC = False
 
-            image_or = hdul[0].data.astype(float)
-            image = image_or - np.median(image_or)
+    ra = args.ra
+    dec = args.dec
+    if(args.name):
+        targets = pd.read_csv("targets.csv")
 
+        if ((targets["NAME"] == args.name).sum()):
+            ra = targets.loc[targets["NAME"]==args.name, "RA"].values[0]
+            dec = targets.loc[targets["NAME"]==args.name, "DEC"].values[0]
+            print("For {} the following coordinates where found".format(args.name))
+            print("ra: {} dec: {}".format(ra,dec))
+        else:
+            print("{} not found".format(args.name))
 
+    if(observation is None and not (ra and dec)):
+        #forced calibration, only the source list needs the detection
+        profiling.begin("detect")
+        observation = detect_sources(image, aperture, stored, engine)
 
-        wcsprm = Wcsprm(hdr.tostring().encode('utf-8')) #everything else gave me errors with python 3
+    profiling.begin("measure")
+    if(observation is not None):
+        new_magnitudes = -2.5 *np.log10(observation["aperture_sum"].values) + ZP_median
 
-        #tranlating aperture into pixel:
-        on_sky = wcsprm.p2s([[0,0],[1,1]], 0)["world"]
-        px_scale = np.sqrt((on_sky[0,0]-on_sky[1,0])**2+(on_sky[0,1]-on_sky[1,1])**2)
-        px_scale = px_scale*60*60 #in arcsec
-        aperture = args.aperture / px_scale  #aperture n pixel
-        print("aperture")
-        observation = find_sources(image, aperture)
-        #print(observation)
+    if(ra and dec):
+        c_unknown = SkyCoord(ra, dec, unit=(u.deg, u.deg), frame="icrs")
+        if(observation is not None):
+            #print(observation[["xcenter", "ycenter"]].values)
+            coordinats_obs = wcsprm.p2s(observation[["xcenter", "ycenter"]].values,1)["world"]
+            #print(coordinats_obs[17])
+            c_obs = SkyCoord(coordinats_obs[:,0], coordinats_obs[:,1], unit=(u.deg, u.deg), frame="icrs")
+            #print(coordinats_obs)
+            from astropy.coordinates import match_coordinates_sky
+            idx, d2d, d3d = match_coordinates_sky(c_unknown, c_obs)
+            cand_dups = d2d < 6*u.arcsec
+        else:
+            #forced calibration, the target is measured with forced photometry as well
+            cand_dups = np.array([False])
+
+        mean, median, std = sigma_clipped_stats(image, sigma=3.0)
+        ap_area= CircularAperture((2,2), r=aperture)
+        sig3_limiting_mag = -2.5*np.log10(3*std*np.sqrt(ap_area.area())) + ZP_median
+        sig5_limiting_mag = -2.5*np.log10(5*std*np.sqrt(ap_area.area())) + ZP_median
+
+        #######################
+        #estimating the error via random apertures
+        # print(std*np.sqrt(aperture_obj.area()))
+        #the summed-area table makes this cheap, so many more apertures than before are used
+        std_apertures = engine.random_aperture_noise(aperture)
+        print(std_apertures)
+        sig5_limiting_mag_apertures = -2.5*np.log10(5*std_apertures) + ZP_median
+        # print(sig5_limiting_mag_apertures)
+        # print(np.mean(random_extractions.loc[random_extractions["aperture_sum"]<0,"aperture_sum"]))
+        ###########################
+        mag = 0
+        if(cand_dups.sum() > 0):
+            print("Position was given. Found {} sources in a 6 arcsec radius. Here is the magnitude:".format(cand_dups.sum()))
+            print(new_magnitudes[idx])
+            print("----")
+
+
+            aperture_obj = CircularAperture(((observation["xcenter"].values)[idx], (observation["ycenter"].values)[idx]), r=aperture)
+            #noise = (observation["aperture_sum"].values)[idx] /(std*np.sqrt(aperture_obj.area()))
+            #https://en.wikipedia.org/wiki/Sum_of_normally_distributed_random_variables
+            #the std**2 is added, so we get a square root for the area!
+            noise = (observation["aperture_sum"].values)[idx] /std_apertures
+
+
+            #print(noise_prob_wrong)
+            #print(noise_prob_wrong2)
+
+            print("We get a signal to noise of {} for the fixed aperture".format(noise))
+
+            mag = new_magnitudes[idx]
+            mag_err = 2.5 * np.log10(1+ 1/noise)
+            text = "found detection in {} band,\n {:.4g} +- {:.2g} {}mag, {:.3g} S/N \n 5 sig limiting mag is {:.4g}".format(args.band, mag, mag_err, mag_sys, noise, sig5_limiting_mag_apertures)
 
-        positions = (observation['xcenter'], observation['ycenter'])
-        apertures = CircularAperture(positions, r=4.)
+        else:
+            print("Position was given. No object was found at that position.")
+            pix_unknown = wcsprm.s2p([[ra, dec]], 1)
+            pix_unknown  = pix_unknown['pixcrd']
 
+            aperture_obj = CircularAperture(pix_unknown, r=aperture)
+            forced_sum = engine.sum_circular(pix_unknown[:,0], pix_unknown[:,1], aperture)
 
-        #get rough coordinates
-        coord = SkyCoord(wcsprm.crval[0], wcsprm.crval[1], unit=(u.deg, u.deg), frame="icrs")
+            forced_mag = -2.5 *np.log10(forced_sum) + ZP_median
+            forced_mag = forced_mag[0]
 
+            #noise = (forced_phot["aperture_sum"].values)[0] /(std*np.sqrt(aperture_obj.area()))
+            noise = forced_sum[0] /std_apertures
 
-        #put in nice wrapper! with repeated tries and maybe try synchron!
-        print(">Dowloading catalog data")
-        #WCS.calc_footprint(header=None, undistort=True, axes=None, center=True)
-        radius = u.Quantity(5, u.arcmin)#should be enough for all images
-        catalog_data, band_name, catalog_name, mag_sys = query.get_photometry_data(coord, radius, args.band, args.catalog)
 
-        #throwing out blended sources (should be improved, TODO)
+            print("Forced photometry gives a magnitude of {}".format(forced_mag))
 
 
-        apertures_catalog = CircularAperture(wcsprm.s2p(catalog_data[["ra", "dec"]], 1)['pixcrd'], r=5.)
+            #local error
+            # pix_unknown = pix_unknown[0]
+            # mean_loc, median_loc, std_loc = sigma_clipped_stats(image[int(pix_unknown[0])-50:int(pix_unknown[0])+50,int(pix_unknown[1])-50:int(pix_unknown[1])+50], sigma=3.0)
+            # ap_area= CircularAperture((2,2), r=aperture)
+            # sig5_limiting_mag_local = -2.5*np.log10(5*std_loc*np.sqrt(ap_area.area())) + ZP_median
+            # print((std_loc*np.sqrt(aperture_obj.area())))
+            # print(sig5_limiting_mag_local)
 
-        obs_matched, cat_matched, distances = register.find_matches_keep_catalog_info(observation, catalog_data, wcsprm, threshold=3)
-        print("Found {} matches".format(obs_matched.shape[0]))
-        MAG_CALC = True
-        if(obs_matched.shape[0] == 0):
-            MAG_CALC = False
 
-        obs_matched["aperture_sum"]
-        cat_matched[band_name]
+            print("We get a signal to noise of {} for the fixed aperture".format(noise))
+            mag = forced_mag
+            mag_err = 2.5 * np.log10(1+ 1/noise)
+            text = "forced photometry in {} band,\n {:.4g} +- {:.2g} {}mag, {:.3g} S/N \n 5 sig limiting mag is {:.4g} ".format(args.band, mag, mag_err,mag_sys, noise, sig5_limiting_mag)
 
-        #mag = -2.5 log10(cts) + ZP
-        ZP = -1*(-2.5 *np.log10(obs_matched["aperture_sum"].values) - cat_matched[band_name].values)
 
-        #FIGURE OUT LINEAR RANGE TOTO
-        ZP_median = np.median(ZP[~np.isnan(ZP)])
-        new_magnitudes = -2.5 *np.log10(observation["aperture_sum"].values) + ZP_median
+    else:
+        print(new_magnitudes)
+        mag = 0
 
+    if(observation is not None):
+        obs_with_photometry = observation.copy()
+        obs_with_photometry["mag"] = new_magnitudes
 
+    #search for targeted object and print out its magnitude TODO
 
+    #the figures are rendered in the background and shown at the end, the target view only needs a cutout
+    profiling.begin("plot")
+    if(ra and dec):
+        pix_unknown = wcsprm.s2p([[ra, dec]], 1)
+        pix_unknown  = pix_unknown['pixcrd']
+        pix_unknown = pix_unknown[0]
+        image_cutout, cutout_origin = diagnostics.cutout(image, pix_unknown[0], pix_unknown[1])
 
-        ra = args.ra
-        dec = args.dec
-        if(args.name):
-            targets = pd.read_csv("targets.csv")
+        outputname = fits_image_filename.replace('.fits','')
+        renderer.submit(draw_target_view, filename=outputname+"_ra{}dec{}.pdf".format(ra, dec), window_title=fits_image_filename, figsize=(15,8),
+                        image_cutout=image_cutout, cutout_origin=cutout_origin, target=pix_unknown,
+                        aperture_position=np.array(aperture_obj.positions, dtype=float), aperture=aperture, aperture_label=str(args.aperture)+" arcsec aperture",
+                        text=text, catalog_mags=cat_matched[band_name].values, ZP=ZP, mag=mag, band_name=band_name,
+                        calibration_title="Photometric calibration with {} sources from {}".format(obs_matched.shape[0], catalog_name),
+                        zp_limits=(np.min(ZP)-1, np.max(ZP)+1) if MAG_CALC else (10,30))
 
-            if ((targets["NAME"] == args.name).sum()):
-                ra = targets.loc[targets["NAME"]==args.name, "RA"].values[0]
-                dec = targets.loc[targets["NAME"]==args.name, "DEC"].values[0]
-                print("For {} the following coordinates where found".format(args.name))
-                print("ra: {} dec: {}".format(ra,dec))
-            else:
-                print("{} not found".format(args.name))
-        if(ra and dec):
-            c_unknown = SkyCoord(ra, dec, unit=(u.deg, u.deg), frame="icrs")
-            #print(observation[["xcenter", "ycenter"]].values)
-            coordinats_obs = wcsprm.p2s(observation[["xcenter", "ycenter"]].values,1)["world"]
-            #print(coordinats_obs[17])
-            c_obs = SkyCoord(coordinats_obs[:,0], coordinats_obs[:,1], unit=(u.deg, u.deg), frame="icrs")
-            #print(coordinats_obs)
-            from astropy.coordinates import match_coordinates_sky
-            idx, d2d, d3d = match_coordinates_sky(c_unknown, c_obs)
-            cand_dups = d2d < 6*u.arcsec
+    else:
+        renderer.submit(draw_calibration, window_title=fits_image_filename, catalog_mags=cat_matched[band_name].values, ZP=ZP, mag=mag, band_name=band_name)
 
-            mean, median, std = sigma_clipped_stats(image, sigma=3.0)
-            ap_area= CircularAperture((2,2), r=aperture)
-            sig3_limiting_mag = -2.5*np.log10(3*std*np.sqrt(ap_area.area())) + ZP_median
-            sig5_limiting_mag = -2.5*np.log10(5*std*np.sqrt(ap_area.area())) + ZP_median
-
-            #######################
-            #estimating the error via random apertures
-            # print(std*np.sqrt(aperture_obj.area()))
-            ran_x = 2*aperture + np.random.random(1000) * (image.shape[0]-4*aperture)
-            ran_y = 2*aperture + np.random.random(1000) * (image.shape[0]-4*aperture)
-            apertures_error = CircularAperture((ran_x,ran_y), r=aperture)
-            phot_table = aperture_photometry(image, apertures_error)
-            phot_table['aperture_sum'].info.format = '%.8g'  # for consistent table output
-            random_extractions = Table(phot_table).to_pandas()
-            #print(np.mean(np.abs(random_extractions["aperture_sum"])))
-            # print(np.median(np.abs(random_extractions["aperture_sum"])))
-            # sig5_limiting_mag_apertures = -2.5*np.log10(5*np.median(np.abs(random_extractions["aperture_sum"]))) + ZP_median
-            # print(sig5_limiting_mag_apertures)
-            m,_, std_apertures = sigma_clipped_stats(random_extractions["aperture_sum"], sigma=3)
-            print(std_apertures)
-            sig5_limiting_mag_apertures = -2.5*np.log10(5*std_apertures) + ZP_median
-            # print(sig5_limiting_mag_apertures)
-            # print(np.mean(random_extractions.loc[random_extractions["aperture_sum"]<0,"aperture_sum"]))
-            ###########################
-            mag = 0
-            if(cand_dups.sum() > 0):
-                print("Position was given. Found {} sources in a 6 arcsec radius. Here is the magnitude:".format(cand_dups.sum()))
-                print(new_magnitudes[idx])
-                print("----")
-
-
-                aperture_obj = CircularAperture(((observation["xcenter"].values)[idx], (observation["ycenter"].values)[idx]), r=aperture)
-                #noise = (observation["aperture_sum"].values)[idx] /(std*np.sqrt(aperture_obj.area()))
-                #https://en.wikipedia.org/wiki/Sum_of_normally_distributed_random_variables
-                #the std**2 is added, so we get a square root for the area!
-                noise = (observation["aperture_sum"].values)[idx] /std_apertures
-
-
-                #print(noise_prob_wrong)
-                #print(noise_prob_wrong2)
-
-                print("We get a signal to noise of {} for the fixed aperture".format(noise))
-
-                mag = new_magnitudes[idx]
-                mag_err = 2.5 * np.log10(1+ 1/noise)
-                text = "found detection in {} band,\n {:.4g} +- {:.2g} {}mag, {:.3g} S/N \n 5 sig limiting mag is {:.4g}".format(args.band, mag, mag_err, mag_sys, noise, sig5_limiting_mag_apertures)
-
-            else:
-                print("Position was given. No object was found at that position.")
-                pix_unknown = wcsprm.s2p([[ra, dec]], 1)
-                pix_unknown  = pix_unknown['pixcrd']
-
-                aperture_obj = CircularAperture(pix_unknown, r=aperture)
-                phot_table = aperture_photometry(image, aperture_obj)
-                phot_table['aperture_sum'].info.format = '%.8g'  # for consistent table output
-                #print(phot_table)
-                forced_phot = Table(phot_table).to_pandas()
-
-                forced_mag = -2.5 *np.log10(forced_phot["aperture_sum"].values) + ZP_median
-                forced_mag = forced_mag[0]
-
-                #noise = (forced_phot["aperture_sum"].values)[0] /(std*np.sqrt(aperture_obj.area()))
-                noise = (forced_phot["aperture_sum"].values)[0] /std_apertures
-
-
-                print("Forced photometry gives a magnitude of {}".format(forced_mag))
-
-
-                #local error
-                # pix_unknown = pix_unknown[0]
-                # mean_loc, median_loc, std_loc = sigma_clipped_stats(image[int(pix_unknown[0])-50:int(pix_unknown[0])+50,int(pix_unknown[1])-50:int(pix_unknown[1])+50], sigma=3.0)
-                # ap_area= CircularAperture((2,2), r=aperture)
-                # sig5_limiting_mag_local = -2.5*np.log10(5*std_loc*np.sqrt(ap_area.area())) + ZP_median
-                # print((std_loc*np.sqrt(aperture_obj.area())))
-                # print(sig5_limiting_mag_local)
-
-
-                print("We get a signal to noise of {} for the fixed aperture".format(noise))
-                mag = forced_mag
-                mag_err = 2.5 * np.log10(1+ 1/noise)
-                text = "forced photometry in {} band,\n {:.4g} +- {:.2g} {}mag, {:.3g} S/N \n 5 sig limiting mag is {:.4g} ".format(args.band, mag, mag_err,mag_sys, noise, sig5_limiting_mag)
 
+    print("overall time taken")
+    print(datetime.now()-StartTime)
+    # if(args.show_images):
+    #     plt.show()
 
-        else:
-            print(new_magnitudes)
-            mag = 0
 
-        obs_with_photometry = observation.copy()
-        obs_with_photometry["mag"] = new_magnitudes
+def main():
+    """Perform photometry for the given file."""
+    print("Program version: 0.1")
+    StartTime = datetime.now()
+    args = parseArguments()
 
-        #search for targeted object and print out its magnitude TODO
 
-        if(ra and dec):
-            plt.figure(figsize=(15,8))
-            plt.subplot(1,2,1)
-            pix_unknown = wcsprm.s2p([[ra, dec]], 1)
-            pix_unknown  = pix_unknown['pixcrd']
-            pix_unknown = pix_unknown[0]
-
-            plt.xlabel("pixel x direction")
-            plt.ylabel("pixel y direction")
-            plt.title(text, size=20)
-            #plt.imshow(image[int( pix_unknown[0])-30: int(pix_unknown[0])+30, int(pix_unknown[1])-30:int(pix_unknown[1])+30],cmap='Greys', origin='lower', norm=LogNorm())
-            #plt.plot(30, 30, "+", color="red", markersize=20)
-            plt.imshow(image,cmap='Greys', origin='lower', norm=LogNorm())
-            plt.xlim(int( pix_unknown[0])-20, int( pix_unknown[0])+20)
-            plt.ylim(int( pix_unknown[1])-20, int( pix_unknown[1])+20)
-            aperture_obj.plot(color='blue', lw=1.5, alpha=0.5, label=str(args.aperture)+" arcsec aperture")
-            plt.plot(pix_unknown[0],pix_unknown[1], "+", color="red", markersize=20, linewidth=10, label="predicted target position")
-            plt.legend(bbox_to_anchor=(1.1, -0.1), ncol=2)
-
-            plt.subplot(1,2,2)
-            plt.title("Photometric calibration with {} sources from {}".format(obs_matched.shape[0], catalog_name))
-            plt.plot(cat_matched[band_name].values,ZP, "o", markersize=20, label="catalog objects")
-            if(MAG_CALC):
-                plt.ylim(np.min(ZP)-1, np.max(ZP)+1)
-            else:
-                plt.ylim(10,30)
-            if(mag):
-                plt.axvline(x=mag, linewidth=4, color="green", label="target")
-            plt.xlabel("catalog "+ band_name+" magnitude")
-            plt.ylabel("Zeropoint (should be constant in linear part of the detector)")
-            plt.legend()
-            outputname = fits_image_filename.replace('.fits','')
-            plt.savefig(outputname+"_ra{}dec{}.pdf".format(ra, dec))
-            plt.show()
+    if(args.ignore_warnings):
+        warnings.simplefilter('ignore', UserWarning)
 
-        else:
 
-            plt.figure()
-            plt.plot(cat_matched[band_name].values,ZP, "o", markersize=20, label="catalog objects")
-            plt.ylim(np.min(ZP)-1, np.max(ZP)+1)
-            if(mag):
-                plt.axvline(x=mag, linewidth=4, color="green", label="target")
-            plt.xlabel("catalog "+ band_name+" magnitude")
-            plt.ylabel("Zeropoint (should be constant in linear part of the detector)")
-            plt.legend()
-            plt.show()
+    fits_image_filenames = args.input
+    #print(fits_image_filenames)
 
+    #for directories search for appropriate fits files
+    if(os.path.isdir(fits_image_filenames[0])):
+        print("detected a directory. Will search for fits files in it that already have astrometry calibration and therefor contain _astro or have a .wcs or .head file next to them")
+        path = fits_image_filenames[0]
+        fits_image_filenames = []
+        for file in os.listdir(path):
+            solved = "_astro" in file or image_io.read_sidecar(path+"/"+file)[0] is not None
+            if file.endswith(".fits") and solved:
+                fits_image_filenames.append(path+"/"+file)
+        print(fits_image_filenames)
 
+    if(args.lightcurve):
+        lightcurve_photometry(fits_image_filenames, args)
         print("overall time taken")
         print(datetime.now()-StartTime)
-        # if(args.show_images):
-        #     plt.show()
+        print("-- finished --")
+        return
+
+    if(args.queue is not None):
+        if(not args.targets):
+            print("ERROR: only the batch mode (-targets) can run on a job queue")
+            return
+        #the workers may run in other directories
+        args.targets = os.path.abspath(args.targets)
+        queue = job_queue.JobQueue(args.queue)
+        n_new = queue.submit("photometry", fits_image_filenames, args)
+        queue.close()
+        print("Added {} frames to the queue {}".format(n_new, args.queue))
+        job_queue.work(args.queue)
+        print("collect the measurements with: python job_queue.py {} -o {}".format(args.queue, args.output))
+        print("-- finished --")
+        return
+
+    if(args.targets):
+        batch_photometry(fits_image_filenames, args)
+        print("overall time taken")
+        print(datetime.now()-StartTime)
+        print("-- finished --")
+        return
+
+    renderer = diagnostics.DiagnosticRenderer(show=True)
+    for fits_image_filename in fits_image_filenames:
+        with profiling.frame_profiler(fits_image_filename, args.profile):
+            photometry_frame(fits_image_filename, args, renderer, StartTime)
+    renderer.show()
     print("-- finished --")
 
 
@@ -0,0 +1,165 @@
+"""Per stage profiling of a frame (--profile).
+
+Each stage of the pipeline (read, detect, catalog, ...) gets its own cProfile
+statistics and the peak memory allocated during the stage (tracemalloc). The
+code marks its stages with
+
+    with profiling.stage("detect"):
+        ...
+
+or, for consecutive stages of a long function, with begin("catalog") ... end().
+Both cost nothing while no profiler is active. Stages that are entered several
+times for a frame are accumulated. A stage started inside another stage is
+counted to the outer one.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import contextlib
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+
+
+#profiler of the frame that is processed right now, None if profiling is off
+_active = None
+_no_profiling = contextlib.nullcontext()
+
+
+def stage(name):
+    """Context manager for a stage of the pipeline, does nothing if no profiler is active."""
+    if(_active is None):
+        return _no_profiling
+    return _active.stage(name)
+
+
+def begin(name):
+    """Start a stage, ending the stage started before with begin."""
+    if(_active is not None):
+        _active.end()
+        _active.begin(name)
+
+
+def end():
+    """End the stage started with begin."""
+    if(_active is not None):
+        _active.end()
+
+
+class _Stage:
+    __slots__ = ("profile", "calls", "seconds", "peak")
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.calls = 0
+        self.seconds = 0.
+        self.peak = 0
+
+
+class FrameProfiler:
+    """Collects the stages of one frame.
+
+    Use as context manager, it is active (see stage) while the context is open.
+
+    Parameters
+    ----------
+    filename : str
+        fits file of the frame, the reports are written next to it
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stages = {}
+        self._current = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        global _active
+        if(not tracemalloc.is_tracing()):
+            tracemalloc.start()
+            self._started_tracing = True
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        self.end()
+        _active = self._previous
+        if(self._started_tracing):
+            tracemalloc.stop()
+        self.write()
+
+    def begin(self, name):
+        """Start profiling the stage, returns False if another stage is running (cProfile can only run one profiler at a time)."""
+        if(self._current is not None):
+            return False
+        record = self.stages.setdefault(name, _Stage())
+        self._current = name
+        tracemalloc.reset_peak()
+        self._memory_start = tracemalloc.get_traced_memory()[0]
+        self._start = time.perf_counter()
+        record.profile.enable()
+        return True
+
+    def end(self):
+        """End the running stage."""
+        if(self._current is None):
+            return
+        record = self.stages[self._current]
+        record.profile.disable()
+        record.seconds += time.perf_counter() - self._start
+        record.peak = max(record.peak, tracemalloc.get_traced_memory()[1] - self._memory_start)
+        record.calls += 1
+        self._current = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = self.begin(name)
+        try:
+            yield
+        finally:
+            if(started):
+                self.end()
+
+    def summary(self, n_functions=8):
+        """Text report: time and memory peak per stage and the most expensive functions of each stage."""
+        lines = ["Profile of {}".format(self.filename), "",
+                 "{:<16} {:>6} {:>10} {:>14}".format("stage", "calls", "time [s]", "peak [MB]")]
+        total = 0.
+        for name, record in self.stages.items():
+            lines.append("{:<16} {:>6} {:>10.3f} {:>14.1f}".format(name, record.calls, record.seconds, record.peak/1e6))
+            total += record.seconds
+        lines.append("{:<16} {:>6} {:>10.3f}".format("total", "", total))
+        for name, record in self.stages.items():
+            stream = io.StringIO()
+            stats = pstats.Stats(record.profile, stream=stream)
+            stats.strip_dirs().sort_stats("cumulative").print_stats(n_functions)
+            lines.append("")
+            lines.append("---- {} ----".format(name))
+            lines.append(stream.getvalue().strip())
+        return "\n".join(lines)+"\n"
+
+    def write(self):
+        """Write <frame>_profile_<stage>.pstats for every stage and the summary <frame>_profile.txt."""
+        prefix = self.filename.rsplit('.', 1)[0]+"_profile"
+        for name, record in self.stages.items():
+            record.profile.dump_stats("{}_{}.pstats".format(prefix, name))
+        with open(prefix+".txt", "w") as f:
+            f.write(self.summary())
+        print("Profile written to {}.txt (pstats per stage: {}_<stage>.pstats)".format(prefix, prefix))
+
+
+def frame_profiler(filename, enabled):
+    """FrameProfiler for the frame if enabled, otherwise a context that does nothing."""
+    if(enabled):
+        return FrameProfiler(filename)
+    return _no_profiling
@@ -28,6 +28,19 @@ FWHM = 4. #pixels, seeing in pixel
 N_BRIGHTEST_SOURCES = 200 # only use the XXX brightest sources in the image
 DETECTION_SIGMA_THRESHOLD = 5 #threshold for detection. standard only use detections above 5 sigma
 DETECTION_ABSOLUTE_THRESHOLD = None #set to replace sigma threshold by absolute threshold
+DETECTION_BINNING = 1 #detect on the image block summed by this factor for the coarse solve (astrometry -bin)
+REFINE_RADIUS = 3 #binned pixels, detections this close to a catalog source after the coarse solve are measured at full resolution
+
+
+#aperture sums (photometry)
+N_NOISE_APERTURES = 10000 #random apertures to estimate the noise in an aperture
+APERTURE_PHASE_STEPS = 16 #sub-pixel steps for the aperture center, positions are rounded to 1/16 pixel
+PHOTOMETRY_CALIBRATION = "detect" #zero point from 'detect'ed sources matched to the catalog or from apertures 'forced' on the catalog positions
+FORCED_CALIBRATION_MAG_RANGE = [14, 21] #catalog magnitudes used for the forced calibration, brighter stars may be saturated
+FORCED_CALIBRATION_MIN_SNR = 5 #forced calibration apertures below this signal to noise are not used
+LIGHTCURVE_MAX_COMPARISON = 50 #comparison stars of a light curve (the brightest within -mag_range), measured in every frame
+LIGHTCURVE_CLIP_SIGMA = 3 #comparison stars further than this many sigma from the zero point of a frame are not used for it
+LIGHTCURVE_WORKERS = 0 #processes measuring the frames of a light curve, 0 for one per core
 
 
 #RMS calculation
@@ -38,7 +51,36 @@ RMS_PX_THRESHOLD = 10 #threshold for rms calculation
 #transformation
 USE_N_SOURCES = 30 #number of sources to be used in fast mode
 FASTMODE_THRESHOLD = 0.5 #half the sources in fast mode have to be detected otherwise I try again without fast mode
+FASTMODE_SIGNAL_RATIO = 3 #in fast mode the offset signal also has to be this many times the median of the other orientations
 OFFSET_BINWIDTH = 1 #binning for peak finding to determine x y offset, default: 1px
+SCALE_ROTATION_BINS_DIST = 3000 #bins in log distance for the scale and rotation search
+SCALE_ROTATION_BINS_ANGLE = 1080 #bins in angle for the scale and rotation search
+SCALE_ROTATION_PYRAMID_FACTOR = 8 #search scale and rotation first on a grid coarser by this factor, then refine around the peak. 1 to use the full grid
+PRECISION = "double" #"single" to compute the image and the registration arrays (pair statistics, histograms, FFTs, matching) in float32/complex64
+FFT_WORKERS = -1 #threads for batched FFTs (scale hypotheses), -1 for all cores
+PAIR_GRID_STEP = 0.1 #upper edge of the log distance grid of the scale and rotation search is rounded up to a multiple of this, so frames of a field share the grid
+PAIR_CACHE_SIZE = 8 #catalog pair histograms (and their FFTs) of this many fields/grids are kept in memory, also stored in CATALOG_CACHE_DIR if set
+PAIR_CACHE_TILE = 2 #arcmin, catalog pair histograms are reused for frames centered in the same sky tile of this size. Larger tiles add catalog sources around the frame to the pairs, which weakens the peak
+PAIR_CACHE_MAX_FILES = 100 #catalog pair histograms kept in CATALOG_CACHE_DIR, the least recently used ones are removed first
+PAIR_SOURCES_STEP = 1.1 #catalog pairs are made from the brightest sources of the downloaded region around the PAIR_CACHE_TILE of the frame, their number is rounded up on a grid of this ratio so the frames of a field share them
+PAIR_REGION_MAX_SOURCES = 2000 #if more region sources would be needed, the catalog pairs are made from the catalog of the frame (not shared between frames)
+
+#scale search with a bank of pixel scales, used if the pixel scale is unclear and the blind solve did not find a solution
+SCALE_SEARCH = 1 #set to 0 to search the scale with one histogram over the distances of both sets instead
+PIXSCALE_RANGE = [0.05, 5.] #arcsec/pixel, plausible pixel scales searched if the instrument is not in PIXSCALE_RANGES
+PIXSCALE_RANGES = {} #arcsec/pixel per instrument (INSTRUME in the header), e.g. {"NOTCAM": [0.2, 0.25]}
+SCALE_HYPOTHESIS_STEP = 1.25 #ratio of neighbouring pixel scales in the bank
+
+
+#blind solve with triangle hashes, used instead of the cross correlation for scale and rotation if the pixel scale is unclear
+BLIND_SOLVE = 1 #set to 0 to always use the cross correlation
+BLIND_N_SOURCES = 20 #brightest detections, all triangles between them are looked up
+BLIND_N_CATALOG = 60 #brightest catalog sources in the hash index
+BLIND_NEIGHBOURS = 10 #catalog triangles are built from each source and all pairs of its nearest neighbours
+BLIND_HASH_TOLERANCE = 0.01 #tolerance of the side ratios of the triangles
+BLIND_N_CANDIDATES = 10 #number of best supported scale/rotation bins (and candidates per bin) that are verified
+BLIND_MATCH_RADIUS = 3 #px, sources within this distance count as matched
+BLIND_MIN_MATCHES = 8 #minimum number of matched sources to accept the blind solution
 
 # #Hubbe Deep Field:
 # FWHM = 7. #pixels, seeing in pixel
@@ -49,5 +91,45 @@ OFFSET_BINWIDTH = 1 #binning for peak finding to determine x y offset, default:
 # RMS_PX_THRESHOLD = 20
 
 #query catalog_data
+CATALOG_MIN_RADIUS = 5 #arcmin, catalog regions are downloaded with at least this radius so photometry (5 arcmin) can reuse the astrometry download
+CATALOG_CACHE_DIR = None #set to a directory to keep downloaded catalog regions between runs
+CATALOG_CACHE_MAX_REGIONS = 20 #downloaded regions kept in memory per catalog, the least recently used ones are dropped first
+CATALOG_MAX_ROWS = 2000 #only the brightest sources are downloaded (sorted on the server)
+CATALOG_MAG_LIMIT = 22 #faintest magnitude downloaded (r for PS1, J for 2MASS, G for GAIA)
+CATALOG_MERGE_RADIUS = 1. #arcsec, entries of different catalogs closer than this are treated as the same star when catalogs are combined
+CATALOG_MAX_CONCURRENT = 4 #requests per catalog service (Vizier, Gaia) running at the same time in one process, also the size of the connection pool
+CATALOG_TIMEOUT = 60 #seconds, timeout of a single catalog request
+CATALOG_MAX_ATTEMPTS = 5 #catalog requests failing with connection problems, timeouts or server errors are tried this often
+CATALOG_BACKOFF = 2 #seconds, wait before the first retry of a catalog request, doubled for every further retry
+CATALOG_BACKOFF_MAX = 60 #seconds, longest wait between two retries
+CATALOG_DEADLINE = 300 #seconds, no retry of a catalog request is started after this time
+CATALOG_VIZIER_URL = None #Vizier endpoint (e.g. a mirror), None for https://<astroquery Vizier server>/viz-bin/votable
+CATALOG_GAIA_URL = None #TAP service used instead of the Gaia archive of astroquery, None for the default
+
+
+#output
+OUTPUT_MODE = "copy" #where astrometry writes the result: copy (<name>_astro.fits), wcs (<name>.wcs), head (<name>.head) or inplace
+OUTPUT_QUANTIZE_LEVEL = None #None compresses float images without loss (astrometry -compress, as GZIP_2), a level (e.g. 16, see astropy CompImageHDU) quantizes them, which changes the pixel values
+
+
+#solve manifest (astrometry -manifest)
+MANIFEST_MAX_ATTEMPTS = 3 #frames that failed this often with the same settings are not tried again
+MANIFEST_MIN_MATCHES = 5 #solutions with fewer catalog sources matched within 3 pixel are marked failed
+MANIFEST_MAX_RMS_PX = 2 #px, solutions with a larger rms of the matched sources are marked failed
+
+#batch scheduling
+SCHEDULE_MAX_RADIUS = 15 #arcmin, largest catalog region downloaded for a group of frames of the same field
+
+#job queue (job_queue.py)
+QUEUE_LEASE_SECONDS = 600 #a running job goes to another worker if its worker did not renew the lease for this long
+QUEUE_HEARTBEAT_SECONDS = 60 #workers renew the lease of their job this often
+QUEUE_MAX_ATTEMPTS = 3 #jobs that failed this often are not tried again
+QUEUE_POLL_SECONDS = 10 #idle workers check this often whether jobs of crashed workers became free
+
+#diagnostic plots (diagnostics.py)
+PLOT_MAX_SIZE = 1024 #pixels, overview plots use an image binned by powers of 2 to at most this size
+PLOT_CUTOUT_HALF_SIZE = 25 #pixels, target views only use a cutout of this half size
+PLOT_QUEUE_SIZE = 4 #figures waiting to be rendered, the solving waits if more are queued
+
 #MAG_PS = "brightest" #magnitue of PANSTARRS to be used: either: 'gmag', "zmag", .., "brightest"
 #MAG_GAIA = "phot_g_mean_mag" #magnitude of GAIA to be used
@@ -7,7 +7,9 @@ setup(
     entry_points={
         'console_scripts': [
             'astrometry=astrometry:main',
-            'photometry=photometry:main'
+            'photometry=photometry:main',
+            'astrometry-manifest=solve_manifest:main',
+            'astrometry-queue=job_queue:main'
         ]
     },
     install_requires = [ 'astroquery',
@@ -0,0 +1,226 @@
+"""Local SQLite manifest of solved frames.
+
+Every frame is identified by the checksum of its pixel data and a key of the
+solve settings. The manifest stores status, resulting wcs, quality and timing, so a
+batch run can skip frames that are already solved with the same settings,
+retry failed frames and resume after a crash.
+
+Query it with
+    python solve_manifest.py manifest.sqlite -status failed
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import traceback
+from datetime import datetime
+from argparse import ArgumentParser
+
+import pandas as pd
+from astropy.io import fits
+
+import settings as s
+import image_io
+import detection_table
+
+
+#arguments and settings that do not change the result of the solve
+IGNORED_ARGUMENTS = ["input", "save_images", "show_images", "verbose", "ignore_warnings", "manifest", "schedule", "queue", "profile", "compress", "output_mode"]
+IGNORED_SETTINGS = ["CATALOG_CACHE_DIR", "MANIFEST_MIN_MATCHES", "MANIFEST_MAX_RMS_PX"]
+
+COLUMNS = ["checksum", "settings_key", "filename", "status", "attempts", "mode", "n_matches", "rms_px",
+           "wcs", "seconds", "started", "finished", "error", "settings"]
+
+
+def frame_checksum(filename):
+    """Checksum of the pixel data of the frame, see detection_table.image_checksum.
+
+    The header is left out: with -output inplace astrometry writes the wcs into it, the frame has to be recognized in the next run.
+    """
+    with fits.open(filename) as hdul:
+        return detection_table.image_checksum(image_io.image_hdu(hdul).data)
+
+
+def solve_settings(args):
+    """Everything that can change the result of the solve: command line arguments and settings.py."""
+    arguments = {name: value for name, value in sorted(vars(args).items()) if name not in IGNORED_ARGUMENTS}
+    constants = {name: repr(getattr(s, name)) for name in sorted(dir(s)) if name.isupper() and name not in IGNORED_SETTINGS}
+    return json.dumps({"arguments": arguments, "settings": constants}, sort_keys=True, default=str)
+
+
+def settings_key(args):
+    """Short key of the solve settings, frames are only skipped if it agrees."""
+    return hashlib.sha1(solve_settings(args).encode("utf-8")).hexdigest()[:16]
+
+
+def quality_problem(result):
+    """Reason why a solve that returned is not good enough (MANIFEST_MIN_MATCHES, MANIFEST_MAX_RMS_PX in settings), None if it is."""
+    n_matches = result.get("n_matches") or 0
+    if(n_matches < s.MANIFEST_MIN_MATCHES):
+        return "only {} matched sources, at least {} needed".format(n_matches, s.MANIFEST_MIN_MATCHES)
+    if(result.get("rms_px") is None or result["rms_px"] > s.MANIFEST_MAX_RMS_PX):
+        return "rms {} px above {} px".format(result.get("rms_px"), s.MANIFEST_MAX_RMS_PX)
+    return None
+
+
+class SolveManifest:
+    """Manifest database of solved frames.
+
+    Parameters
+    ----------
+    filename : str
+        SQLite file, created if it does not exist
+    max_attempts : int
+        Frames that failed this often are not tried again, default MANIFEST_MAX_ATTEMPTS from settings
+
+    """
+
+    def __init__(self, filename, max_attempts=None):
+        if(max_attempts is None):
+            max_attempts = s.MANIFEST_MAX_ATTEMPTS
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(filename, timeout=60)
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS frames (
+                checksum TEXT NOT NULL, settings_key TEXT NOT NULL, filename TEXT, status TEXT, attempts INTEGER DEFAULT 0,
+                mode TEXT, n_matches INTEGER, rms_px REAL, wcs TEXT, seconds REAL, started TEXT, finished TEXT, error TEXT, settings TEXT,
+                PRIMARY KEY (checksum, settings_key))""")
+
+    def get(self, checksum, key):
+        """Row of the frame as dict, None if it was never started with these settings."""
+        row = self.connection.execute("SELECT {} FROM frames WHERE checksum=? AND settings_key=?".format(", ".join(COLUMNS)),
+                                      (checksum, key)).fetchone()
+        if(row is None):
+            return None
+        return dict(zip(COLUMNS, row))
+
+    def start(self, checksum, key, filename, settings=None):
+        """Mark the frame as running. A frame that stays in this status was interrupted and will be solved again."""
+        with self.connection:
+            self.connection.execute("""INSERT INTO frames (checksum, settings_key, filename, status, attempts, started, settings)
+                VALUES (?, ?, ?, 'running', 1, ?, ?)
+                ON CONFLICT(checksum, settings_key) DO UPDATE SET filename=excluded.filename, status='running',
+                attempts=attempts+1, started=excluded.started, finished=NULL, error=NULL""",
+                                    (checksum, key, filename, datetime.now().isoformat(timespec="seconds"), settings))
+
+    def finish(self, checksum, key, status, seconds, result=None, error=None):
+        """Store the outcome. result is the dict returned by the solve (wcs, n_matches, rms_px, mode)."""
+        if(result is None):
+            result = {}
+        with self.connection:
+            self.connection.execute("""UPDATE frames SET status=?, seconds=?, finished=?, error=?, wcs=?, n_matches=?, rms_px=?, mode=?
+                WHERE checksum=? AND settings_key=?""",
+                                    (status, seconds, datetime.now().isoformat(timespec="seconds"), error, result.get("wcs"),
+                                     result.get("n_matches"), result.get("rms_px"), result.get("mode"), checksum, key))
+
+    def run(self, filename, key, solve, output_filename=None, settings=None):
+        """Solve a frame unless the manifest says it is already current.
+
+        Parameters
+        ----------
+        filename : str
+            fits file
+        key : str
+            settings key, see settings_key
+        solve : callable
+            called without arguments, returns the result dict. Results with too few matches or a too large rms count as failed, see quality_problem
+        output_filename : str
+            if given, a solved frame is only skipped if this file exists
+        settings : str
+            description of the settings stored with the frame, see solve_settings
+
+        Returns
+        -------
+        status : str
+            "skipped", "solved" or "failed"
+
+        """
+        checksum = frame_checksum(filename)
+        row = self.get(checksum, key)
+        if(row is not None and row["status"] == "solved"):
+            if(output_filename is None or os.path.exists(output_filename)):
+                print("{} was already solved with these settings, skipping it (manifest {})".format(filename, self.filename))
+                return "skipped"
+            print("{} was already solved but the output is missing, solving it again".format(filename))
+        if(row is not None and row["status"] == "failed" and row["attempts"] >= self.max_attempts):
+            print("{} failed {} times with these settings, skipping it".format(filename, row["attempts"]))
+            return "skipped"
+        if(row is not None and row["status"] == "running"):
+            print("{} was interrupted in an earlier run, solving it again".format(filename))
+
+        self.start(checksum, key, filename, settings)
+        start_time = time.time()
+        try:
+            result = solve()
+        except Exception as e:
+            traceback.print_exc()
+            print("Solving {} failed: {!r}".format(filename, e))
+            self.finish(checksum, key, "failed", time.time()-start_time, error=repr(e))
+            return "failed"
+        problem = quality_problem(result)
+        if(problem is not None):
+            print("Solution of {} rejected: {}".format(filename, problem))
+            self.finish(checksum, key, "failed", time.time()-start_time, result=result, error=problem)
+            return "failed"
+        self.finish(checksum, key, "solved", time.time()-start_time, result=result)
+        return "solved"
+
+    def query(self, status=None, filename=None):
+        """Frames in the manifest as dataframe, optionally only with the given status or filename containing the string."""
+        sql = "SELECT {} FROM frames WHERE 1=1".format(", ".join(COLUMNS))
+        parameters = []
+        if(status is not None):
+            sql = sql + " AND status=?"
+            parameters.append(status)
+        if(filename is not None):
+            sql = sql + " AND filename LIKE ?"
+            parameters.append("%"+filename+"%")
+        return pd.read_sql_query(sql + " ORDER BY started", self.connection, params=parameters)
+
+    def close(self):
+        self.connection.close()
+
+
+def parseArguments():
+    # Create argument parser
+    parser = ArgumentParser()
+    parser.add_argument("manifest", help="SQLite manifest written by astrometry -manifest", type=str)
+    parser.add_argument("-status", "--status", help="Only show frames with this status (running, solved or failed)", type=str, default=None)
+    parser.add_argument("-f", "--filename", help="Only show frames with this string in the filename", type=str, default=None)
+    parser.add_argument("-wcs", "--show_wcs", help="Set True to also print the resulting wcs", type=bool, default=False)
+    return parser.parse_args()
+
+
+def main():
+    """Print the frames in a manifest."""
+    args = parseArguments()
+    if(not os.path.exists(args.manifest)):
+        print("ERROR: manifest {} not found".format(args.manifest))
+        return
+    manifest = SolveManifest(args.manifest)
+    frames = manifest.query(args.status, args.filename)
+    manifest.close()
+    columns = ["filename", "status", "attempts", "mode", "n_matches", "rms_px", "seconds", "finished", "settings_key", "error"]
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        print(frames[columns])
+    print("")
+    print(frames["status"].value_counts().to_string())
+    if(args.show_wcs):
+        for _, frame in frames.iterrows():
+            print("")
+            print(frame["filename"])
+            print(frame["wcs"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""Tests of catalog_client.py (and the Vizier request of get_catalog_data.py) against a local stand-in server.
+
+The server answers each request with the next injected response (status code and latency), so server errors,
+slow answers and broken connections can be tested without the catalog services.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import io
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io.votable import from_table, writeto
+from astropy.table import Table
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import catalog_client
+import get_catalog_data
+import settings as s
+
+
+class StandIn:
+    """Requests received by the stand-in server and the responses injected for the next requests."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.responses = [] #(status, latency in s) of the next requests, status None closes the connection
+        self.default = (200, 0.)
+        self.body = b"ok"
+
+    def next_response(self):
+        with self.lock:
+            self.count += 1
+            if(self.responses):
+                return self.responses.pop(0)
+            return self.default
+
+
+def _handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            status, latency = state.next_response()
+            time.sleep(latency)
+            if(status is None):
+                self.close_connection = True
+                self.connection.close()
+                return
+            body = state.body if status == 200 else b"error"
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Stand-in server, returns its state and url. Retries wait only briefly."""
+    monkeypatch.setattr(s, "CATALOG_BACKOFF", 0.01)
+    monkeypatch.setattr(s, "CATALOG_BACKOFF_MAX", 0.05)
+    monkeypatch.setattr(s, "CATALOG_MAX_ATTEMPTS", 5)
+    monkeypatch.setattr(s, "CATALOG_TIMEOUT", 60)
+    monkeypatch.setattr(s, "CATALOG_DEADLINE", 30)
+    monkeypatch.setattr(s, "CATALOG_MAX_CONCURRENT", 4)
+    monkeypatch.setattr(s, "CATALOG_CACHE_DIR", None)
+    catalog_client._reset()
+    state = StandIn()
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _handler(state))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield state, "http://127.0.0.1:{}/viz-bin/votable".format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+    catalog_client._reset()
+
+
+def test_server_errors_are_retried(server):
+    state, url = server
+    state.responses = [(503, 0.), (500, 0.)]
+    response = catalog_client.post("vizier", url, {"a": 1})
+    assert response.content == b"ok"
+    assert state.count == 3
+
+
+def test_client_errors_are_not_retried(server):
+    state, url = server
+    state.responses = [(400, 0.)]
+    with pytest.raises(requests.HTTPError):
+        catalog_client.post("vizier", url, {"a": 1})
+    assert state.count == 1
+
+
+def test_rate_limit_is_retried(server):
+    state, url = server
+    state.responses = [(429, 0.)]
+    assert catalog_client.post("vizier", url, {"a": 1}).content == b"ok"
+    assert state.count == 2
+
+
+def test_closed_connection_is_retried(server):
+    state, url = server
+    state.responses = [(None, 0.)]
+    assert catalog_client.post("vizier", url, {"a": 1}).content == b"ok"
+    assert state.count == 2
+
+
+def test_slow_response_times_out_and_is_retried(server, monkeypatch):
+    state, url = server
+    monkeypatch.setattr(s, "CATALOG_TIMEOUT", 1)
+    state.responses = [(200, 2.)]
+    start = time.monotonic()
+    assert catalog_client.post("vizier", url, {"a": 1}).content == b"ok"
+    assert state.count == 2
+    assert time.monotonic() - start < 2.
+
+
+def test_attempts_are_limited(server, monkeypatch):
+    state, url = server
+    monkeypatch.setattr(s, "CATALOG_MAX_ATTEMPTS", 3)
+    state.default = (503, 0.)
+    with pytest.raises(requests.HTTPError):
+        catalog_client.post("vizier", url, {"a": 1})
+    assert state.count == 3
+
+
+def test_no_retry_after_the_deadline(server, monkeypatch):
+    state, url = server
+    monkeypatch.setattr(s, "CATALOG_BACKOFF", 0.2)
+    monkeypatch.setattr(s, "CATALOG_BACKOFF_MAX", 0.2)
+    monkeypatch.setattr(s, "CATALOG_MAX_ATTEMPTS", 100)
+    state.default = (503, 0.1)
+    start = time.monotonic()
+    with pytest.raises(requests.HTTPError):
+        catalog_client.post("vizier", url, {"a": 1}, deadline=1.)
+    assert time.monotonic() - start < 1.5
+    assert 2 <= state.count < 10
+
+
+def test_local_errors_are_not_retried():
+    calls = []
+
+    def request(timeout):
+        calls.append(timeout)
+        raise PermissionError("cache directory not writable")
+    with pytest.raises(PermissionError):
+        catalog_client.call("vizier", request)
+    assert len(calls) == 1
+
+
+def test_concurrent_requests_are_limited(server, monkeypatch):
+    state, url = server
+    monkeypatch.setattr(s, "CATALOG_MAX_CONCURRENT", 2)
+    catalog_client._reset()
+    state.default = (200, 0.3)
+    threads = [threading.Thread(target=catalog_client.post, args=("vizier", url, {"a": i})) for i in range(4)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    #two rounds of two requests
+    assert time.monotonic() - start >= 0.55
+    assert state.count == 4
+
+
+def test_identical_requests_are_sent_once(server):
+    state, url = server
+    state.responses = [(503, 0.3)]
+    state.default = (200, 0.3)
+    results = []
+
+    def download():
+        return catalog_client.post("vizier", url, {"a": 1}).content
+    threads = [threading.Thread(target=lambda: results.append(catalog_client.single_flight(("test",), download)))
+               for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [b"ok"]*6
+    assert state.count == 2
+
+
+def test_vizier_query(server, monkeypatch):
+    state, url = server
+    monkeypatch.setattr(s, "CATALOG_VIZIER_URL", url)
+    table = Table({"RAJ2000": [150., 150.01], "DEJ2000": [20., 20.01], "Jmag": [12., 13.]})
+    body = io.BytesIO()
+    writeto(from_table(table), body)
+    state.body = body.getvalue()
+    state.responses = [(502, 0.)]
+    tables = get_catalog_data._query_vizier("2MASS", SkyCoord(150, 20, unit="deg"), 1*u.arcmin, "II/246/out")
+    assert state.count == 2
+    assert len(tables) == 1
+    assert list(tables[0]["RAJ2000"]) == [150., 150.01]
+
+
+def test_empty_vizier_result(server, monkeypatch):
+    state, url = server
+    monkeypatch.setattr(s, "CATALOG_VIZIER_URL", url)
+    body = io.BytesIO()
+    writeto(from_table(Table({"RAJ2000": [1.]})[:0]), body)
+    state.body = body.getvalue()
+    assert get_catalog_data._query_vizier("2MASS", SkyCoord(150, 20, unit="deg"), 1*u.arcmin, "II/246/out") == []
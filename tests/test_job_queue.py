@@ -0,0 +1,134 @@
+"""Tests of job_queue.py with several local worker processes on a temporary queue.
+
+The jobs run a small handler that appends the frame and the worker to a log file, so the test can check that every
+job wrote its output exactly once.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import multiprocessing
+import os
+import sys
+import time
+from argparse import Namespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_queue
+import settings as s
+
+
+def _write_log(filename, args):
+    """Job handler: wait, then write the 'output' like astrometry does after args.lease_check()."""
+    time.sleep(args.sleep)
+    args.lease_check()
+    with open(args.log, "a") as f:
+        f.write("{} {}\n".format(os.path.basename(filename), os.getpid()))
+    return {"pid": os.getpid()}
+
+
+@pytest.fixture
+def queue_settings(monkeypatch):
+    monkeypatch.setitem(job_queue.HANDLERS, "test", _write_log)
+    monkeypatch.setattr(s, "QUEUE_POLL_SECONDS", 0.1)
+    monkeypatch.setattr(s, "QUEUE_HEARTBEAT_SECONDS", 0.2)
+    monkeypatch.setattr(s, "QUEUE_LEASE_SECONDS", 30)
+    monkeypatch.setattr(s, "QUEUE_MAX_ATTEMPTS", 3)
+
+
+def _start_workers(queue_filename, n_workers, max_jobs=None, delay=0.):
+    """Worker processes, forked so they see the test handler and settings."""
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for i in range(n_workers):
+        process = context.Process(target=job_queue.work, args=(queue_filename, "worker{}".format(len(processes)), max_jobs))
+        process.start()
+        processes.append(process)
+        time.sleep(delay)
+    return processes
+
+
+def _join(processes):
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+
+def _log(filename):
+    with open(filename) as f:
+        return [line.split() for line in f.read().splitlines()]
+
+
+@pytest.mark.parametrize("n_workers", [2, 3])
+def test_every_job_is_done_once(tmp_path, queue_settings, n_workers):
+    queue_filename = str(tmp_path / "queue.sqlite")
+    log = str(tmp_path / "log.txt")
+    frames = ["frame{:02d}.fits".format(i) for i in range(12)]
+    queue = job_queue.JobQueue(queue_filename)
+    assert queue.submit("test", frames, Namespace(log=log, sleep=0.05)) == 12
+    #submitting again adds nothing
+    assert queue.submit("test", frames, Namespace(log=log, sleep=0.05)) == 0
+    queue.close()
+
+    _join(_start_workers(queue_filename, n_workers))
+
+    lines = _log(log)
+    assert sorted(line[0] for line in lines) == frames
+    queue = job_queue.JobQueue(queue_filename)
+    jobs = queue.query("test")
+    queue.close()
+    assert (jobs["status"] == "done").all()
+    assert (jobs["attempts"] == 1).all()
+    assert jobs["worker"].nunique() > 1
+
+
+def test_lost_lease_skips_the_output(tmp_path, queue_settings, monkeypatch):
+    #no heartbeats, the lease of the first worker runs out while its job is running
+    monkeypatch.setattr(s, "QUEUE_HEARTBEAT_SECONDS", 60)
+    monkeypatch.setattr(s, "QUEUE_LEASE_SECONDS", 1)
+    queue_filename = str(tmp_path / "queue.sqlite")
+    log = str(tmp_path / "log.txt")
+    queue = job_queue.JobQueue(queue_filename)
+    queue.submit("test", ["frame.fits"], Namespace(log=log, sleep=2.))
+    queue.close()
+
+    #the second worker takes the job over after the lease of the first one ran out
+    _join(_start_workers(queue_filename, 2, max_jobs=1, delay=1.3))
+
+    lines = _log(log)
+    assert len(lines) == 1
+    queue = job_queue.JobQueue(queue_filename)
+    jobs = queue.query("test")
+    queue.close()
+    assert jobs["status"].tolist() == ["done"]
+    assert jobs["worker"].tolist() == ["worker1"]
+    assert jobs["attempts"].tolist() == [2]
+
+
+def test_jobs_of_a_region_stay_on_one_worker(tmp_path, queue_settings):
+    queue = job_queue.JobQueue(str(tmp_path / "queue.sqlite"))
+    args = Namespace(log="", sleep=0.)
+    regions = [[150., 20., 0.1], [151., 20., 0.1]]
+    for i in range(3):
+        for region in regions:
+            queue.submit("test", ["frame_{}_{}.fits".format(region[0], i)], args, region=region)
+
+    first = queue.claim("a")
+    #the region of the first job is taken, the next worker starts on the other one
+    second = queue.claim("b")
+    assert first["region"] == regions[0]
+    assert second["region"] == regions[1]
+    #each worker continues with its region although the jobs are queued alternating
+    assert queue.claim("a", first["region"])["region"] == regions[0]
+    assert queue.claim("b", second["region"])["region"] == regions[1]
+    assert queue.claim("a", first["region"])["region"] == regions[0]
+    #without jobs of its own region left, a worker helps with another one
+    assert queue.claim("a", first["region"])["region"] == regions[1]
+    queue.close()
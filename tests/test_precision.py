@@ -0,0 +1,99 @@
+"""Single against double precision of the registration (astrometry -precision) on synthetic frames.
+
+The frames are made from a known WCS: catalog sources around the field, the detections are the sources on the
+sensor with centroid noise plus unrelated sources. The start WCS is off in offset, rotation and scale. Both precisions
+have to find the same solution.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import copy
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.wcs import WCS
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import get_transformation as register
+import settings as s
+
+
+#tolerances of single against double precision
+MAX_POSITION_DIFFERENCE_PX = 0.01 #largest difference of the projected catalog positions on the sensor
+MAX_RMS_DIFFERENCE_PX = 0.01 #difference of the rms of the matched sources
+MAX_MATCH_DIFFERENCE = 1 #difference of the number of sources matched within 3 pixel
+
+
+def synthetic_frame(seed, n_catalog=400, n_detections=200, rotation_deg=7., scale=1.03, offset=(15., -22.), size=1000, noise=0.3):
+    """Detections, catalog and start WCS of a synthetic frame."""
+    rng = np.random.default_rng(seed)
+    true = WCS(naxis=2)
+    true.wcs.crval = [150., 20.]
+    true.wcs.crpix = [size/2, size/2]
+    true.wcs.cdelt = [-8e-5, 8e-5]
+    true.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    #catalog sources also around the sensor
+    pixels = rng.uniform(-0.2*size, 1.2*size, (n_catalog, 2))
+    world = true.wcs.p2s(pixels, 0)["world"]
+    catalog = pd.DataFrame({"ra": world[:, 0], "dec": world[:, 1], "mag": rng.uniform(12, 20, n_catalog)})
+    inside = np.all((pixels > 0) & (pixels < size), axis=1)
+    detected = pixels[np.flatnonzero(inside)[:n_detections]] + rng.normal(0, noise, (min(n_detections, inside.sum()), 2))
+    detected = np.vstack([detected, rng.uniform(0, size, (n_detections//5, 2))])
+    observation = pd.DataFrame({"id": np.arange(len(detected))+1, "xcenter": detected[:, 0], "ycenter": detected[:, 1],
+                                "aperture_sum": rng.uniform(100, 1000, len(detected))})
+    start = WCS(naxis=2)
+    start.wcs.crval = [150., 20.]
+    start.wcs.crpix = [size/2+offset[0], size/2+offset[1]]
+    angle = np.radians(rotation_deg)
+    rotation = np.array([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]])
+    start.wcs.pc = rotation @ np.diag([-8e-5*scale, 8e-5*scale])
+    start.wcs.cdelt = [1, 1]
+    start.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    return observation, catalog, start.wcs
+
+
+def solve(observation, catalog, wcsprm):
+    """Coarse registration and fine transformation as in astrometry.solve_frame."""
+    detections = register.Detections.from_dataframe(observation)
+    catalog_sources = register.CatalogSources.from_dataframe(catalog)
+    wcsprm, _ = register.coarse_registration(detections, catalog_sources, copy.copy(wcsprm), fast=False, verbose=False)
+    _, _, _, _, distances = register.find_matches(detections, catalog_sources, wcsprm, threshold=3)
+    best_score = len(distances)/(np.sqrt(np.mean(distances))+10)
+    for threshold in [2, 3, 5, 8, 10, 6, 4, 20, 2, 1, 0.5]:
+        wcsprm_new, score = register.fine_transformation(detections, catalog_sources, wcsprm, threshold=threshold, verbose=False)
+        if(score > best_score):
+            wcsprm = wcsprm_new
+            best_score = score
+    _, _, _, _, distances = register.find_matches(detections, catalog_sources, wcsprm, threshold=3)
+    #find_matches gives squared distances
+    return wcsprm, len(distances), float(np.sqrt(np.mean(distances)))
+
+
+@pytest.mark.parametrize("frame", [dict(seed=0), dict(seed=1, rotation_deg=-40, scale=0.95), dict(seed=4, n_detections=40, n_catalog=150)])
+def test_single_precision_agrees_with_double(frame, monkeypatch):
+    observation, catalog, start = synthetic_frame(**frame)
+    solutions = {}
+    for precision in ["double", "single"]:
+        monkeypatch.setattr(s, "PRECISION", precision)
+        solutions[precision] = solve(observation, catalog, start)
+    wcs_double, n_double, rms_double = solutions["double"]
+    wcs_single, n_single, rms_single = solutions["single"]
+
+    #the solution is found: nearly all real detections are matched, within the centroid noise (0.3 px per axis)
+    n_real = len(observation) - len(observation)//6
+    assert n_double >= 0.95*n_real
+    assert rms_double < 0.6
+    #and agree with each other
+    difference = wcs_single.s2p(catalog[["ra", "dec"]].values, 0)["pixcrd"] - wcs_double.s2p(catalog[["ra", "dec"]].values, 0)["pixcrd"]
+    assert np.max(np.abs(difference)) < MAX_POSITION_DIFFERENCE_PX
+    assert abs(n_single - n_double) <= MAX_MATCH_DIFFERENCE
+    assert abs(rms_single - rms_double) < MAX_RMS_DIFFERENCE_PX
@@ -0,0 +1,305 @@
+"""Blind registration with scale and rotation invariant triangle hashes.
+
+Used when the pixel scale in the header is unclear. Triangles of bright stars
+are described by the ratios of their sides, which do not change with scale,
+rotation, reflection or offset. The catalog triangles are stored in an index
+(one per sky tile, cached), the triangles of the brightest detections are
+looked up in it and every hit gives a candidate similarity transformation from
+pixel to tangent plane coordinates. The candidate with the most matched
+sources is converted into the wcs.
+
+Author Lukas Wenzl
+written in python 3
+
+"""
+
+#Author Lukas Wenzl
+#written in python 3
+
+import os
+import copy
+import zipfile
+
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy import units as u
+
+import settings as s
+import get_transformation as register
+import image_io
+
+
+#catalog indices built in this run: {(source, ra, dec, radius, catalog size, n_catalog, neighbours): index}
+_index_cache = {}
+
+
+def tangent_plane(ra, dec, ra_center, dec_center):
+    """Gnomonic projection around the center in degrees.
+
+    Same as the intermediate world coordinates of a RA---TAN, DEC--TAN wcs with crval at the center.
+    """
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    ra_center = np.radians(ra_center)
+    dec_center = np.radians(dec_center)
+    cos_c = np.sin(dec_center)*np.sin(dec) + np.cos(dec_center)*np.cos(dec)*np.cos(ra-ra_center)
+    xi = np.cos(dec)*np.sin(ra-ra_center) / cos_c
+    eta = (np.cos(dec_center)*np.sin(dec) - np.sin(dec_center)*np.cos(dec)*np.cos(ra-ra_center)) / cos_c
+    return np.degrees(xi), np.degrees(eta)
+
+
+def triangles(x, y, neighbours):
+    """Triangles of each point with all pairs of its nearest neighbours.
+
+    Parameters
+    ----------
+    x, y : array
+        positions
+    neighbours : int
+        number of nearest neighbours, len(x)-1 gives all triangles
+
+    Returns
+    -------
+    triangles : array
+        (n, 3) indices of the vertices, each triangle only once
+
+    """
+    n = len(x)
+    if(n < 3):
+        return np.zeros((0, 3), dtype=int)
+    k = min(neighbours, n-1)
+    _, nearest = cKDTree(np.column_stack([x, y])).query(np.column_stack([x, y]), k+1)
+    nearest = nearest[:, 1:]
+    first, second = np.triu_indices(k, 1)
+    tri = np.column_stack([np.repeat(np.arange(n), len(first)), nearest[:, first].ravel(), nearest[:, second].ravel()])
+    return np.unique(np.sort(tri, axis=1), axis=0)
+
+
+def invariants(x, y, tri):
+    """Side ratios of the triangles and their vertices in a well defined order.
+
+    Returns
+    -------
+    keys : array
+        (n, 2) b/a and c/a for the sides a >= b >= c
+    ordered : array
+        (n, 3) vertex indices, vertex k is opposite of the k-th longest side
+    size : array
+        longest side
+
+    """
+    points = np.column_stack([x, y])[tri]
+    sides = np.linalg.norm(points[:, [1, 2, 0]] - points[:, [2, 0, 1]], axis=2) #side opposite of each vertex
+    order = np.argsort(-sides, axis=1)
+    sides = np.take_along_axis(sides, order, axis=1)
+    ordered = np.take_along_axis(tri, order, axis=1)
+    keys = sides[:, 1:] / sides[:, :1]
+    #the order of the vertices is not stable if two sides are almost the same
+    stable = (1 - keys[:, 0] > s.BLIND_HASH_TOLERANCE) & (keys[:, 0] - keys[:, 1] > s.BLIND_HASH_TOLERANCE)
+    return keys[stable], ordered[stable], sides[stable, 0]
+
+
+def build_catalog_index(catalog, ra_center, dec_center, n_catalog=None, neighbours=None):
+    """Triangle hash index of the brightest catalog sources.
+
+    Parameters
+    ----------
+    catalog : CatalogSources or dataframe
+        catalog data with ra, dec and mag
+    ra_center, dec_center : float
+        center of the tangent plane in degrees
+    n_catalog : int
+        number of brightest sources used, default BLIND_N_CATALOG from settings
+    neighbours : int
+        triangles are build from each source and pairs of its nearest neighbours, default BLIND_NEIGHBOURS from settings
+
+    Returns
+    -------
+    index : dict
+        center, positions in the tangent plane (x, y), ordered triangle vertices and side ratio keys
+
+    """
+    if(n_catalog is None):
+        n_catalog = s.BLIND_N_CATALOG
+    if(neighbours is None):
+        neighbours = s.BLIND_NEIGHBOURS
+    bright = register.as_catalog(catalog).brightest(n_catalog)
+    x, y = tangent_plane(bright.ra, bright.dec, ra_center, dec_center)
+    keys, ordered, _ = invariants(x, y, triangles(x, y, neighbours))
+    return {"center": np.array([ra_center, dec_center]), "x": x, "y": y, "triangles": ordered, "keys": keys}
+
+
+def catalog_index(catalog, coord, radius, source):
+    """Triangle hash index for the catalog region, cached per sky tile.
+
+    The index is kept for the rest of the run and stored in CATALOG_CACHE_DIR if that is set in settings.
+    """
+    ra = coord.icrs.ra.deg
+    dec = coord.icrs.dec.deg
+    radius = u.Quantity(radius, u.deg).value
+    key = (source, round(ra, 5), round(dec, 5), round(radius, 5), len(catalog), s.BLIND_N_CATALOG, s.BLIND_NEIGHBOURS)
+    if(key in _index_cache):
+        return _index_cache[key]
+
+    filename = None
+    if(s.CATALOG_CACHE_DIR is not None):
+        filename = os.path.join(s.CATALOG_CACHE_DIR, "{}_{:.5f}_{:+.5f}_{:.5f}_n{}_tri{}_{}.npz".format(*key))
+    index = None
+    if(filename is not None and os.path.isfile(filename)):
+        try:
+            with np.load(filename) as stored:
+                index = {name: stored[name] for name in stored.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            index = None #unreadable file (e.g. left by a crash), built again
+    if(index is None):
+        index = build_catalog_index(catalog, ra, dec)
+        if(filename is not None):
+            os.makedirs(s.CATALOG_CACHE_DIR, exist_ok=True)
+            #other workers sharing the cache directory may read the index while it is written
+            def write(temporary):
+                with open(temporary, "wb") as f:
+                    np.savez(f, **index)
+            image_io.write_atomic(filename, write)
+    _index_cache[key] = index
+    return index
+
+
+def _fit_similarity(z, w, reflected):
+    """Least squares w = alpha*z + beta (z conjugated if reflected) along the last axis. Positions as complex numbers."""
+    if(reflected):
+        z = np.conj(z)
+    z_mean = np.mean(z, axis=-1, keepdims=True)
+    w_mean = np.mean(w, axis=-1, keepdims=True)
+    alpha = np.sum((w-w_mean)*np.conj(z-z_mean), axis=-1) / np.sum(np.abs(z-z_mean)**2, axis=-1)
+    beta = w_mean[..., 0] - alpha*z_mean[..., 0]
+    residual = np.max(np.abs(alpha[..., np.newaxis]*z + beta[..., np.newaxis] - w), axis=-1) / np.abs(alpha)
+    return alpha, beta, residual
+
+
+def _count_matches(z, tree, alpha, beta, reflected, radius):
+    """Number of positions z that end up within radius (pixel) of a catalog source."""
+    if(reflected):
+        z = np.conj(z)
+    w = alpha*z + beta
+    distances, _ = tree.query(np.column_stack([w.real, w.imag]), distance_upper_bound=radius*np.abs(alpha))
+    return np.sum(np.isfinite(distances))
+
+
+def blind_solve(observation, catalog, wcsprm, coord, radius, source, verbose=True):
+    """Find the wcs from triangle hashes, without any prior on scale and rotation.
+
+    Parameters
+    ----------
+    observation : Detections or dataframe
+        sources on the observation
+    catalog : CatalogSources or dataframe
+        nearby sources from online catalogs with accurate astrometric information
+    wcsprm
+        Wcsprm file, only the projection and cdelt are kept
+    coord : SkyCoord
+        center of the catalog region
+    radius : Quantity
+        radius of the catalog region
+    source : str
+        catalog name, for the cache
+    verbose : boolean
+        Set to False to supress output to the console
+
+    Returns
+    -------
+    wcsprm or None
+        None if no solution with at least BLIND_MIN_MATCHES matched sources was found
+
+    """
+    observation = register.as_detections(observation)
+    catalog = register.as_catalog(catalog)
+    index = catalog_index(catalog, coord, radius, source)
+    ra_center, dec_center = index["center"]
+
+    bright = observation.brightest(s.BLIND_N_SOURCES)
+    obs_x = bright.x
+    obs_y = bright.y
+    keys, ordered, size = invariants(obs_x, obs_y, triangles(obs_x, obs_y, len(obs_x)-1))
+    keep = size > 4*s.BLIND_MATCH_RADIUS #small triangles do not constrain the rotation
+    keys = keys[keep]
+    ordered = ordered[keep]
+    if(len(keys) == 0 or len(index["keys"]) == 0):
+        print("Blind solve: not enough sources for triangles")
+        return None
+
+    hits = cKDTree(index["keys"]).query_ball_point(keys, r=s.BLIND_HASH_TOLERANCE)
+    n_hits = np.array([len(h) for h in hits])
+    if(np.sum(n_hits) == 0):
+        print("Blind solve: no matching triangles found")
+        return None
+    obs_tri = ordered[np.repeat(np.arange(len(keys)), n_hits)]
+    cat_tri = index["triangles"][np.concatenate(hits).astype(int)]
+
+    #candidate transformations from each pair of triangles, with and without reflection
+    z = obs_x[obs_tri] + 1j*obs_y[obs_tri]
+    w = index["x"][cat_tri] + 1j*index["y"][cat_tri]
+    alpha, beta, residual = _fit_similarity(z, w, False)
+    alpha_r, beta_r, residual_r = _fit_similarity(z, w, True)
+    reflected = residual_r < residual
+    alpha = np.where(reflected, alpha_r, alpha)
+    beta = np.where(reflected, beta_r, beta)
+    residual = np.where(reflected, residual_r, residual)
+    good = residual < s.BLIND_MATCH_RADIUS
+    if(not np.any(good)):
+        print("Blind solve: no consistent triangles found")
+        return None
+    alpha, beta, reflected = alpha[good], beta[good], reflected[good]
+
+    #vote for scale, rotation and reflection, verify the best supported candidates
+    votes = np.column_stack([np.round(np.log(np.abs(alpha))/0.02), np.round(np.angle(alpha)/np.radians(1)), reflected]).astype(int)
+    bins, members, counts = np.unique(votes, axis=0, return_inverse=True, return_counts=True)
+    members = members.reshape(-1)
+
+    cat_x, cat_y = tangent_plane(catalog.ra, catalog.dec, ra_center, dec_center)
+    tree = cKDTree(np.column_stack([cat_x, cat_y]))
+    z_all = observation.x + 1j*observation.y
+    best = (0, None)
+    for b in np.argsort(-counts)[:s.BLIND_N_CANDIDATES]:
+        candidates = np.nonzero(members == b)[0]
+        for c in candidates[:s.BLIND_N_CANDIDATES]:
+            n_matches = _count_matches(z_all, tree, alpha[c], beta[c], reflected[c], s.BLIND_MATCH_RADIUS)
+            if(n_matches > best[0]):
+                best = (n_matches, c)
+    n_matches, c = best
+    if(n_matches < s.BLIND_MIN_MATCHES):
+        print("Blind solve: best candidate only matched {} sources, will use the cross correlation instead".format(n_matches))
+        return None
+    alpha, beta, is_reflected = alpha[c], beta[c], bool(reflected[c])
+
+    #refine with all matched sources
+    z = np.conj(z_all) if is_reflected else z_all
+    distances, matches = tree.query(np.column_stack([(alpha*z+beta).real, (alpha*z+beta).imag]), distance_upper_bound=s.BLIND_MATCH_RADIUS*np.abs(alpha))
+    matched = np.isfinite(distances)
+    alpha, beta, _ = _fit_similarity(z_all[matched], cat_x[matches[matched]] + 1j*cat_y[matches[matched]], is_reflected)
+
+    #intermediate world coordinates = A @ pixel + t, so crpix = -A^-1 t and pc = A/cdelt
+    if(is_reflected):
+        A = np.array([[alpha.real, alpha.imag], [alpha.imag, -alpha.real]])
+    else:
+        A = np.array([[alpha.real, -alpha.imag], [alpha.imag, alpha.real]])
+    t = np.array([beta.real, beta.imag])
+    wcsprm = copy.copy(wcsprm)
+    cdelt = np.array(wcsprm.get_cdelt())
+    wcsprm.crval = [ra_center, dec_center]
+    wcsprm.crpix = -np.linalg.solve(A, t)
+    wcsprm.pc = A / cdelt[:, np.newaxis]
+
+    #find_matches compares squared distances with the threshold
+    obs_matched_x, _, _, _, _ = register.find_matches(observation, catalog, wcsprm, threshold=s.BLIND_MATCH_RADIUS**2)
+    if(len(obs_matched_x) < s.BLIND_MIN_MATCHES):
+        print("Blind solve: the solution only matched {} sources, will use the cross correlation instead".format(len(obs_matched_x)))
+        return None
+
+    if(is_reflected):
+        refl = ""
+    else:
+        refl = "not "
+    print("Blind solve with triangle hashes: pixelscale {:.3g} arcsec, rotation of {:.3g} deg. The image was ".format(np.abs(alpha)*3600, np.degrees(np.angle(alpha)))+refl+"mirrored.")
+    if(verbose):
+        print("{} of {} sources matched within {} pixel, {} candidate triangle pairs".format(len(obs_matched_x), len(z_all), s.BLIND_MATCH_RADIUS, len(members)))
+    return wcsprm